@@ -0,0 +1,906 @@
+"""
+Asyncio monitoring engine: IMAP, SMS and the HTTP endpoint on a single event loop
+"""
+
+import asyncio
+import re
+import signal
+import ssl
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from urllib.parse import urlsplit
+
+from email_monitor import DISCOVERY_STAGGER_SECONDS, IDLE_MAX_SECONDS, MailboxSession
+
+from metrics import IMAP_CONNECT_DURATION
+from sms_rate_limiter import parse_retry_after
+from sms_sender import SMSThrottled
+
+try:
+    from aiohttp import ClientSession, ClientTimeout, TCPConnector
+    from twilio.base.exceptions import TwilioRestException
+    from twilio.rest import Client
+    from twilio.http.async_http_client import AsyncTwilioHttpClient
+except ImportError:
+    # Older or slimmed-down twilio installs: sends fall back to a worker thread
+    Client = None
+    AsyncTwilioHttpClient = None
+
+LITERAL_RE = re.compile(rb'\{(\d+)\}$')
+NUMBERED_UNTAGGED_RE = re.compile(rb'^(\d+) (\w+)(.*)$', re.DOTALL)
+RESPONSE_CODE_RE = re.compile(rb'^\[(\S+?)(?: ([^\]]*))?\]')
+
+class AsyncIMAPError(Exception):
+    """The server rejected a command or the connection was lost"""
+
+class AsyncIMAPClient:
+    """Minimal asyncio IMAP4rev1 client
+    
+    Results use imaplib's (status, data) shapes so the parsing helpers in
+    email_monitor work unchanged on both engines.
+    """
+    
+    def __init__(self, reader, writer, command_timeout):
+        self.reader = reader
+        self.writer = writer
+        self.command_timeout = command_timeout
+        self.capabilities = ()
+        self.untagged_responses = {}
+        self.tag_prefix = f"A{id(self) % 10000:04d}"
+        self.tag_number = 0
+    
+    @classmethod
+    async def connect(cls, host, port, tls='ssl', connect_timeout=10, command_timeout=60):
+        """Open a connection and read the greeting; tls is 'ssl', 'starttls' or None"""
+        context = ssl.create_default_context()
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(host, port, ssl=context if tls == 'ssl' else None),
+            connect_timeout
+        )
+        client = cls(reader, writer, command_timeout)
+        
+        try:
+            greeting = await asyncio.wait_for(reader.readline(), connect_timeout)
+            if not greeting.startswith(b'* OK'):
+                raise AsyncIMAPError(f"Unexpected greeting: {greeting.strip()}")
+            
+            if tls == 'starttls':
+                await client.command('STARTTLS')
+                await writer.start_tls(context, server_hostname=host)
+            
+            await client.command('CAPABILITY')
+            capabilities = client.pop_untagged('CAPABILITY')
+            client.capabilities = tuple(capabilities[-1].decode().upper().split()) if capabilities else ()
+        except BaseException:
+            client.close()
+            raise
+        
+        return client
+    
+    def _new_tag(self):
+        self.tag_number += 1
+        return f"{self.tag_prefix}{self.tag_number}".encode()
+    
+    async def _read_line(self):
+        line = await self.reader.readline()
+        if not line:
+            raise AsyncIMAPError("connection closed by server")
+        return line
+    
+    async def _collect_untagged(self, line):
+        """Store an untagged response the way imaplib does, reading any literals"""
+        line = line.rstrip(b'\r\n')
+        numbered = NUMBERED_UNTAGGED_RE.match(line)
+        if numbered:
+            name = numbered.group(2).upper().decode()
+            data = numbered.group(1) + numbered.group(3) if name == 'FETCH' else numbered.group(1)
+        else:
+            name, _, data = line.partition(b' ')
+            name = name.upper().decode()
+            if name == 'BYE':
+                raise AsyncIMAPError(f"server said BYE: {data.decode(errors='replace')}")
+            code = RESPONSE_CODE_RE.match(data)
+            if code:
+                self.untagged_responses.setdefault(code.group(1).upper().decode(), []).append(code.group(2))
+        
+        literal = LITERAL_RE.search(data)
+        while literal:
+            value = await self.reader.readexactly(int(literal.group(1)))
+            self.untagged_responses.setdefault(name, []).append((data, value))
+            data = (await self._read_line()).rstrip(b'\r\n')
+            literal = LITERAL_RE.search(data)
+        
+        self.untagged_responses.setdefault(name, []).append(data)
+    
+    async def _read_until_tagged(self, tag):
+        while True:
+            line = await self._read_line()
+            if line.startswith(tag + b' '):
+                return line[len(tag) + 1:].split(b' ', 1)[0].decode().upper()
+            if line.startswith(b'* '):
+                await self._collect_untagged(line[2:])
+    
+    async def command(self, name, *args):
+        """Send a command and wait for its tagged completion; returns the status"""
+        tag = self._new_tag()
+        parts = [tag, name.encode()] + [arg.encode() if isinstance(arg, str) else arg for arg in args if arg is not None]
+        self.writer.write(b' '.join(parts) + b'\r\n')
+        
+        try:
+            await self.writer.drain()
+            status = await asyncio.wait_for(self._read_until_tagged(tag), self.command_timeout)
+        except asyncio.TimeoutError:
+            raise AsyncIMAPError(f"{name} timed out after {self.command_timeout}s")
+        except (ConnectionError, asyncio.IncompleteReadError) as e:
+            raise AsyncIMAPError(f"connection lost during {name}: {str(e)}")
+        
+        if status not in ('OK', 'NO', 'BAD'):
+            raise AsyncIMAPError(f"unexpected completion for {name}: {status}")
+        if status == 'BAD' or (status == 'NO' and name in ('LOGIN', 'SELECT', 'STARTTLS')):
+            raise AsyncIMAPError(f"{name} failed with {status}")
+        return status
+    
+    def pop_untagged(self, name):
+        return self.untagged_responses.pop(name, [])
+    
+    async def login(self, username, password):
+        quoted = '"' + password.replace('\\', '\\\\').replace('"', '\\"') + '"'
+        return await self.command('LOGIN', username, quoted)
+    
+    async def select(self, mailbox='INBOX'):
+        return await self.command('SELECT', mailbox)
+    
+    async def noop(self):
+        # The session consumes the unsolicited responses, e.g. EXISTS, it returns
+        return await self.command('NOOP')
+    
+    async def uid(self, command, *args):
+        """UID SEARCH / UID FETCH returning (status, data) like imaplib"""
+        status = await self.command('UID', command, *args)
+        return status, self.pop_untagged(command.upper()) or [None]
+    
+    async def idle(self, timeout, stop_event, note_line):
+        """Wait in IDLE until note_line(untagged line) reports new mail
+        
+        Returns True (new mail), False (timeout or stop) or None (refused).
+        Untagged lines sent before the continuation go to note_line too;
+        those after DONE are left in untagged_responses.
+        """
+        tag = self._new_tag()
+        self.writer.write(tag + b' IDLE\r\n')
+        await self.writer.drain()
+        
+        new_mail = False
+        while True:
+            response = await asyncio.wait_for(self._read_line(), self.command_timeout)
+            if response.startswith(b'+'):
+                break
+            if response.startswith(tag + b' '):
+                return None
+            if not response.startswith(b'* ') or response.startswith(b'* BYE'):
+                raise AsyncIMAPError(f"unexpected response to IDLE: {response.strip()}")
+            new_mail = note_line(response)
+        
+        deadline = time.monotonic() + timeout
+        while not new_mail and not stop_event.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            
+            read_task = asyncio.ensure_future(self.reader.readline())
+            stop_task = asyncio.ensure_future(stop_event.wait())
+            done, _ = await asyncio.wait(
+                {read_task, stop_task}, timeout=remaining, return_when=asyncio.FIRST_COMPLETED
+            )
+            stop_task.cancel()
+            
+            if read_task not in done:
+                # Cancelling readline leaves any partial line buffered in the reader
+                read_task.cancel()
+                try:
+                    await read_task
+                except asyncio.CancelledError:
+                    pass
+                continue
+            
+            line = read_task.result()
+            if not line or line.startswith(b'* BYE'):
+                raise AsyncIMAPError("connection closed by server during IDLE")
+            new_mail = note_line(line)
+        
+        self.writer.write(b'DONE\r\n')
+        await self.writer.drain()
+        await asyncio.wait_for(self._read_until_tagged(tag), self.command_timeout)
+        return new_mail
+    
+    async def logout(self):
+        try:
+            await self.command('LOGOUT')
+        except Exception:
+            pass
+        finally:
+            self.close()
+    
+    def close(self):
+        try:
+            self.writer.close()
+        except Exception:
+            pass
+
+async def run_commands_async(commands, execute):
+    """Awaiting counterpart of email_monitor.run_commands"""
+    try:
+        request = next(commands)
+        while True:
+            request = commands.send(await execute(*request))
+    except StopIteration as finished:
+        return finished.value
+
+class AsyncMailboxSession(MailboxSession):
+    """MailboxSession counterpart whose connector and probes are coroutines"""
+    
+    async def is_alive(self):
+        if self.connection is None:
+            return False
+        
+        try:
+            start = time.monotonic()
+            status = await self.connection.noop()
+            self.total_noop_time += time.monotonic() - start
+            self.consume_untagged()
+            return status == 'OK'
+        except (AsyncIMAPError, OSError) as e:
+            self.logger.info(f"IMAP session lost: {str(e)}")
+            return False
+    
+    async def acquire(self):
+        """Return a live, selected client, reconnecting only if the session is gone"""
+        if await self.is_alive():
+            self.reuses += 1
+            self.logger.debug("Reusing IMAP session (saved ~%.2fs handshake)", self.average_handshake_time())
+            return self.connection
+        
+        self.invalidate()
+        
+        start = time.monotonic()
+        client = await self.connector()
+        if client is None:
+            return None
+        
+        try:
+            await client.select(self.mailbox)
+        except Exception as e:
+            self.logger.error(f"Error selecting {self.mailbox}: {str(e)}")
+            await client.logout()
+            return None
+        
+        self.uidvalidity = self._response_code(client, 'UIDVALIDITY')
+        self.uidnext = self._response_code(client, 'UIDNEXT')
+        # The mailbox size reported by SELECT is the baseline, not new mail
+        self.exists = self._response_code(client, 'EXISTS')
+        self.new_mail_seen = False
+        client.untagged_responses.clear()
+        
+        elapsed = time.monotonic() - start
+        self.handshakes += 1
+        self.total_handshake_time += elapsed
+        IMAP_CONNECT_DURATION.observe(elapsed)
+        self.connection = client
+        self.logger.debug("Opened new IMAP session in %.2fs", elapsed, extra={'stage': 'connect', 'duration': elapsed})
+        return client
+    
+    def _response_code(self, client, name):
+        try:
+            return int(client.pop_untagged(name)[-1])
+        except (TypeError, ValueError, IndexError):
+            return None
+    
+    def invalidate(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+    
+    async def close(self):
+        if self.connection is not None:
+            client = self.connection
+            self.connection = None
+            await client.logout()
+
+if AsyncTwilioHttpClient is not None:
+    class PooledAsyncTwilioHttpClient(AsyncTwilioHttpClient):
+        """Async counterpart of sms_sender.PooledTwilioHttpClient, on an aiohttp connector"""
+        
+        def __init__(self, rate_limiter, pool_size=4, timeout=None, keepalive_interval=0):
+            super().__init__(pool_connections=False, timeout=timeout)
+            self.rate_limiter = rate_limiter
+            self.pool_size = pool_size
+            self.last_request_at = None
+            
+            # aiohttp closes connections idle for 15s by default; hold them past the keep-alive refresh
+            connector = TCPConnector(limit=pool_size, keepalive_timeout=max(15.0, 2 * keepalive_interval))
+            self.session = ClientSession(
+                connector=connector, timeout=ClientTimeout(total=timeout) if timeout else None
+            )
+        
+        async def request(self, method, url, params=None, data=None, headers=None, auth=None, timeout=None,
+                          allow_redirects=False):
+            response = await super().request(method, url, params, data, headers, auth, timeout, allow_redirects)
+            self.last_request_at = time.monotonic()
+            if response.status_code == 429 and data and data.get('From'):
+                self.rate_limiter.throttle(data['From'], parse_retry_after((response.headers or {}).get('Retry-After')))
+            return response
+
+class AsyncSMSSender:
+    """Sends through Twilio's aiohttp client, reusing SMSSender's formatting and rate limiter"""
+    
+    def __init__(self, sms_sender):
+        self.sms_sender = sms_sender
+        self.logger = sms_sender.logger
+        self.rate_limiter = sms_sender.rate_limiter
+        self.client = None
+        
+        base_client = sms_sender.client
+        if AsyncTwilioHttpClient is not None and base_client is not None:
+            config = sms_sender.config
+            http_client = PooledAsyncTwilioHttpClient(
+                self.rate_limiter, pool_size=config.sms_http_pool_size, timeout=config.sms_http_timeout,
+                keepalive_interval=config.sms_http_keepalive_interval
+            )
+            self.client = Client(base_client.username, base_client.password, http_client=http_client)
+            self.client.api.base_url = base_client.api.base_url
+        else:
+            self.logger.warning("Async Twilio client unavailable, sending SMS from a worker thread")
+    
+    async def send_message(self, to_phone_number, message):
+        """Send an SMS without blocking the event loop; returns its SID or None
+        
+        Raises SMSThrottled like SMSSender.send_message.
+        """
+        if self.client is None:
+            return await asyncio.to_thread(self.sms_sender.send_message, to_phone_number, message)
+        
+        params = None
+        try:
+            params = self.sms_sender.build_message_params(to_phone_number, message)
+            if params is None:
+                return None
+            
+            wait = self.rate_limiter.acquire(params['from_'])
+            if wait:
+                raise SMSThrottled(wait)
+            
+            self.logger.info(f"Sending SMS from {params['from_']} to {params['to']}")
+            twilio_message = await self.client.messages.create_async(**params)
+            self.rate_limiter.record_success(params['from_'])
+            self.logger.info(f"SMS sent successfully. Message SID: {twilio_message.sid}")
+            return twilio_message.sid
+        
+        except SMSThrottled:
+            raise
+        except TwilioRestException as e:
+            if e.status == 429:
+                self.logger.warning(f"Twilio rate limited {params['from_']}: {e.msg}")
+                sender = params['from_']
+                raise SMSThrottled(self.rate_limiter.delay(sender) or self.rate_limiter.throttle(sender))
+            self.logger.error(f"Error sending SMS notification: {str(e)}")
+            return None
+        except Exception as e:
+            self.logger.error(f"Error sending SMS notification: {str(e)}")
+            return None
+    
+    async def warm_up(self, connections=1):
+        """Async counterpart of SMSSender.warm_up"""
+        if self.client is None:
+            return await asyncio.to_thread(self.sms_sender.warm_up, connections)
+        
+        connections = max(1, min(connections, self.client.http_client.pool_size))
+        start = time.monotonic()
+        results = await asyncio.gather(*(self._fetch_account() for _ in range(connections)))
+        warmed = sum(results)
+        self.logger.debug("Warmed up %d/%d Twilio connection(s) in %.3fs", warmed, connections, time.monotonic() - start)
+        return warmed
+    
+    async def keep_warm(self, connections=1):
+        """Async counterpart of SMSSender.keep_warm"""
+        if self.client is None:
+            return await asyncio.to_thread(self.sms_sender.keep_warm, connections)
+        
+        interval = self.sms_sender.config.sms_http_keepalive_interval
+        last_request_at = self.client.http_client.last_request_at
+        if not interval or last_request_at is None or time.monotonic() - last_request_at < interval:
+            return False
+        return await self.warm_up(connections) > 0
+    
+    async def _fetch_account(self):
+        try:
+            await self.client.api.accounts(self.client.username).fetch_async()
+            return True
+        except Exception as e:
+            self.logger.debug(f"Twilio connection warm-up failed: {str(e)}")
+            return False
+    
+    async def send_notification(self, to_phone_number, message):
+        """Send SMS notification via Twilio without blocking the event loop"""
+        try:
+            return await self.send_message(to_phone_number, message) is not None
+        except SMSThrottled as e:
+            self.logger.error(f"SMS not sent: {str(e)}")
+            return False
+    
+    async def close(self):
+        if self.client is not None:
+            await self.client.http_client.close()
+
+class AsyncHealthServer:
+    """Tiny HTTP/1.0 server answering GET and HEAD requests from a route table
+    
+    A route is the response body, or a callable returning (status code, content type, body).
+    Each connection must deliver its request, and take its response, within
+    request_timeout seconds however slowly it trickles in.
+    """
+    
+    def __init__(self, routes, logger, port, request_timeout=10):
+        self.routes = routes
+        self.logger = logger
+        self.port = port
+        self.request_timeout = request_timeout
+        self.server = None
+    
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle_request, '0.0.0.0', self.port, backlog=128)
+        self.logger.info(f"HTTP server started on port {self.port}")
+    
+    async def read_request(self, reader):
+        """(method, path) of the request; its headers are skipped"""
+        request_line = await reader.readline()
+        while True:
+            header = await reader.readline()
+            if header in (b'\r\n', b'\n', b''):
+                break
+        
+        parts = request_line.decode('latin-1').split()
+        return (parts[0] if parts else ''), (parts[1] if len(parts) > 1 else '')
+    
+    async def handle_request(self, reader, writer):
+        try:
+            method, path = await asyncio.wait_for(self.read_request(reader), self.request_timeout)
+            route = self.routes.get(path)
+            
+            if method not in ('GET', 'HEAD'):
+                writer.write(b"HTTP/1.0 501 Not Implemented\r\nContent-Length: 0\r\n\r\n")
+            elif route is None:
+                writer.write(b"HTTP/1.0 404 Not Found\r\nContent-Length: 0\r\n\r\n")
+            else:
+                status, content_type, body = route() if callable(route) else (200, 'text/plain', route)
+                writer.write(
+                    f"HTTP/1.0 {status} {HTTPStatus(status).phrase}\r\nContent-type: {content_type}\r\n"
+                    f"Content-Length: {len(body)}\r\n\r\n".encode()
+                    + (body if method == 'GET' else b'')
+                )
+            await asyncio.wait_for(writer.drain(), self.request_timeout)
+        except (asyncio.TimeoutError, ConnectionError, UnicodeDecodeError):
+            pass
+        finally:
+            writer.close()
+    
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+async def http_get_status(url, timeout=30):
+    """Fetch a URL with a plain GET and return the HTTP status code"""
+    parts = urlsplit(url)
+    secure = parts.scheme == 'https'
+    port = parts.port or (443 if secure else 80)
+    
+    reader, writer = await asyncio.wait_for(
+        asyncio.open_connection(parts.hostname, port, ssl=ssl.create_default_context() if secure else None),
+        timeout
+    )
+    try:
+        writer.write(
+            f"GET {parts.path or '/'} HTTP/1.1\r\nHost: {parts.hostname}\r\nConnection: close\r\n\r\n".encode()
+        )
+        await writer.drain()
+        status_line = await asyncio.wait_for(reader.readline(), timeout)
+        return int(status_line.split()[1])
+    finally:
+        writer.close()
+
+class AsyncMonitoringEngine:
+    """Runs an EmailMonitoringAgent's IMAP checks, SMS alerts and HTTP endpoint on one event loop
+    
+    The agent supplies logging, one EmailMonitor per mailbox (checkpoint,
+    discovery cache and parsing helpers), record_alerts() and the SMS
+    dispatcher's outbox. Every mailbox runs as its own task; all of them share
+    the SMS client and its connection pool. Alerts are recorded in the outbox
+    and delivered as tasks, so delivery overlaps with the next fetch or IDLE
+    wait.
+    
+    The process is not single-threaded: outbox, dedup and checkpoint writes
+    commit to disk (SQLite with synchronous=FULL), so they all run on one
+    dedicated outbox thread, in order, instead of stalling the event loop.
+    """
+    
+    def __init__(self, agent, http_routes=None, http_port=None, keep_alive_url=None, health_watchdog=None):
+        self.agent = agent
+        self.logger = agent.logger
+        self.sms = None
+        self.mailboxes = [AsyncMailboxMonitor(self, monitor) for monitor in agent.email_monitors]
+        self.http_routes = http_routes
+        self.http_port = http_port
+        self.keep_alive_url = keep_alive_url
+        self.health_watchdog = health_watchdog
+        self.stop_event = None
+        self.loop = None
+        self.outbox_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='outbox')
+        self.deliveries = {}
+        
+        # Alerts are delivered by this loop instead of the dispatcher's threads
+        for monitor in agent.email_monitors:
+            monitor.alert_handler = self.handle_new_emails
+    
+    def run(self):
+        """Run the engine until a shutdown signal arrives"""
+        return asyncio.run(self.run_async())
+    
+    def request_stop(self, signum=None):
+        if signum is not None:
+            self.logger.info(f"Received signal {signum}, shutting down gracefully...")
+        self.agent.running = False
+        self.stop_event.set()
+    
+    async def run_async(self):
+        self.stop_event = asyncio.Event()
+        self.loop = asyncio.get_running_loop()
+        
+        # aiohttp sessions must be created on the loop that uses them
+        self.sms = AsyncSMSSender(self.agent.sms_sender)
+        await self.sms.warm_up(self.agent.sms_dispatcher.worker_count)
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            self.loop.add_signal_handler(signum, self.request_stop, signum)
+        
+        http_server = None
+        background = []
+        try:
+            if self.http_routes is not None:
+                http_server = AsyncHealthServer(
+                    self.http_routes, self.logger, self.http_port, self.agent.config.http_request_timeout
+                )
+                await http_server.start()
+            
+            background.append(asyncio.create_task(self._outbox_loop()))
+            
+            if self.health_watchdog is not None:
+                background.append(asyncio.create_task(self._health_loop()))
+            
+            if self.keep_alive_url:
+                background.append(asyncio.create_task(self._keep_alive_loop()))
+                self.logger.info("Internal keep-alive pinger started (10-minute intervals)")
+            
+            self.logger.info(f"Asyncio monitoring engine started for {len(self.mailboxes)} mailbox(es)")
+            await asyncio.gather(*(mailbox.run() for mailbox in self.mailboxes))
+        
+        finally:
+            for task in background:
+                task.cancel()
+            
+            # A commit still running records its alerts and schedules their delivery
+            self.outbox_executor.shutdown(wait=True)
+            await asyncio.sleep(0)
+            
+            # Let alerts already in flight finish before closing the clients;
+            # anything not delivered stays in the outbox for the next run
+            if self.deliveries:
+                await asyncio.gather(*self.deliveries.values(), return_exceptions=True)
+            
+            for mailbox in self.mailboxes:
+                await mailbox.session.close()
+                self.logger.info(f"IMAP session stats for {mailbox.name}: {mailbox.session.get_stats()}")
+            
+            await self.sms.close()
+            if http_server is not None:
+                await http_server.close()
+            
+            self.logger.info("Asyncio monitoring engine stopped")
+        
+        return True
+    
+    async def sleep(self, seconds):
+        """Sleep unless a shutdown is requested first; returns True on shutdown"""
+        try:
+            await asyncio.wait_for(self.stop_event.wait(), seconds)
+            return True
+        except asyncio.TimeoutError:
+            return False
+    
+    async def in_outbox_thread(self, function, *args):
+        """Run a blocking outbox, dedup or checkpoint write on the outbox thread"""
+        return await self.loop.run_in_executor(self.outbox_executor, function, *args)
+    
+    def handle_new_emails(self, email_monitor, emails):
+        """Alert handler for the monitors: record the alerts, then deliver them as tasks
+        
+        Runs on the outbox thread, as part of EmailMonitor.commit_new_emails.
+        """
+        keys = self.agent.record_alerts(emails, email_monitor.config.target_phone_numbers)
+        
+        # Held alerts are scheduled by the outbox loop once their coalescing window closes
+        if not self.agent.outbox.coalesce_window:
+            for key in keys:
+                self.loop.call_soon_threadsafe(self.schedule_delivery, key)
+    
+    def schedule_delivery(self, key):
+        if key in self.deliveries:
+            return
+        task = asyncio.create_task(self._deliver(key))
+        self.deliveries[key] = task
+        task.add_done_callback(lambda _: self.deliveries.pop(key, None))
+    
+    async def _deliver(self, key):
+        """Async counterpart of SMSDispatchQueue._deliver, sharing its outbox and stats"""
+        dispatcher = self.agent.sms_dispatcher
+        try:
+            # Claiming may also reconcile an earlier attempt with the blocking Twilio client
+            prepared = await self.in_outbox_thread(dispatcher.prepare_delivery, key)
+            if prepared is None:
+                return
+            
+            rows, body = prepared
+            start = time.monotonic()
+            sid, error = None, "send failed"
+            try:
+                sid = await self.sms.send_message(rows[0]['recipient'], body)
+            except SMSThrottled as e:
+                await self.in_outbox_thread(dispatcher.defer, rows, e.retry_after)
+                return
+            except Exception as e:
+                error = str(e)
+            
+            await self.in_outbox_thread(dispatcher.record_result, rows, sid, error, time.monotonic() - start)
+        except Exception as e:
+            self.logger.error(f"Error delivering SMS alert: {str(e)}")
+    
+    async def _outbox_loop(self):
+        """Deliver alerts whose backoff or coalescing window has expired and reconcile in-doubt ones"""
+        dispatcher = self.agent.sms_dispatcher
+        while not await self.sleep(dispatcher.pump_interval):
+            try:
+                # Reconciliation also queries Twilio with the blocking client
+                for key in await self.in_outbox_thread(dispatcher.poll_outbox):
+                    self.schedule_delivery(key)
+                await self.sms.keep_warm(dispatcher.worker_count)
+            except Exception as e:
+                self.logger.error(f"Error in SMS outbox pump: {str(e)}")
+    
+    async def _health_loop(self):
+        """Refresh the health snapshot on the loop, in place of HealthWatchdog's thread"""
+        while not await self.sleep(self.health_watchdog.interval):
+            self.health_watchdog.refresh()
+    
+    async def _keep_alive_loop(self):
+        while not await self.sleep(600):  # 10 minutes
+            try:
+                status = await http_get_status(f"{self.keep_alive_url}/keepalive")
+                if status == 200:
+                    self.logger.info("Keep-alive ping successful - service staying awake")
+                else:
+                    self.logger.warning(f"Keep-alive ping returned status: {status}")
+            except Exception as ping_error:
+                self.logger.warning(f"Keep-alive ping failed: {str(ping_error)}")
+
+class AsyncMailboxMonitor:
+    """Checks one mailbox on the engine's event loop"""
+    
+    def __init__(self, engine, monitor):
+        self.engine = engine
+        self.monitor = monitor
+        self.config = monitor.config
+        self.logger = monitor.logger
+        self.name = monitor.config.mailbox_name
+        self.session = AsyncMailboxSession(self._open_client, self.logger)
+    
+    async def run(self):
+        """Monitoring loop for this mailbox, until the engine stops"""
+        engine = self.engine
+        while not engine.stop_event.is_set():
+            cycle_start = time.monotonic()
+            try:
+                await self.run_monitoring_cycle()
+                
+                # Wait for the server to push new mail; None means IDLE is unavailable
+                if self.config.use_idle:
+                    new_mail = await self.wait_for_new_mail(self.config.idle_timeout)
+                    if new_mail is not None:
+                        continue
+            
+            except Exception as e:
+                self.logger.error(f"Unexpected error monitoring {self.name}: {str(e)}")
+            
+            cycle_duration = time.monotonic() - cycle_start
+            await engine.sleep(max(0, self.monitor.poll_scheduler.next_interval() - cycle_duration))
+    
+    async def run_monitoring_cycle(self):
+        """Check for new emails and schedule their alerts without waiting for delivery"""
+        try:
+            self.logger.info(f"Starting email monitoring cycle for {self.name}...")
+            new_emails = await self.check_for_bookeo_emails()
+            
+            # Their alerts were recorded and scheduled by the engine's alert handler
+            if new_emails:
+                self.logger.info(f"Found {len(new_emails)} new Bookeo email(s) in {self.name}")
+            else:
+                self.logger.info(f"No new Bookeo emails found in {self.name}")
+        
+        except Exception as e:
+            self.logger.error(f"Error during monitoring cycle: {str(e)}")
+    
+    async def check_for_bookeo_emails(self):
+        """Async counterpart of EmailMonitor.check_for_bookeo_emails"""
+        monitor = self.monitor
+        with monitor.tracked_check(self.session):
+            try:
+                client = await self.session.acquire()
+                if client is None:
+                    return []
+                
+                checked = await run_commands_async(monitor.check_commands(self.session), client.uid)
+                return await self.engine.in_outbox_thread(monitor.commit_new_emails, *checked) if checked else []
+            
+            except (AsyncIMAPError, OSError, asyncio.TimeoutError) as e:
+                self.logger.error(f"IMAP connection lost while checking for Bookeo emails: {str(e)}")
+                self.session.invalidate()
+                return monitor.discard_new_emails()
+            
+            except Exception as e:
+                self.logger.error(f"Error checking for Bookeo emails: {str(e)}")
+                return monitor.discard_new_emails()
+    
+    async def wait_for_new_mail(self, timeout):
+        """Async counterpart of EmailMonitor.wait_for_new_mail"""
+        self.monitor.using_idle = False
+        client = await self.session.acquire()
+        if client is None:
+            return None
+        
+        if not self.session.supports_idle():
+            self.logger.debug("IMAP server does not support IDLE")
+            return None
+        self.monitor.using_idle = True
+        
+        # Mail announced since the last search (e.g. in acquire's NOOP) is
+        # not repeated once IDLE starts
+        if self.session.new_mail_seen:
+            self.logger.debug("New mail was announced before IDLE started")
+            return True
+        
+        try:
+            self.logger.debug(f"Waiting up to {timeout}s for new mail via IMAP IDLE")
+            new_mail = await client.idle(
+                min(timeout, IDLE_MAX_SECONDS), self.engine.stop_event, self.session.note_idle_line
+            )
+            self.session.consume_untagged()
+            if new_mail:
+                self.logger.info("IMAP IDLE: server reported new mail")
+            return new_mail
+        except (AsyncIMAPError, OSError, asyncio.TimeoutError) as e:
+            self.logger.error(f"IMAP IDLE failed: {str(e)}")
+            self.session.invalidate()
+            self.monitor.using_idle = False
+            return None
+    
+    async def _open_transport(self, imap_server, port):
+        """Connect to a single IMAP server up to (not including) LOGIN, raising on failure"""
+        self.logger.info(f"Attempting connection to IMAP server: {imap_server}:{port}")
+        return await AsyncIMAPClient.connect(
+            imap_server, port,
+            tls='ssl' if port == 993 else 'starttls',
+            connect_timeout=self.config.imap_connect_timeout,
+            command_timeout=self.config.imap_command_timeout,
+        )
+    
+    async def _login(self, client):
+        """Log in on a client from _open_transport, closing it on failure"""
+        try:
+            await asyncio.wait_for(
+                client.login(self.config.email_address, self.config.email_password),
+                self.config.imap_login_timeout
+            )
+        except BaseException:
+            client.close()
+            raise
+    
+    async def _connect_to_server(self, imap_server, port):
+        """Connect and log in to a single IMAP server, raising on failure"""
+        client = await self._open_transport(imap_server, port)
+        await self._login(client)
+        return client
+    
+    async def _race_servers(self, imap_servers):
+        """Happy-eyeballs race over the candidates; returns (host, port, client) or None
+        
+        As in EmailMonitor._race_servers only the connect, TLS and greeting
+        are raced; LOGIN goes to the first server that answered and to the
+        next one only if it fails.
+        """
+        candidates = iter(imap_servers)
+        attempts = {}
+        pending = set()
+        connected = []
+        
+        def start_next():
+            for imap_server, port in candidates:
+                task = asyncio.create_task(self._open_transport(imap_server, port))
+                attempts[task] = (imap_server, port)
+                pending.add(task)
+                return
+        
+        try:
+            start_next()
+            while pending or connected:
+                if not connected:
+                    done, _ = await asyncio.wait(
+                        pending, timeout=DISCOVERY_STAGGER_SECONDS, return_when=asyncio.FIRST_COMPLETED
+                    )
+                    if not done:
+                        start_next()
+                    for task in done:
+                        pending.discard(task)
+                        host, port = attempts[task]
+                        if task.exception() is None:
+                            connected.append((host, port, task.result()))
+                        else:
+                            # A failure starts the next candidate immediately
+                            self.logger.debug(f"Failed to connect to {host}:{port} - {str(task.exception())}")
+                            start_next()
+                    continue
+                
+                # The other candidates keep connecting while this login runs
+                imap_server, port, client = connected.pop(0)
+                try:
+                    await self._login(client)
+                    return imap_server, port, client
+                except Exception as login_error:
+                    self.logger.debug(f"Login to {imap_server}:{port} failed - {str(login_error)}")
+                    start_next()
+            
+            return None
+        
+        finally:
+            for task in pending:
+                task.cancel()
+            # Close any candidate that connected while we were deciding; a
+            # cancellation of this task itself still propagates from gather
+            for result in await asyncio.gather(*pending, return_exceptions=True):
+                if isinstance(result, AsyncIMAPClient):
+                    result.close()
+            for _, _, client in connected:
+                client.close()
+    
+    async def _open_client(self):
+        """Async counterpart of EmailMonitor._open_connection"""
+        monitor = self.monitor
+        try:
+            cached, imap_servers = monitor.discovery_candidates()
+            if cached:
+                try:
+                    client = await self._connect_to_server(*cached)
+                    monitor.record_connected(*cached, cached=True)
+                    return client
+                except Exception as server_error:
+                    imap_servers = monitor.record_cached_failure(cached, imap_servers, server_error)
+            
+            winner = await self._race_servers(imap_servers)
+            if winner:
+                imap_server, port, client = winner
+                monitor.record_connected(imap_server, port)
+                return client
+            
+            monitor.record_discovery_failed()
+            return None
+        
+        except Exception as e:
+            self.logger.error(f"Error connecting to mailbox: {str(e)}")
+            return None
@@ -0,0 +1,925 @@
+#!/usr/bin/env python3
+"""
+Offline performance benchmarks for the email monitoring agent
+
+Usage: python benchmarks.py [benchmark ...]
+Runs every benchmark when none is named.
+"""
+
+import asyncio
+import copy
+import email
+import logging
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+from booking_parser import booking_extractor
+from config import Config
+from dedup_store import DedupStore
+from email_monitor import EmailMonitor
+from latency_metrics import format_seconds, pipeline_latency
+from metrics import CYCLES, CYCLE_DURATION, register_agent_metrics, registry
+from fake_servers import FakeIMAPServer, FakeTwilioServer, generate_bookeo_message
+from harness import clear_twilio_env, make_logger, make_monitor, make_twilio_sender
+from poll_scheduler import PollScheduler
+from sms_outbox import SMSOutbox, alert_key
+from sms_rate_limiter import SendRateLimiter
+from sms_sender import SMSDispatchQueue
+
+def bench_batched_fetch(message_counts=(1, 5, 10, 25, 50), latency=0.02):
+    """Cycle time against message count: one FETCH per email vs batched FETCHes"""
+    logger = make_logger()
+    print(f"\nBatched FETCH ({latency * 1000:.0f} ms simulated round trip)")
+    print(f"{'emails':>8} {'per-email':>12} {'batched cycle':>14} {'FETCHes':>10} {'speedup':>9}")
+    
+    for count in message_counts:
+        server = FakeIMAPServer(latency=latency).start()
+        for index in range(count):
+            server.mailbox.add_message(generate_bookeo_message(index))
+        
+        # Baseline: the previous one-round-trip-per-email loop
+        monitor = make_monitor(server, logger)
+        connection = monitor.session.acquire()
+        start = time.perf_counter()
+        _, messages = connection.uid('SEARCH', None, 'FROM "noreply@bookeo.com"')
+        for uid in messages[0].split():
+            _, email_data = connection.uid('FETCH', uid, '(RFC822)')
+            monitor.parse_email_message(email_data[0][1])
+        per_email_time = time.perf_counter() - start
+        monitor.disconnect_from_mailbox()
+        
+        # Batched: a full monitoring cycle on a warm session
+        monitor = make_monitor(server, logger)
+        monitor.session.acquire()
+        server.reset_counters()
+        start = time.perf_counter()
+        found = monitor.check_for_bookeo_emails()
+        batched_time = time.perf_counter() - start
+        monitor.disconnect_from_mailbox()
+        server.stop()
+        
+        assert len(found) == count, f"expected {count} emails, found {len(found)}"
+        print(
+            f"{count:>8} {per_email_time * 1000:>10.1f}ms {batched_time * 1000:>12.1f}ms "
+            f"{server.fetch_commands:>10} {per_email_time / batched_time:>8.1f}x"
+        )
+
+def bench_fetch_bytes(message_count=20, html_sizes=(2000, 20000, 200000)):
+    """Bytes downloaded per message: full RFC822 vs header-first partial fetch"""
+    logger = make_logger()
+    print(f"\nDownload size per message ({message_count} emails)")
+    print(f"{'HTML part':>10} {'RFC822':>12} {'header-first':>14} {'reduction':>10}")
+    
+    for html_size in html_sizes:
+        server = FakeIMAPServer().start()
+        for index in range(message_count):
+            server.mailbox.add_message(generate_bookeo_message(index, html_size=html_size))
+        
+        monitor = make_monitor(server, logger)
+        connection = monitor.session.acquire()
+        server.reset_counters()
+        connection.uid('FETCH', f"1:{message_count}", '(UID RFC822)')
+        full_bytes = server.bytes_sent / message_count
+        
+        server.reset_counters()
+        found = monitor.check_for_bookeo_emails()
+        partial_bytes = server.bytes_sent / message_count
+        monitor.disconnect_from_mailbox()
+        server.stop()
+        
+        assert len(found) == message_count and all(email_info['body'] for email_info in found)
+        print(
+            f"{html_size:>9}B {full_bytes / 1024:>10.1f}KB {partial_bytes / 1024:>12.1f}KB "
+            f"{full_bytes / partial_bytes:>9.1f}x"
+        )
+
+class NullSMSSender:
+    """Stands in for SMSSender; the async engine sends through it from a worker thread"""
+    
+    client = None
+    
+    def __init__(self, logger):
+        self.logger = logger
+        self.rate_limiter = SendRateLimiter(rate=1e9, burst=1000)
+        self.sent = 0
+    
+    def available_sends(self):
+        return self.rate_limiter.burst
+    
+    def send_message(self, to_phone_number, message):
+        self.sent += 1
+        return f"SM{self.sent:032d}"
+    
+    def find_sent_message(self, to_phone_number, message, since, exclude=()):
+        return None
+    
+    def warm_up(self, connections=1):
+        return 0
+    
+    def keep_warm(self, connections=1):
+        return False
+
+class BenchmarkAgent:
+    """Just enough of EmailMonitoringAgent to drive AsyncMonitoringEngine"""
+    
+    def __init__(self, servers, logger):
+        self.logger = logger
+        self.running = True
+        self.sms_sender = NullSMSSender(logger)
+        self.email_monitors = []
+        
+        base_config = Config()
+        base_config.uid_state_file = None
+        base_config.discovery_cache_file = None
+        base_config.dedup_store_file = None
+        base_config.poll_history_file = None
+        for index, server in enumerate(servers):
+            config = copy.copy(base_config)
+            config.mailbox_name = f"location-{index}"
+            config.target_phone_numbers = [f"+1555{index:07d}"]
+            monitor = EmailMonitor(config, logger)
+            monitor.session.connector = server.connect
+            self.email_monitors.append(monitor)
+        
+        self.outbox = SMSOutbox(None, logger)
+        self.sms_dispatcher = SMSDispatchQueue(self.sms_sender, self.outbox, base_config, logger)
+    
+    def record_alerts(self, emails, recipients):
+        keys = []
+        for email_info in emails:
+            message = f"New Bookeo booking: {email_info.get('subject', 'No Subject')}"
+            for recipient in recipients:
+                key = alert_key(email_info, recipient)
+                if self.outbox.add(key, recipient, message, email_info.get('subject')):
+                    keys.append(key)
+        return keys
+
+async def run_engine_cycles(agent, servers):
+    """Two concurrent cycles over every mailbox; returns (cold, warm) seconds"""
+    from async_engine import AsyncMonitoringEngine, AsyncSMSSender
+    
+    engine = AsyncMonitoringEngine(agent)
+    engine.loop = asyncio.get_running_loop()
+    engine.sms = AsyncSMSSender(agent.sms_sender)
+    for mailbox, server in zip(engine.mailboxes, servers):
+        mailbox.session.connector = server.connect_async
+    
+    timings = []
+    for _ in range(2):
+        start = time.perf_counter()
+        await asyncio.gather(*(mailbox.run_monitoring_cycle() for mailbox in engine.mailboxes))
+        await asyncio.gather(*engine.deliveries.values())
+        timings.append(time.perf_counter() - start)
+    
+    for mailbox in engine.mailboxes:
+        await mailbox.session.close()
+    engine.outbox_executor.shutdown()
+    return timings
+
+def bench_multi_mailbox(mailbox_counts=(1, 5, 10, 25), emails_per_mailbox=3, latency=0.02):
+    """Wall time and memory as mailboxes are added to one asyncio agent"""
+    logger = make_logger(logging.ERROR)
+    print(f"\nMulti-mailbox monitoring ({emails_per_mailbox} emails each, {latency * 1000:.0f} ms simulated round trip)")
+    print(
+        f"{'mailboxes':>10} {'cold cycle':>11} {'warm cycle':>11} {'sequential':>11} "
+        f"{'memory':>9} {'per mailbox':>12}"
+    )
+    
+    for count in mailbox_counts:
+        servers = [FakeIMAPServer(latency=latency).start() for _ in range(count)]
+        for server in servers:
+            for index in range(emails_per_mailbox):
+                server.mailbox.add_message(generate_bookeo_message(index))
+        
+        agent = BenchmarkAgent(servers, logger)
+        cold_time, warm_time = asyncio.run(run_engine_cycles(agent, servers))
+        assert agent.outbox.get_stats()['sent'] == count * emails_per_mailbox
+        
+        # Baseline: the threaded agent checks each mailbox in turn
+        agent = BenchmarkAgent(servers, logger)
+        for monitor in agent.email_monitors:
+            monitor.session.acquire()
+        start = time.perf_counter()
+        for monitor in agent.email_monitors:
+            monitor.check_for_bookeo_emails()
+        sequential_time = time.perf_counter() - start
+        for monitor in agent.email_monitors:
+            monitor.disconnect_from_mailbox()
+        
+        # Memory held by the engine, its sessions and parsed emails, on a fresh run
+        agent = BenchmarkAgent(servers, logger)
+        tracemalloc.start()
+        asyncio.run(run_engine_cycles(agent, servers))
+        memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        
+        for server in servers:
+            server.stop()
+        
+        print(
+            f"{count:>10} {cold_time * 1000:>9.1f}ms {warm_time * 1000:>9.1f}ms {sequential_time * 1000:>9.1f}ms "
+            f"{memory / 1024:>7.0f}KB {memory / 1024 / count:>10.1f}KB"
+        )
+
+def bench_dedup_store(entry_counts=(1000, 10000, 50000), lookups=100000):
+    """Dedup store load time, lookup rate and log size with many processed emails"""
+    logger = make_logger()
+    print(f"\nDedup store ({lookups} lookups per size)")
+    print(f"{'entries':>8} {'append':>10} {'reload':>10} {'lookups/s':>12} {'log size':>10}")
+    
+    for count in entry_counts:
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "processed_emails.log")
+            store = DedupStore(path, logger)
+            
+            # One append per cycle of 5 emails, as the monitor does
+            start = time.perf_counter()
+            for first in range(0, count, 5):
+                store.add([f"msgid:<booking-{index}@bookeo.com>" for index in range(first, min(first + 5, count))])
+            append_time = time.perf_counter() - start
+            
+            start = time.perf_counter()
+            store = DedupStore(path, logger)
+            reload_time = time.perf_counter() - start
+            assert len(store.entries) == count
+            
+            keys = [[f"msgid:<booking-{index % (2 * count)}@bookeo.com>"] for index in range(lookups)]
+            start = time.perf_counter()
+            for key in keys:
+                store.contains_any(key)
+            lookup_rate = lookups / (time.perf_counter() - start)
+            
+            print(
+                f"{count:>8} {append_time * 1000:>8.1f}ms {reload_time * 1000:>8.1f}ms "
+                f"{lookup_rate:>12,.0f} {os.path.getsize(path) / 1024:>8.0f}KB"
+            )
+
+def booking_bodies(count):
+    """Text previews of Bookeo-shaped emails, as the monitor hands them to the extractor"""
+    bodies = []
+    for index in range(count):
+        message = email.message_from_bytes(generate_bookeo_message(index))
+        text_part = next(part for part in message.walk() if part.get_content_type() == 'text/plain')
+        body = text_part.get_payload(decode=True).decode('utf-8')
+        if index % 2:
+            body = body.replace('\n', '\r\n')
+        bodies.append(body[:500])
+    return bodies
+
+LEGACY_BOOKING_PATTERNS = [
+    ('date', r'Date:\s*(.+)'),
+    ('time', r'Time:\s*(.+)'),
+    ('game', r'Game:\s*(.+)'),
+    ('participants', r'Participants:\s*(.+)'),
+    ('price', r'Total price:\s*(.+)'),
+    ('customer', r'Customer\s*([^\n]+)'),
+    ('customer_email', r'Email:\s*([^\s\n]+)'),
+    ('customer_phone', r'Phone \(mobile\):\s*(.+)'),
+    ('booking_number', r'Booking number:\s*(.+)'),
+]
+
+def legacy_extract_booking_details(email_body):
+    """The previous extractor: one re.search per field"""
+    details = {}
+    for field, pattern in LEGACY_BOOKING_PATTERNS:
+        match = re.search(pattern, email_body)
+        if match:
+            details[field] = match.group(1).strip()
+    return details
+
+def bench_booking_extractor(corpus_size=1000, rounds=20):
+    """Booking detail extraction rate: nine re.search calls vs the single-pass extractor"""
+    bodies = booking_bodies(corpus_size)
+    for body in bodies:
+        assert legacy_extract_booking_details(body) == booking_extractor.extract(body)
+    
+    print(f"\nBooking detail extraction ({corpus_size} bodies x {rounds} rounds)")
+    print(f"{'extractor':>12} {'emails/s':>12} {'per email':>11}")
+    
+    # Rounds alternate between the extractors so both see the same machine load
+    extractors = {'nine-search': legacy_extract_booking_details, 'single-pass': booking_extractor.extract}
+    best = dict.fromkeys(extractors, float('inf'))
+    for _ in range(rounds):
+        for name, extract in extractors.items():
+            start = time.perf_counter()
+            for body in bodies:
+                extract(body)
+            best[name] = min(best[name], time.perf_counter() - start)
+    
+    rates = {}
+    for name in extractors:
+        rates[name] = corpus_size / best[name]
+        print(f"{name:>12} {rates[name]:>12,.0f} {best[name] / corpus_size * 1e6:>9.1f}us")
+    
+    print(f"{'speedup':>12} {rates['single-pass'] / rates['nine-search']:>11.2f}x")
+
+def run_alert_burst(alert_count, gap, window, max_delay, logger):
+    """Record a burst of alerts for one recipient; returns (SMS sent, max alert latency)"""
+    config = Config()
+    config.sms_workers = 2
+    outbox = SMSOutbox(None, logger, coalesce_window=window, coalesce_max_delay=max_delay)
+    sender = NullSMSSender(logger)
+    dispatcher = SMSDispatchQueue(sender, outbox, config, logger)
+    dispatcher.pump_interval = 0.01
+    dispatcher.start()
+    
+    for index in range(alert_count):
+        key = f"alert-{index}"
+        outbox.add(key, "+15550100", f"New Bookeo booking {index}", key, f"#{3100000 + index} Sat 7:00 PM")
+        dispatcher.submit([key])
+        time.sleep(gap)
+    
+    while outbox.get_stats()['sent'] < alert_count:
+        time.sleep(0.01)
+    dispatcher.stop()
+    
+    latencies = outbox.connection.execute("SELECT MAX(updated_at - created_at) FROM outbox").fetchone()[0]
+    outbox.close()
+    return sender.sent, latencies
+
+def bench_coalescing(bursts=((1, 0), (3, 0.05), (2, 0.3), (10, 0.05), (6, 0.4)), window=0.5, max_delay=1.5):
+    """Twilio API calls and worst-case alert latency for bursts, with and without coalescing"""
+    logger = make_logger(logging.ERROR)
+    print(f"\nAlert coalescing ({window}s window, {max_delay}s max delay, times scaled down from 5s/30s)")
+    print(f"{'alerts':>7} {'gap':>7} {'SMS off':>8} {'SMS on':>7} {'latency off':>12} {'latency on':>11}")
+    
+    for alert_count, gap in bursts:
+        sent_off, latency_off = run_alert_burst(alert_count, gap, 0, 0, logger)
+        sent_on, latency_on = run_alert_burst(alert_count, gap, window, max_delay, logger)
+        assert latency_on <= max_delay + 0.2
+        print(
+            f"{alert_count:>7} {gap * 1000:>5.0f}ms {sent_off:>8} {sent_on:>7} "
+            f"{latency_off * 1000:>10.0f}ms {latency_on * 1000:>9.0f}ms"
+        )
+
+def bench_rate_limiter(backlog=30, twilio_rate=5, limits=((1000, 1000), (5, 5), (4, 2))):
+    """Draining an outage backlog against a rate-limited fake Twilio, with and without client limiting"""
+    logger = make_logger(logging.ERROR)
+    print(f"\nRate limiter ({backlog} queued alerts, fake Twilio accepts {twilio_rate}/s, Retry-After 1s)")
+    print(f"{'client limit':>13} {'drain time':>11} {'API calls':>10} {'429s':>6} {'deferred':>9}")
+    
+    for rate, burst in limits:
+        server = FakeTwilioServer(rate_limit=twilio_rate, retry_after="1").start()
+        sender, config = make_twilio_sender(server, logger, rate, burst)
+        config.sms_workers = 4
+        outbox = SMSOutbox(None, logger)
+        dispatcher = SMSDispatchQueue(sender, outbox, config, logger)
+        dispatcher.pump_interval = 0.02
+        
+        # The backlog is already in the outbox when the agent comes back up
+        for index in range(backlog):
+            outbox.add(f"alert-{index}", f"+1555{index:07d}", f"New Bookeo booking {index}", f"alert {index}")
+        
+        start = time.perf_counter()
+        dispatcher.start()
+        while outbox.get_stats()['sent'] < backlog:
+            time.sleep(0.01)
+        drain_time = time.perf_counter() - start
+        stats = dispatcher.get_stats()
+        dispatcher.stop()
+        server.stop()
+        
+        assert len(server.snapshot()) == backlog and stats['failed'] == 0
+        label = "none" if rate >= 1000 else f"{rate}/s b{burst}"
+        print(
+            f"{label:>13} {drain_time:>10.2f}s {server.requests:>10} {server.rejected:>6} "
+            f"{stats['throttled']:>9}"
+        )
+    
+    clear_twilio_env()
+
+def bench_twilio_transport(sends=10, latency=0.02, connect_latency=0.06, idle_timeout=0.5):
+    """Send latency on cold, warm and idle connections to a fake Twilio that charges for handshakes"""
+    logger = make_logger(logging.ERROR)
+    print(
+        f"\nTwilio transport ({latency * 1000:.0f}ms per request, {connect_latency * 1000:.0f}ms per new "
+        f"connection, server drops connections idle {idle_timeout}s)"
+    )
+    print(f"{'scenario':>24} {'sends':>6} {'median':>9} {'max':>9} {'new conns':>10}")
+    server = FakeTwilioServer(latency=latency, connect_latency=connect_latency, idle_timeout=idle_timeout).start()
+    
+    def measure(label, sender, count, before_each=None):
+        timings = []
+        connections = server.connections
+        for index in range(count):
+            if before_each:
+                before_each(sender)
+            start = time.perf_counter()
+            assert sender.send_message("+15550100", f"Transport {index}")
+            timings.append(time.perf_counter() - start)
+        timings.sort()
+        print(
+            f"{label:>24} {count:>6} {timings[count // 2] * 1000:>7.1f}ms {timings[-1] * 1000:>7.1f}ms "
+            f"{server.connections - connections:>10}"
+        )
+    
+    def idle(sender):
+        time.sleep(idle_timeout * 1.5)
+    
+    def idle_with_pump(sender):
+        # The dispatcher's pump calls keep_warm() about once a second
+        deadline = time.monotonic() + idle_timeout * 1.5
+        while time.monotonic() < deadline:
+            sender.keep_warm()
+            time.sleep(0.05)
+    
+    # A session per request, as with pool_connections=False: every send connects
+    unpooled, _ = make_twilio_sender(server, logger, rate=1000, burst=1000)
+    unpooled.client.http_client.session = None
+    measure("no connection reuse", unpooled, sends)
+    
+    sender, config = make_twilio_sender(server, logger, rate=1000, burst=1000)
+    config.sms_http_keepalive_interval = idle_timeout / 2
+    measure("cold first send", sender, 1)
+    
+    sender, config = make_twilio_sender(server, logger, rate=1000, burst=1000)
+    config.sms_http_keepalive_interval = idle_timeout / 2
+    sender.warm_up()
+    measure("warmed up at start", sender, 1)
+    measure("warm", sender, sends)
+    measure("after idle", sender, 3, idle)
+    measure("after idle, keep-warm", sender, 3, idle_with_pump)
+    
+    server.stop()
+    clear_twilio_env()
+
+def booking_rate_per_hour(moment):
+    """Synthetic Bookeo traffic: busy evenings and weekend days, next to nothing overnight"""
+    if moment.hour < 8:
+        return 0.02
+    if moment.weekday() >= 5:
+        return 2.5 if moment.hour < 22 else 0.2
+    if moment.hour >= 17:
+        return 2.0 if moment.hour < 22 else 0.2
+    return 0.3
+
+def generate_arrivals(start, weeks, seed=17):
+    """Email arrival times; a third of the bookings bring a follow-up email within minutes"""
+    rng = random.Random(seed)
+    arrivals = []
+    for hour in range(weeks * 7 * 24):
+        hour_start = start + hour * 3600
+        rate = booking_rate_per_hour(datetime.fromtimestamp(hour_start))
+        t = hour_start + rng.expovariate(rate) * 3600
+        while t < hour_start + 3600:
+            arrivals.append(t)
+            if rng.random() < 1 / 3:
+                arrivals.append(t + rng.uniform(60, 300))
+            t += rng.expovariate(rate) * 3600
+    return sorted(arrivals)
+
+def simulate_polling(scheduler, arrivals, start, end, measure_from):
+    """Poll on the scheduler's intervals; returns (polls, detection latencies) after measure_from"""
+    polls, latencies = 0, []
+    now, index = start, 0
+    while now < end:
+        found = 0
+        while index < len(arrivals) and arrivals[index] <= now:
+            if now >= measure_from:
+                latencies.append(now - arrivals[index])
+            found += 1
+            index += 1
+        scheduler.record_poll(found, now=now)
+        if now >= measure_from:
+            polls += 1
+        now += scheduler.next_interval(now=now)
+    return polls, latencies
+
+def bench_poll_scheduler(weeks=6, measured_weeks=2, check_interval=120, min_interval=30, max_interval=900):
+    """Polls per day and detection latency for fixed and adaptive intervals over simulated weeks"""
+    logger = make_logger(logging.ERROR)
+    start = datetime(2026, 1, 5).timestamp()  # a Monday, local time
+    end = start + weeks * 7 * 86400
+    measure_from = end - measured_weeks * 7 * 86400
+    arrivals = generate_arrivals(start, weeks)
+    
+    print(
+        f"\nPoll scheduling ({weeks} simulated weeks, {len(arrivals)} emails, "
+        f"last {measured_weeks} measured; adaptive bounds {min_interval}-{max_interval}s)"
+    )
+    print(f"{'schedule':>22} {'polls/day':>10} {'mean latency':>13} {'p95 latency':>12} {'max latency':>12}")
+    
+    schedules = [(f"fixed {interval}s", False, interval, 1.0) for interval in (60, check_interval, 300)]
+    schedules += [(f"adaptive cost {cost:g}", True, check_interval, cost) for cost in (1, 3, 6)]
+    for label, adaptive, interval, cost in schedules:
+        scheduler = PollScheduler(None, logger, interval, min_interval, max_interval, cost, adaptive)
+        polls, latencies = simulate_polling(scheduler, arrivals, start, end, measure_from)
+        latencies.sort()
+        print(
+            f"{label:>22} {polls / (measured_weeks * 7):>10.0f} {sum(latencies) / len(latencies):>12.0f}s "
+            f"{latencies[int(len(latencies) * 0.95)]:>11.0f}s {latencies[-1]:>11.0f}s"
+        )
+
+def make_alert_handler(outbox, dispatcher, recipient="+15550100"):
+    """What the agents' record_alerts do, minus message formatting"""
+    def handle_new_emails(email_monitor, emails):
+        keys = []
+        for email_info in emails:
+            with pipeline_latency.timer('extract'):
+                details = booking_extractor.extract(email_info['body'])
+            key = alert_key(email_info, recipient)
+            if outbox.add(
+                key, recipient, f"New booking {details.get('booking_number')}", email_info['subject'],
+                email_info['subject'], email_info['sent_at'], email_info['arrived_at']
+            ):
+                keys.append(key)
+        dispatcher.submit(keys)
+    return handle_new_emails
+
+def wait_for_sent(outbox, count, timeout=30):
+    """Wait until count alerts in the outbox have been accepted by Twilio"""
+    deadline = time.monotonic() + timeout
+    while outbox.get_stats()['sent'] < count:
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"only {outbox.get_stats()['sent']} of {count} alerts sent")
+        time.sleep(0.002)
+
+def bench_alert_latency(rounds=15, imap_latency=0.02, twilio_latency=0.05, seed=19):
+    """Per-stage latency percentiles for emails flowing from a fake IMAP server to a fake Twilio"""
+    logger = make_logger(logging.ERROR)
+    rng = random.Random(seed)
+    imap_server = FakeIMAPServer(latency=imap_latency).start()
+    twilio_server = FakeTwilioServer(latency=twilio_latency).start()
+    sender, config = make_twilio_sender(twilio_server, logger, rate=1000, burst=1000)
+    config.sms_workers = 2
+    outbox = SMSOutbox(None, logger)
+    dispatcher = SMSDispatchQueue(sender, outbox, config, logger)
+    monitor = make_monitor(imap_server, logger)
+    monitor.alert_handler = make_alert_handler(outbox, dispatcher)
+    dispatcher.start()
+    
+    # A first email sets the UID checkpoint and opens the connections
+    imap_server.mailbox.add_message(generate_bookeo_message(0))
+    monitor.check_for_bookeo_emails()
+    while outbox.get_stats()['sent'] < 1:
+        time.sleep(0.01)
+    pipeline_latency.reset()
+    
+    # Bookeo sends a few seconds before the server has the email; the check
+    # follows within a (scaled-down) polling interval
+    index = 1
+    for _ in range(rounds):
+        now = datetime.now(timezone.utc)
+        for _ in range(rng.randint(1, 3)):
+            sent_at = now - timedelta(seconds=rng.uniform(2, 20))
+            imap_server.mailbox.add_message(generate_bookeo_message(index, sent_at=sent_at), now)
+            index += 1
+        time.sleep(rng.uniform(0.1, 1.0))
+        monitor.check_for_bookeo_emails()
+    
+    while outbox.get_stats()['sent'] < index:
+        time.sleep(0.01)
+    dispatcher.stop()
+    monitor.disconnect_from_mailbox()
+    imap_server.stop()
+    twilio_server.stop()
+    clear_twilio_env()
+    
+    print(
+        f"\nAlert latency by stage ({index - 1} emails, {imap_latency * 1000:.0f}ms IMAP and "
+        f"{twilio_latency * 1000:.0f}ms Twilio round trips; Date and INTERNALDATE have 1s resolution)"
+    )
+    print(pipeline_latency.format_table())
+
+def bench_metrics_scrape(mailbox_counts=(1, 10, 50), scrapes=200, observations=200000):
+    """Cost of rendering /metrics, and of recording a check while something scrapes continuously"""
+    logger = make_logger()
+    outbox = SMSOutbox(None, logger)
+    config = Config()
+    dispatcher = SMSDispatchQueue(NullSMSSender(logger), outbox, config, logger)
+    rng = random.Random(20)
+    
+    print("\n/metrics rendering")
+    for mailbox_count in mailbox_counts:
+        monitors = []
+        for index in range(mailbox_count):
+            monitor_config = copy.copy(config)
+            monitor_config.mailbox_name = f"location-{index}"
+            # Only the statistics attributes are read at scrape time
+            monitors.append(SimpleNamespace(
+                config=monitor_config, messages_fetched=rng.randint(0, 1000),
+                bytes_downloaded=rng.randint(0, 10 ** 7)
+            ))
+            for _ in range(50):
+                CYCLES.inc(mailbox=monitor_config.mailbox_name, result='ok')
+                CYCLE_DURATION.observe(rng.uniform(0.05, 2.0), mailbox=monitor_config.mailbox_name)
+        register_agent_metrics(monitors, dispatcher)
+        
+        start = time.perf_counter()
+        for _ in range(scrapes):
+            body = registry.render()
+        elapsed = time.perf_counter() - start
+        print(
+            f"  {mailbox_count:>3} mailbox(es): {elapsed / scrapes * 1000:6.2f} ms per scrape, "
+            f"{len(body) / 1024:6.1f} KiB"
+        )
+    
+    def observe_rate():
+        start = time.perf_counter()
+        for _ in range(observations):
+            CYCLE_DURATION.observe(0.2, mailbox="location-0")
+        return observations / (time.perf_counter() - start)
+    
+    quiet = observe_rate()
+    stop = threading.Event()
+    scraped = [0]
+    
+    def scrape():
+        while not stop.is_set():
+            registry.render()
+            scraped[0] += 1
+    
+    scraper = threading.Thread(target=scrape)
+    scraper.start()
+    busy = observe_rate()
+    stop.set()
+    scraper.join()
+    
+    print(
+        f"  check durations recorded: {quiet / 1000:.0f}k/s idle, {busy / 1000:.0f}k/s during "
+        f"{scraped[0]} back-to-back scrapes (one check records one)"
+    )
+
+async def probe_health(port, method, timeout):
+    """Seconds for one request on a fresh connection, or None if it failed or timed out"""
+    async def request():
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        try:
+            writer.write(f"{method} /health HTTP/1.0\r\nHost: localhost\r\n\r\n".encode())
+            await writer.drain()
+            response = await reader.read()
+        finally:
+            writer.close()
+        return response.startswith(b"HTTP/1.0 200")
+    
+    start = time.perf_counter()
+    try:
+        if await asyncio.wait_for(request(), timeout):
+            return time.perf_counter() - start
+    except (asyncio.TimeoutError, OSError):
+        pass
+    return None
+
+async def load_health_server(port, probes, stalled_clients, timeout):
+    """Hold stalled_clients connections open without sending anything, then fire probes at once"""
+    stalled = [await asyncio.open_connection('127.0.0.1', port) for _ in range(stalled_clients)]
+    await asyncio.sleep(0.05)
+    results = await asyncio.gather(*(
+        probe_health(port, 'HEAD' if index % 4 == 0 else 'GET', timeout) for index in range(probes)
+    ))
+    for _, writer in stalled:
+        writer.close()
+    return [result for result in results if result is not None]
+
+def bench_health_server(probes=(50, 300), stalled_clients=3, timeout=3.0):
+    """Probe latency under concurrent load, with a few half-open clients holding connections"""
+    from async_engine import AsyncHealthServer
+    from render_main import HealthCheckHandler, PooledHTTPServer
+    from http.server import HTTPServer
+    
+    logger = make_logger()
+    body = b'{"status": "ok", "live": true, "ready": true}' * 8
+    HealthCheckHandler.routes = {'/health': lambda: (200, 'application/json', body)}
+    
+    def threaded(server):
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server.server_address[1], server.shutdown
+    
+    class SingleThreadedHTTPServer(HTTPServer):
+        """What start_http_server used before: one request at a time, no timeouts"""
+        
+        def handle_error(self, request, client_address):
+            pass
+    
+    def single_threaded():
+        return threaded(SingleThreadedHTTPServer(('127.0.0.1', 0), HealthCheckHandler))
+    
+    def pooled():
+        return threaded(PooledHTTPServer(('127.0.0.1', 0), HealthCheckHandler))
+    
+    def event_loop():
+        loop = asyncio.new_event_loop()
+        threading.Thread(target=loop.run_forever, daemon=True).start()
+        server = AsyncHealthServer(HealthCheckHandler.routes, logger, 0)
+        asyncio.run_coroutine_threadsafe(server.start(), loop).result()
+        
+        def stop():
+            asyncio.run_coroutine_threadsafe(server.close(), loop).result()
+            loop.call_soon_threadsafe(loop.stop)
+        return server.server.sockets[0].getsockname()[1], stop
+    
+    print(
+        f"\nHealth server under load (concurrent probes, a quarter HEAD; {stalled_clients} half-open "
+        f"clients connected first; probes give up after {timeout:.0f}s)"
+    )
+    print(f"{'server':>16} {'probes':>7} {'ok':>5} {'p50':>9} {'p99':>9} {'max':>9}")
+    for name, start_server in (
+        ('single-threaded', single_threaded), ('thread pool', pooled), ('event loop', event_loop)
+    ):
+        for count in probes:
+            port, stop = start_server()
+            latencies = sorted(asyncio.run(load_health_server(port, count, stalled_clients, timeout)))
+            stop()
+            
+            if latencies:
+                p50 = format_seconds(latencies[len(latencies) // 2])
+                p99 = format_seconds(latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))])
+                maximum = format_seconds(latencies[-1])
+            else:
+                p50 = p99 = maximum = '-'
+            print(f"{name:>16} {count:>7} {len(latencies):>5} {p50:>9} {p99:>9} {maximum:>9}")
+
+class SlowStream:
+    """Console stream that takes delay seconds per write, like a backed-up log pipe"""
+    
+    def __init__(self, delay):
+        self.delay = delay
+    
+    def write(self, text):
+        time.sleep(self.delay)
+    
+    def flush(self):
+        pass
+
+def bench_logging(records=2000, slow_write=0.0002):
+    """Time the monitor thread spends per log call, with handlers attached directly or behind the queue"""
+    from contextlib import redirect_stderr
+    from logger_config import BoundedQueueHandler, LazyValue, setup_logger
+    
+    print(f"\nLogging cost on the calling thread ({records} INFO records to console and a rotating file)")
+    print(f"{'console':>8} {'handlers':>22} {'per call':>9} {'until written':>14} {'dropped':>8}")
+    with tempfile.TemporaryDirectory() as directory, open(os.devnull, 'w') as devnull:
+        for console, stream in (('fast', devnull), ('slow', SlowStream(slow_write))):
+            for label, queue_size, overflow in (
+                ('direct', 0, 'drop'), ('queue 10000, drop', 10000, 'drop'),
+                ('queue 500, drop', 500, 'drop'), ('queue 500, block', 500, 'block'),
+            ):
+                with redirect_stderr(stream):
+                    logger = setup_logger(
+                        f"BenchmarkLogging.{console}.{queue_size}.{overflow}", "INFO",
+                        os.path.join(directory, "benchmark.log"), queue_size, overflow
+                    )
+                queue_handler = next((h for h in logger.handlers if isinstance(h, BoundedQueueHandler)), None)
+                
+                start = time.perf_counter()
+                for index in range(records):
+                    logger.info(f"Found new Bookeo email: New booking #{index:06d} - Escape Room, 4 players")
+                caller_time = time.perf_counter() - start
+                
+                if queue_handler:
+                    queue_handler.listener.stop()
+                written_time = time.perf_counter() - start
+                dropped = queue_handler.dropped if queue_handler else 0
+                for handler in logger.handlers + (list(queue_handler.listener.handlers) if queue_handler else []):
+                    handler.close()
+                logger.handlers.clear()
+                
+                print(
+                    f"{console:>8} {label:>22} {caller_time / records * 1e6:>7.1f}us "
+                    f"{written_time * 1000:>12.0f}ms {dropped:>8}"
+                )
+    
+    # DEBUG is off in production: eager f-strings still build their message
+    logger = make_logger(logging.INFO)
+    stats = SimpleNamespace(get_stats=lambda: {'sent': 12, 'failed': 0, 'queue': 3, 'in_flight': 1})
+    criteria = 'UID 1200:* FROM "noreply@bookeo.com"'
+    calls = 100000
+    for label, log in (
+        ('f-string', lambda: logger.debug(f"Searching with criteria: {criteria} ({stats.get_stats()})")),
+        ('lazy', lambda: logger.debug("Searching with criteria: %s (%s)", criteria, LazyValue(stats.get_stats))),
+    ):
+        start = time.perf_counter()
+        for _ in range(calls):
+            log()
+        print(f"  disabled DEBUG call, {label}: {(time.perf_counter() - start) / calls * 1e9:.0f}ns")
+
+def bench_end_to_end(batch_sizes=(1, 10, 50), cycles=3, idle_trials=5, imap_latency=0.01, twilio_latency=0.03):
+    """EmailMonitor and SMSSender end to end against the fake IMAP and Twilio servers"""
+    logger = make_logger(logging.ERROR)
+    print(
+        f"\nEnd to end: EmailMonitor -> outbox -> SMSSender ({imap_latency * 1000:.0f}ms IMAP and "
+        f"{twilio_latency * 1000:.0f}ms Twilio round trips, {cycles} cycles per batch size; "
+        f"alerts found together go to one recipient as a digest)"
+    )
+    print(
+        f"{'emails/cycle':>13} {'cycle':>9} {'to last SMS':>12} {'emails/s':>9} "
+        f"{'IMAP bytes/msg':>15} {'IMAP cmds/cycle':>16} {'API calls/msg':>14}"
+    )
+    
+    def start_pipeline():
+        imap_server = FakeIMAPServer(latency=imap_latency, capabilities=("IMAP4rev1", "IDLE")).start()
+        twilio_server = FakeTwilioServer(latency=twilio_latency).start()
+        sender, config = make_twilio_sender(twilio_server, logger, rate=1000, burst=1000)
+        config.sms_workers = 4
+        outbox = SMSOutbox(None, logger)
+        dispatcher = SMSDispatchQueue(sender, outbox, config, logger)
+        monitor = make_monitor(imap_server, logger)
+        monitor.alert_handler = make_alert_handler(outbox, dispatcher)
+        dispatcher.start()
+        
+        # A first email sets the UID checkpoint and opens the IMAP and Twilio connections
+        imap_server.mailbox.add_message(generate_bookeo_message(0))
+        monitor.check_for_bookeo_emails()
+        wait_for_sent(outbox, 1)
+        imap_server.reset_counters()
+        twilio_server.reset_counters()
+        return imap_server, twilio_server, outbox, dispatcher, monitor
+    
+    def stop_pipeline(imap_server, twilio_server, outbox, dispatcher, monitor):
+        dispatcher.stop()
+        monitor.disconnect_from_mailbox()
+        outbox.close()
+        imap_server.stop()
+        twilio_server.stop()
+    
+    for batch in batch_sizes:
+        pipeline = start_pipeline()
+        imap_server, twilio_server, outbox, dispatcher, monitor = pipeline
+        
+        index = 1
+        cycle_time = total_time = 0.0
+        for _ in range(cycles):
+            for _ in range(batch):
+                imap_server.mailbox.add_message(generate_bookeo_message(index))
+                index += 1
+            
+            start = time.perf_counter()
+            found = monitor.check_for_bookeo_emails()
+            cycle_time += time.perf_counter() - start
+            assert len(found) == batch
+            wait_for_sent(outbox, index)
+            total_time += time.perf_counter() - start
+        
+        emails = batch * cycles
+        print(
+            f"{batch:>13} {cycle_time / cycles * 1000:>7.1f}ms {total_time / cycles * 1000:>10.1f}ms "
+            f"{emails / total_time:>9.1f} {imap_server.bytes_sent / emails:>15.0f} "
+            f"{len(imap_server.commands) / cycles:>16.1f} {twilio_server.requests / emails:>14.2f}"
+        )
+        stop_pipeline(*pipeline)
+    
+    # Push mode: the monitor waits in IDLE and checks as soon as the server announces mail
+    pipeline = start_pipeline()
+    imap_server, twilio_server, outbox, dispatcher, monitor = pipeline
+    stop = threading.Event()
+    
+    def idle_loop():
+        while not stop.is_set():
+            if monitor.wait_for_new_mail(1, stop.is_set):
+                monitor.check_for_bookeo_emails()
+    
+    watcher = threading.Thread(target=idle_loop)
+    watcher.start()
+    latencies = []
+    for trial in range(1, idle_trials + 1):
+        time.sleep(0.2)
+        start = time.perf_counter()
+        imap_server.mailbox.add_message(generate_bookeo_message(trial))
+        wait_for_sent(outbox, trial + 1)
+        latencies.append(time.perf_counter() - start)
+    stop.set()
+    watcher.join()
+    stop_pipeline(*pipeline)
+    clear_twilio_env()
+    
+    print(
+        f"  IDLE push, new email to SMS accepted: mean {format_seconds(sum(latencies) / len(latencies))}, "
+        f"max {format_seconds(max(latencies))} over {idle_trials} emails"
+    )
+
+BENCHMARKS = {
+    'batched_fetch': bench_batched_fetch,
+    'fetch_bytes': bench_fetch_bytes,
+    'multi_mailbox': bench_multi_mailbox,
+    'dedup_store': bench_dedup_store,
+    'booking_extractor': bench_booking_extractor,
+    'coalescing': bench_coalescing,
+    'rate_limiter': bench_rate_limiter,
+    'twilio_transport': bench_twilio_transport,
+    'poll_scheduler': bench_poll_scheduler,
+    'alert_latency': bench_alert_latency,
+    'metrics_scrape': bench_metrics_scrape,
+    'health_server': bench_health_server,
+    'logging': bench_logging,
+    'end_to_end': bench_end_to_end,
+}
+
+def main():
+    """Run the benchmarks named on the command line, or all of them"""
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            print(f"Unknown benchmark '{name}'. Available: {', '.join(BENCHMARKS)}")
+            sys.exit(1)
+        BENCHMARKS[name]()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+"""
+Single-pass extraction of the labelled booking details in Bookeo emails
+"""
+
+import re
+
+# (field, label pattern, value pattern). Patterns must not contain capturing
+# groups; the first occurrence of each label in the body wins.
+BOOKING_FIELDS = [
+    ('date', r'Date:\s*', r'.+'),
+    ('time', r'Time:\s*', r'.+'),
+    ('game', r'Game:\s*', r'.+'),
+    ('participants', r'Participants:\s*', r'.+'),
+    ('price', r'Total price:\s*', r'.+'),
+    ('customer', r'Customer\s*', r'[^\n]+'),
+    ('customer_email', r'Email:\s*', r'[^\s\n]+'),
+    ('customer_phone', r'Phone \(mobile\):\s*', r'.+'),
+    ('booking_number', r'Booking number:\s*', r'.+'),
+]
+
+class BookingDetailsExtractor:
+    """Reads every registered field with one precompiled regex and one scan of the body"""
+    
+    def __init__(self, fields=BOOKING_FIELDS):
+        self.fields = {}
+        for field, label, value in fields:
+            self.fields[field] = (label, value)
+        self.compile()
+    
+    def register(self, field, label, value=r'.+'):
+        """Add (or replace) a labelled field, e.g. register('room', r'Room:\\s*')"""
+        if not field.isidentifier():
+            raise ValueError(f"Field name must be a valid identifier: {field!r}")
+        self.fields[field] = (label, value)
+        self.compile()
+    
+    def compile(self):
+        # Values are captured inside a lookahead so only the label is consumed;
+        # a label that appears within another field's value is still found,
+        # exactly as with one search per field
+        self.pattern = re.compile('|'.join(
+            f'(?:{label})(?=(?P<{field}>{value}))' for field, (label, value) in self.fields.items()
+        ))
+    
+    def extract(self, text):
+        """Return {field: value} for every label found in text"""
+        details = {}
+        for match in self.pattern.finditer(text):
+            field = match.lastgroup
+            if field not in details:
+                details[field] = match.group(field).strip()
+        return details
+
+booking_extractor = BookingDetailsExtractor()
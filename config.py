@@ -7,31 +7,131 @@ from datetime import datetime
 
 class Config:
     def __init__(self):
+        # Settings that could not be parsed; reported by validate()
+        self.parse_errors = []
+        
         # Email configuration
         self.email_address = os.getenv("EMAIL_ADDRESS", "robot@quantumescapesdanville.com")
         self.email_password = os.getenv("EMAIL_PASSWORD", "Agentlogin1234!")
         
-        # Bookeo sender configuration
-        self.bookeo_sender = os.getenv("BOOKEO_SENDER", "noreply@bookeo.com")
+        # Bookeo sender configuration (comma-separated for several senders)
+        self.bookeo_senders = self._split_list(os.getenv("BOOKEO_SENDER", "noreply@bookeo.com"))
+        self.bookeo_sender = self.bookeo_senders[0] if self.bookeo_senders else ""
         
         # SMS configuration
-        self.target_phone_number = os.getenv("TARGET_PHONE_NUMBER", "619-917-2605")
+        self.target_phone_numbers = self._split_list(os.getenv("TARGET_PHONE_NUMBER", "619-917-2605"))
+        self.target_phone_number = self.target_phone_numbers[0] if self.target_phone_numbers else ""
+        
+        # Optional JSON file listing several mailboxes to monitor in one process
+        self.mailbox_profiles_file = os.getenv("MAILBOX_PROFILES_FILE")
+        self.mailbox_name = "default"
         
         # Monitoring configuration
-        self.check_interval = int(os.getenv("CHECK_INTERVAL", "120"))  # 2 minutes default
+        self.check_interval = self._number("CHECK_INTERVAL", "120", int)  # 2 minutes default
+        
+        # Adaptive polling: short intervals when bookings are likely, long ones overnight
+        self.adaptive_polling = os.getenv("ADAPTIVE_POLLING", "true").lower() == "true"
+        self.poll_min_interval = self._number("POLL_MIN_INTERVAL", "30", int)
+        self.poll_max_interval = self._number("POLL_MAX_INTERVAL", "900", int)
+        self.poll_cost = self._number("POLL_COST", "3", float)  # seconds of alert delay one poll is worth
+        self.poll_history_file = os.getenv("POLL_HISTORY_FILE", "poll_history.json")
+        
+        # IMAP IDLE push configuration (falls back to polling if unsupported)
+        self.use_idle = os.getenv("USE_IDLE", "true").lower() == "true"
+        self.idle_timeout = self._number("IDLE_TIMEOUT", "1500", int)  # 25 minutes default
+        
+        # Run IMAP, SMS and HTTP on one asyncio event loop instead of threads: true, false,
+        # or auto to use it whenever more than one mailbox profile is monitored
+        self.async_engine = os.getenv("ASYNC_ENGINE", "auto").lower()
+        self.use_async_engine = self.async_engine == "true"
+        
+        # Per-connection IMAP deadlines in seconds (never applied process-wide)
+        self.imap_connect_timeout = self._number("IMAP_CONNECT_TIMEOUT", "10", float)
+        self.imap_login_timeout = self._number("IMAP_LOGIN_TIMEOUT", "15", float)
+        self.imap_command_timeout = self._number("IMAP_COMMAND_TIMEOUT", "60", float)
+        
+        # Cache of the IMAP server that last worked for the account
+        self.discovery_cache_file = os.getenv("IMAP_DISCOVERY_CACHE", "imap_server_cache.json")
+        
+        # Durable UID high-water mark for incremental fetching
+        self.uid_state_file = os.getenv("UID_STATE_FILE", "uid_checkpoint.json")
+        
+        # Processed Message-IDs and booking numbers, so restarts never re-alert
+        self.dedup_store_file = os.getenv("DEDUP_STORE_FILE", "processed_emails.log")
+        self.dedup_retention_days = self._number("DEDUP_RETENTION_DAYS", "30", int)
+        
+        # SMS dispatch queue: alerts are sent by worker threads, off the monitoring loop
+        self.sms_workers = self._number("SMS_WORKERS", "2", int)
+        self.sms_queue_size = self._number("SMS_QUEUE_SIZE", "100", int)
+        self.sms_max_attempts = self._number("SMS_MAX_ATTEMPTS", "6", int)
+        self.sms_retry_delay = self._number("SMS_RETRY_DELAY", "5", float)  # seconds, doubles per attempt
+        self.sms_outbox_file = os.getenv("SMS_OUTBOX_FILE", "sms_outbox.db")
+        
+        # Alerts for one recipient arriving within the window go out as one digest SMS
+        self.sms_coalesce_window = self._number("SMS_COALESCE_WINDOW", "5", float)  # seconds, 0 disables
+        self.sms_coalesce_max_delay = self._number("SMS_COALESCE_MAX_DELAY", "30", float)  # seconds
+        self.sms_max_segments = self._number("SMS_MAX_SEGMENTS", "1", int)
+        
+        # Client-side throughput limit per Twilio sender number (long codes take about 1/s)
+        self.sms_rate_limit = self._number("SMS_RATE_LIMIT", "1", float)  # messages per second
+        self.sms_rate_burst = self._number("SMS_RATE_BURST", "3", int)
+        
+        # Keep-alive connection pool to api.twilio.com, shared by every sender
+        self.sms_http_pool_size = self._number("SMS_HTTP_POOL_SIZE", "4", int)
+        self.sms_http_timeout = self._number("SMS_HTTP_TIMEOUT", "15", float)  # seconds per request
+        # Opt-in: refresh idle connections every this many seconds, one Account fetch each; 0 warms up only at startup
+        self.sms_http_keepalive_interval = self._number("SMS_HTTP_KEEPALIVE_INTERVAL", "0", float)
+        
+        # Health and metrics HTTP endpoint
+        self.http_workers = self._number("HTTP_WORKERS", "8", int)
+        self.http_request_timeout = self._number("HTTP_REQUEST_TIMEOUT", "10", float)  # seconds per request
+        
+        # Health watchdog: a mailbox whose check is this long past due marks the agent
+        # not live; a larger or older SMS backlog marks it not ready
+        self.health_stall_timeout = self._number("HEALTH_STALL_TIMEOUT", "300", float)  # seconds
+        self.health_max_sms_backlog = self._number("HEALTH_MAX_SMS_BACKLOG", "50", int)  # alerts
+        self.health_max_sms_age = self._number("HEALTH_MAX_SMS_AGE", "1800", float)  # seconds
         
         # Logging configuration
         self.log_level = os.getenv("LOG_LEVEL", "INFO").upper()
         self.log_file = os.getenv("LOG_FILE", "email_monitor.log")
+        self.log_format = os.getenv("LOG_FORMAT", "text").lower()  # text or json lines
+        
+        # Log records reach the console and file through a queue drained by a background thread
+        self.log_queue_size = self._number("LOG_QUEUE_SIZE", "10000", int)  # records, 0 writes synchronously
+        self.log_queue_overflow = os.getenv("LOG_QUEUE_OVERFLOW", "drop").lower()
         
         # Twilio configuration (required environment variables)
         self.twilio_account_sid = os.getenv("TWILIO_ACCOUNT_SID")
         self.twilio_auth_token = os.getenv("TWILIO_AUTH_TOKEN")
         self.twilio_phone_number = os.getenv("TWILIO_PHONE_NUMBER")
     
+    def _number(self, name, default, kind):
+        """Read a numeric setting, keeping the default (and an error for validate()) if it is malformed"""
+        value = os.getenv(name, default)
+        try:
+            return kind(value)
+        except ValueError:
+            self.parse_errors.append(f"{name} must be a number, got '{value}'")
+            return kind(default)
+    
+    def resolve_async_engine(self, mailbox_count):
+        """Settle ASYNC_ENGINE=auto once the profiles are loaded
+        
+        The threaded loop checks mailboxes one after another and can only
+        IDLE on a single one, so several mailboxes get the asyncio engine.
+        """
+        if self.async_engine == "auto":
+            self.use_async_engine = mailbox_count > 1
+        return self.use_async_engine
+    
+    @staticmethod
+    def _split_list(value):
+        return [item.strip() for item in value.split(",") if item.strip()]
+    
     def validate(self):
         """Validate configuration settings"""
-        errors = []
+        errors = list(self.parse_errors)
         
         # Check required email settings
         if not self.email_address:
@@ -58,6 +158,66 @@ class Config:
         if self.check_interval < 30:
             errors.append("CHECK_INTERVAL must be at least 30 seconds")
         
+        # Validate adaptive polling bounds
+        if self.poll_min_interval < 30:
+            errors.append("POLL_MIN_INTERVAL must be at least 30 seconds")
+        if self.poll_max_interval < self.poll_min_interval:
+            errors.append("POLL_MAX_INTERVAL must be at least POLL_MIN_INTERVAL")
+        if self.poll_cost <= 0:
+            errors.append("POLL_COST must be greater than 0")
+        
+        # Validate IMAP timeouts
+        for name in ("imap_connect_timeout", "imap_login_timeout", "imap_command_timeout"):
+            if getattr(self, name) <= 0:
+                errors.append(f"{name.upper()} must be greater than 0")
+        
+        # Validate SMS dispatch settings
+        for name in ("sms_workers", "sms_queue_size", "sms_max_attempts", "sms_max_segments", "sms_rate_burst",
+                     "sms_http_pool_size"):
+            if getattr(self, name) < 1:
+                errors.append(f"{name.upper()} must be at least 1")
+        
+        if self.sms_rate_limit <= 0:
+            errors.append("SMS_RATE_LIMIT must be greater than 0")
+        if self.sms_http_timeout <= 0:
+            errors.append("SMS_HTTP_TIMEOUT must be greater than 0")
+        if self.sms_http_keepalive_interval < 0:
+            errors.append("SMS_HTTP_KEEPALIVE_INTERVAL must not be negative")
+        
+        if self.http_workers < 1:
+            errors.append("HTTP_WORKERS must be at least 1")
+        if self.http_request_timeout <= 0:
+            errors.append("HTTP_REQUEST_TIMEOUT must be greater than 0")
+        
+        if self.log_format not in ("text", "json"):
+            errors.append("LOG_FORMAT must be 'text' or 'json'")
+        if self.log_queue_size < 0:
+            errors.append("LOG_QUEUE_SIZE must not be negative")
+        if self.log_queue_overflow not in ("drop", "block"):
+            errors.append("LOG_QUEUE_OVERFLOW must be 'drop' or 'block'")
+        
+        if self.health_stall_timeout <= 0:
+            errors.append("HEALTH_STALL_TIMEOUT must be greater than 0")
+        if self.health_max_sms_backlog < 1:
+            errors.append("HEALTH_MAX_SMS_BACKLOG must be at least 1")
+        if self.health_max_sms_age <= 0:
+            errors.append("HEALTH_MAX_SMS_AGE must be greater than 0")
+        
+        if self.sms_coalesce_window < 0:
+            errors.append("SMS_COALESCE_WINDOW must not be negative")
+        if self.sms_coalesce_max_delay < self.sms_coalesce_window:
+            errors.append("SMS_COALESCE_MAX_DELAY must be at least SMS_COALESCE_WINDOW")
+        
+        if self.dedup_retention_days < 1:
+            errors.append("DEDUP_RETENTION_DAYS must be at least 1")
+        
+        if self.async_engine not in ("true", "false", "auto"):
+            errors.append("ASYNC_ENGINE must be 'true', 'false' or 'auto'")
+        
+        # Validate IDLE timeout (RFC 2177 servers may drop IDLE after 30 minutes)
+        if self.idle_timeout < 60 or self.idle_timeout > 29 * 60:
+            errors.append("IDLE_TIMEOUT must be between 60 and 1740 seconds")
+        
         if errors:
             print("Configuration validation errors:")
             for error in errors:
@@ -71,11 +231,29 @@ class Config:
         print("Current Configuration:")
         print(f"  Email Address: {self.email_address}")
         print(f"  Email Password: {'*' * len(self.email_password) if self.email_password else 'Not Set'}")
-        print(f"  Bookeo Sender: {self.bookeo_sender}")
-        print(f"  Target Phone: {self.target_phone_number}")
+        print(f"  Bookeo Sender: {', '.join(self.bookeo_senders)}")
+        print(f"  Target Phone: {', '.join(self.target_phone_numbers)}")
+        print(f"  Mailbox Profiles File: {self.mailbox_profiles_file or 'Not Set (single mailbox)'}")
         print(f"  Check Interval: {self.check_interval} seconds")
+        print(f"  Adaptive Polling: {self.adaptive_polling} ({self.poll_min_interval}-{self.poll_max_interval}s, cost {self.poll_cost}, history {self.poll_history_file})")
+        print(f"  Use IDLE: {self.use_idle}")
+        print(f"  IDLE Timeout: {self.idle_timeout} seconds")
+        print(f"  Async Engine: {self.async_engine}")
+        print(f"  IMAP Timeouts: connect {self.imap_connect_timeout}s, login {self.imap_login_timeout}s, command {self.imap_command_timeout}s")
+        print(f"  IMAP Discovery Cache: {self.discovery_cache_file}")
+        print(f"  UID State File: {self.uid_state_file}")
+        print(f"  Dedup Store: {self.dedup_store_file} ({self.dedup_retention_days} days)")
+        print(f"  SMS Dispatch: {self.sms_workers} worker(s), queue {self.sms_queue_size}, {self.sms_max_attempts} attempt(s), retry delay {self.sms_retry_delay}s")
+        print(f"  SMS Outbox: {self.sms_outbox_file}")
+        print(f"  SMS Coalescing: {self.sms_coalesce_window}s window, {self.sms_coalesce_max_delay}s max delay, {self.sms_max_segments} segment(s)")
+        print(f"  SMS Rate Limit: {self.sms_rate_limit}/s per sender number, burst {self.sms_rate_burst}")
+        print(f"  SMS HTTP Pool: {self.sms_http_pool_size} connection(s), timeout {self.sms_http_timeout}s, keep-alive {f'every {self.sms_http_keepalive_interval}s when idle' if self.sms_http_keepalive_interval else 'off'}")
+        print(f"  HTTP Server: {self.http_workers} worker(s), {self.http_request_timeout}s request timeout")
+        print(f"  Health: stalled {self.health_stall_timeout}s past a due check, not ready above {self.health_max_sms_backlog} unsent SMS or {self.health_max_sms_age}s old")
         print(f"  Log Level: {self.log_level}")
         print(f"  Log File: {self.log_file}")
+        print(f"  Log Format: {self.log_format}")
+        print(f"  Log Queue: {self.log_queue_size} records, {self.log_queue_overflow} when full")
         print(f"  Twilio SID: {'*' * len(self.twilio_account_sid) if self.twilio_account_sid else 'Not Set'}")
         print(f"  Twilio Token: {'*' * len(self.twilio_auth_token) if self.twilio_auth_token else 'Not Set'}")
         print(f"  Twilio Phone: {self.twilio_phone_number if self.twilio_phone_number else 'Not Set'}")
@@ -0,0 +1,163 @@
+"""
+Durable record of processed emails so a booking is never texted twice
+"""
+
+import hashlib
+import os
+import re
+import time
+
+BOOKING_NUMBER_RE = re.compile(r'Booking number:\s*(\S+)')
+
+# Rewrite the log once it holds this many lines beyond the live entries
+COMPACT_SLACK_LINES = 1000
+
+def dedup_keys(email_info):
+    """Keys identifying an email
+    
+    The Message-ID, or without one a hash of the sender, subject and date.
+    Once the body is known, the booking number is added together with the
+    subject, so a resent notification is caught while a change or
+    cancellation of the same booking is still alerted on.
+    """
+    keys = []
+    message_id = (email_info.get('message_id') or '').strip()
+    if message_id:
+        keys.append(f"msgid:{message_id}")
+    else:
+        fingerprint = '\n'.join(email_info.get(field) or '' for field in ('from', 'subject', 'date'))
+        keys.append(f"hash:{hashlib.sha1(fingerprint.encode('utf-8')).hexdigest()}")
+    
+    booking_match = BOOKING_NUMBER_RE.search(email_info.get('body') or '')
+    if booking_match:
+        subject = ' '.join((email_info.get('subject') or '').lower().split())
+        keys.append(f"booking:{booking_match.group(1)}:{subject}")
+    return keys
+
+class DedupStore:
+    """Append-only log of processed keys with an in-memory index
+    
+    Each log line is "<unix time>\\t<key>". Lookups hit a dict, so they are
+    O(1); entries older than the retention window are evicted from the front
+    of the dict (which is in insertion, i.e. time, order) and the log is
+    compacted once stale lines outnumber the live ones.
+    """
+    
+    def __init__(self, path, logger, retention_days=30):
+        self.path = path
+        self.logger = logger
+        self.retention_seconds = retention_days * 24 * 3600
+        self.entries = {}
+        self.pending = set()
+        self.log_lines = 0
+        self.load()
+    
+    def load(self):
+        """Rebuild the index from the log, skipping expired and malformed lines"""
+        if not self.path or not os.path.exists(self.path):
+            return
+        
+        cutoff = time.time() - self.retention_seconds
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    self.log_lines += 1
+                    seen_at, _, key = line.rstrip('\n').partition('\t')
+                    try:
+                        seen_at = float(seen_at)
+                    except ValueError:
+                        continue
+                    if key and seen_at >= cutoff and key not in self.entries:
+                        self.entries[key] = seen_at
+            
+            self.logger.info(f"Loaded {len(self.entries)} processed email keys from {self.path}")
+        except Exception as e:
+            self.logger.warning(f"Ignoring unreadable dedup store '{self.path}': {str(e)}")
+            self.entries = {}
+            return
+        
+        self.compact_if_needed()
+    
+    def evict_expired(self):
+        cutoff = time.time() - self.retention_seconds
+        while self.entries:
+            oldest_key = next(iter(self.entries))
+            if self.entries[oldest_key] >= cutoff:
+                break
+            del self.entries[oldest_key]
+    
+    def contains_any(self, keys):
+        return any(key in self.entries for key in keys)
+    
+    def add(self, keys):
+        """Record keys as processed and append them to the log in one write"""
+        now = time.time()
+        new_keys = [key for key in keys if key not in self.entries]
+        if not new_keys:
+            return
+        
+        for key in new_keys:
+            self.entries[key] = now
+        self.evict_expired()
+        
+        if not self.path:
+            return
+        
+        try:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(''.join(f"{now:.0f}\t{key}\n" for key in new_keys))
+            self.log_lines += len(new_keys)
+        except Exception as e:
+            self.logger.error(f"Error saving dedup store: {str(e)}")
+            return
+        
+        self.compact_if_needed()
+    
+    def compact_if_needed(self):
+        """Atomically rewrite the log with only the live entries"""
+        if not self.path or self.log_lines <= 2 * len(self.entries) + COMPACT_SLACK_LINES:
+            return
+        
+        try:
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(''.join(f"{seen_at:.0f}\t{key}\n" for key, seen_at in self.entries.items()))
+            os.replace(tmp_path, self.path)
+            self.log_lines = len(self.entries)
+            self.logger.debug(f"Compacted dedup store to {self.log_lines} entries")
+        except Exception as e:
+            self.logger.error(f"Error compacting dedup store: {str(e)}")
+    
+    def filter_new(self, emails):
+        """Drop emails already processed, pending or repeated within the list
+        
+        The keys of the emails kept are attached as email_info['dedup_keys']
+        and held as pending until commit(), so an email whose alert could not
+        be recorded is found again on the next check instead of being lost.
+        """
+        new_emails = []
+        duplicate_keys = []
+        for email_info in emails:
+            keys = dedup_keys(email_info)
+            if self.contains_any(keys) or any(key in self.pending for key in keys):
+                # A resent booking's new Message-ID is recorded too, so it is skipped on headers next time
+                duplicate_keys.extend(keys)
+                self.logger.info(f"Skipping already processed email: {email_info.get('subject', 'No Subject')}")
+                continue
+            
+            email_info['dedup_keys'] = keys
+            self.pending.update(keys)
+            new_emails.append(email_info)
+        
+        self.add(duplicate_keys)
+        return new_emails
+    
+    def commit(self, emails):
+        """Record emails returned by filter_new as processed"""
+        keys = [key for email_info in emails for key in email_info.get('dedup_keys', ())]
+        self.add(keys)
+        self.pending.difference_update(keys)
+    
+    def release_pending(self):
+        """Forget uncommitted emails so the next check processes them again"""
+        self.pending.clear()
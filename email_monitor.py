@@ -2,133 +2,919 @@
 Email monitoring module for checking IMAP mailbox for Bookeo emails
 """
 
+import binascii
 import imaplib
+import itertools
 import email
 import email.utils
-import socket
-from datetime import datetime, timedelta
+import json
+import os
+import quopri
+import select
+import ssl
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
 from email.header import decode_header
 import re
 
+from dedup_store import DedupStore, dedup_keys
+from latency_metrics import pipeline_latency
+from logger_config import pop_log_context, push_log_context
+from metrics import CYCLES, CYCLE_DURATION, IMAP_CONNECT_DURATION, LAST_SUCCESSFUL_CHECK
+from poll_scheduler import PollScheduler
+
+# RFC 2177: servers may drop clients that stay in IDLE for 30 minutes or more,
+# so a single IDLE command is never kept open longer than this
+IDLE_MAX_SECONDS = 29 * 60
+
+# Delay before racing the next IMAP server candidate during discovery
+DISCOVERY_STAGGER_SECONDS = 0.25
+
+# Upper bound on messages requested by a single FETCH command
+FETCH_BATCH_SIZE = 50
+
+# Cycle ids for log records, unique across the mailboxes of one process
+CHECK_IDS = itertools.count(1)
+
+# Header-first fetching: only these headers are downloaded in the first phase,
+# then at most BODY_FETCH_BYTES of the text/plain part in the second
+HEADER_FIELDS = 'FROM TO SUBJECT DATE MESSAGE-ID'
+BODY_FETCH_BYTES = 2048
+BODY_PREVIEW_CHARS = 500
+
+HEADER_FETCH_ITEMS = f'(UID INTERNALDATE BODYSTRUCTURE BODY.PEEK[HEADER.FIELDS ({HEADER_FIELDS})])'
+
+FETCH_START_RE = re.compile(rb'^(\d+) \(')
+FETCH_LITERAL_MARKER_RE = re.compile(rb'\{\d+\}$')
+FETCH_UID_RE = re.compile(rb'\bUID (\d+)')
+FETCH_INTERNALDATE_RE = re.compile(rb'\bINTERNALDATE "([^"]+)"')
+FETCH_LITERAL_ITEM_RE = re.compile(rb'([A-Z0-9.]+(?:\[[^\]]*\])?(?:<\d+>)?) \{\d+\}$', re.IGNORECASE)
+
+def compress_uid_set(uids):
+    """Compress UIDs into an IMAP sequence set, e.g. [3, 7, 9, 10, 11] -> '3,7,9:11'"""
+    ranges = []
+    for uid in sorted(set(uids)):
+        if ranges and uid == ranges[-1][1] + 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+    return ','.join(str(first) if first == last else f"{first}:{last}" for first, last in ranges)
+
+def body_fetch_items(section):
+    """FETCH items for the first BODY_FETCH_BYTES of a body section, without setting \\Seen"""
+    return f'(UID BODY.PEEK[{section}]<0.{BODY_FETCH_BYTES}>)'
+
+def iter_fetch_responses(data):
+    """Stream the per-message results out of a multi-message FETCH response
+    
+    imaplib returns a flat list mixing (prefix, literal) tuples and plain
+    bytes continuations. Yields one dict per message with its sequence number,
+    UID, the non-literal attribute text and the literals keyed by item name.
+    """
+    current = None
+    
+    for part in data:
+        if part is None:
+            continue
+        
+        prefix, literal = part if isinstance(part, tuple) else (part, None)
+        
+        start = FETCH_START_RE.match(prefix)
+        if start:
+            if current is not None:
+                yield _finish_fetch_response(current)
+            current = {'sequence': int(start.group(1)), 'attributes': b'', 'literals': {}}
+        elif current is None:
+            continue
+        
+        if literal is not None:
+            item = FETCH_LITERAL_ITEM_RE.search(prefix)
+            if item:
+                current['literals'][item.group(1).upper().decode()] = literal
+                prefix = prefix[:item.start()]
+            else:
+                # A literal string inside an attribute such as BODYSTRUCTURE
+                marker = FETCH_LITERAL_MARKER_RE.search(prefix)
+                quoted = b'"' + literal.replace(b'\\', b'\\\\').replace(b'"', b'\\"') + b'"'
+                prefix = (prefix[:marker.start()] if marker else prefix) + quoted
+        current['attributes'] += prefix
+    
+    if current is not None:
+        yield _finish_fetch_response(current)
+
+def _finish_fetch_response(response):
+    uid = FETCH_UID_RE.search(response['attributes'])
+    response['uid'] = int(uid.group(1)) if uid else None
+    return response
+
+def parse_internaldate(attributes):
+    """Unix time the server received the message, from a FETCH INTERNALDATE item, or None"""
+    match = FETCH_INTERNALDATE_RE.search(attributes)
+    if not match:
+        return None
+    try:
+        return datetime.strptime(match.group(1).decode().strip(), "%d-%b-%Y %H:%M:%S %z").timestamp()
+    except ValueError:
+        return None
+
+def parse_date_header(value):
+    """Unix time from a Date header, or None"""
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return date.timestamp()
+
+BODYSTRUCTURE_TOKEN_RE = re.compile(rb'\(|\)|"(?:[^"\\]|\\.)*"|[^\s()"]+')
+
+def parse_bodystructure(attributes):
+    """Parse the BODYSTRUCTURE item of a FETCH response into nested lists"""
+    index = attributes.upper().find(b'BODYSTRUCTURE (')
+    if index < 0:
+        return None
+    
+    stack = [[]]
+    for match in BODYSTRUCTURE_TOKEN_RE.finditer(attributes, index + len(b'BODYSTRUCTURE ')):
+        token = match.group(0)
+        if token == b'(':
+            stack.append([])
+        elif token == b')':
+            completed = stack.pop()
+            stack[-1].append(completed)
+            if len(stack) == 1:
+                return stack[0][0]
+        elif token.startswith(b'"'):
+            stack[-1].append(re.sub(rb'\\(.)', rb'\1', token[1:-1]).decode('utf-8', errors='replace'))
+        elif token.upper() == b'NIL':
+            stack[-1].append(None)
+        else:
+            stack[-1].append(token.decode('ascii', errors='replace'))
+    
+    return None
+
+def find_text_part(structure):
+    """Locate the body part to preview, mirroring parse_email_message
+    
+    Returns a dict with the IMAP section, transfer encoding and charset of the
+    first text/plain part of a multipart message (or the body of a single-part
+    text message), or None when there is nothing to preview.
+    """
+    if not structure:
+        return None
+    
+    if not isinstance(structure[0], list):
+        # Single-part message: its body is section 1
+        if str(structure[0]).upper() != 'TEXT':
+            return None
+        return _describe_body_part(structure, '1')
+    
+    return _find_plain_text_part(structure, '')
+
+def _find_plain_text_part(structure, prefix):
+    for index, child in enumerate(structure, 1):
+        if not isinstance(child, list):
+            break
+        
+        section = f"{prefix}{index}"
+        if isinstance(child[0], list):
+            found = _find_plain_text_part(child, f"{section}.")
+            if found:
+                return found
+        elif str(child[0]).upper() == 'TEXT' and str(child[1]).upper() == 'PLAIN':
+            return _describe_body_part(child, section)
+    
+    return None
+
+def _describe_body_part(part, section):
+    params = part[2] if len(part) > 2 and isinstance(part[2], list) else []
+    charset = None
+    for index in range(0, len(params) - 1, 2):
+        if str(params[index]).upper() == 'CHARSET':
+            charset = params[index + 1]
+    
+    encoding = part[5] if len(part) > 5 and part[5] else '7BIT'
+    return {'section': section, 'encoding': encoding.upper(), 'charset': charset or 'utf-8'}
+
+def decode_partial_body(data, encoding, charset):
+    """Decode a body prefix that may have been cut off mid-encoding"""
+    if encoding == 'BASE64':
+        compact = re.sub(rb'[^A-Za-z0-9+/=]', b'', data)
+        data = binascii.a2b_base64(compact[:len(compact) - len(compact) % 4])
+    elif encoding == 'QUOTED-PRINTABLE':
+        # Drop an escape sequence or soft line break cut off by the byte limit
+        data = quopri.decodestring(re.sub(rb'=[0-9A-Fa-f]?$', b'', data))
+    
+    try:
+        return data.decode(charset, errors='ignore')
+    except LookupError:
+        return data.decode('utf-8', errors='ignore')
+
+def parse_size_update(line):
+    """(name, number) for an untagged "* N EXISTS" or "* N EXPUNGE" line, else None"""
+    words = line.split()
+    if len(words) != 3 or words[0] != b'*' or not words[1].isdigit():
+        return None
+    name = words[2].upper().decode('ascii', 'replace')
+    if name not in ('EXISTS', 'EXPUNGE'):
+        return None
+    return name, int(words[1])
+
+def has_buffered_input(connection):
+    """Check, without blocking, for input already read from the socket
+    
+    imaplib reads through a buffered file object, and TLS decrypts whole
+    records, so a line can be waiting although select() reports nothing.
+    """
+    sock = connection.sock
+    timeout = sock.gettimeout()
+    sock.setblocking(False)
+    try:
+        return bool(connection.file.peek(1))
+    except (BlockingIOError, ssl.SSLWantReadError):
+        return False
+    finally:
+        sock.settimeout(timeout)
+
+def run_commands(commands, execute):
+    """Drive a command generator such as EmailMonitor.check_commands
+    
+    execute(*request) runs one yielded request and returns its result; the
+    asyncio engine has an awaiting counterpart of this loop.
+    """
+    try:
+        request = next(commands)
+        while True:
+            request = commands.send(execute(*request))
+    except StopIteration as finished:
+        return finished.value
+
+class MailboxSession:
+    """Long-lived, authenticated and selected IMAP session reused across monitoring cycles"""
+    
+    def __init__(self, connector, logger, mailbox='INBOX'):
+        self.connector = connector
+        self.logger = logger
+        self.mailbox = mailbox
+        self.connection = None
+        self.uidvalidity = None
+        self.uidnext = None
+        
+        # Message count last reported by the server; new_mail_seen is set when
+        # it grows, e.g. in the reply to a NOOP, and cleared by the next search
+        self.exists = None
+        self.new_mail_seen = False
+        
+        # Session statistics
+        self.handshakes = 0
+        self.reuses = 0
+        self.total_handshake_time = 0.0
+        self.total_noop_time = 0.0
+    
+    def is_alive(self):
+        """Check the current connection with a cheap NOOP"""
+        if self.connection is None:
+            return False
+        
+        try:
+            start = time.monotonic()
+            status, _ = self.connection.noop()
+            self.total_noop_time += time.monotonic() - start
+            
+            self.consume_untagged()
+            return status == 'OK'
+        except (imaplib.IMAP4.error, OSError) as e:
+            self.logger.info(f"IMAP session lost: {str(e)}")
+            return False
+    
+    def note_mailbox_size(self, exists=None, expunged=0):
+        """Track the server's message count, flagging new mail when it grows"""
+        if self.exists is not None:
+            self.exists -= expunged
+        if exists is not None:
+            if self.exists is None or exists > self.exists:
+                self.new_mail_seen = True
+            self.exists = exists
+    
+    def note_untagged_line(self, line):
+        """Apply a raw "* N EXISTS" / "* N EXPUNGE" line read outside imaplib"""
+        update = parse_size_update(line)
+        if update is None:
+            return
+        name, number = update
+        if name == 'EXISTS':
+            self.note_mailbox_size(exists=number)
+        else:
+            self.note_mailbox_size(expunged=1)
+    
+    def note_idle_line(self, line):
+        """Apply an untagged line read around IDLE; True once new mail was announced"""
+        self.note_untagged_line(line)
+        return self.new_mail_seen
+    
+    def supports_idle(self):
+        """Check whether the current connection advertises the IDLE capability"""
+        return self.connection is not None and 'IDLE' in self.connection.capabilities
+    
+    def consume_untagged(self):
+        """Note new mail announced in untagged responses, then drop them
+        
+        Unsolicited EXISTS/RECENT/EXPUNGE responses pile up in imaplib on a
+        long-lived connection because nothing else consumes them.
+        """
+        untagged = self.connection.untagged_responses
+        try:
+            exists = int(untagged['EXISTS'][-1]) if 'EXISTS' in untagged else None
+        except (TypeError, ValueError):
+            exists = None
+        self.note_mailbox_size(exists, len(untagged.get('EXPUNGE', ())))
+        untagged.clear()
+    
+    def acquire(self):
+        """Return a live, selected connection, reconnecting only if the session is gone"""
+        if self.is_alive():
+            self.reuses += 1
+            self.logger.debug(
+                "Reusing IMAP session (saved ~%.2fs handshake, %d handshake(s) for %d acquisition(s))",
+                self.average_handshake_time(), self.handshakes, self.handshakes + self.reuses
+            )
+            return self.connection
+        
+        self.invalidate()
+        
+        start = time.monotonic()
+        connection = self.connector()
+        if connection is None:
+            return None
+        
+        try:
+            status, _ = connection.select(self.mailbox)
+            if status != 'OK':
+                raise imaplib.IMAP4.error(f"SELECT {self.mailbox} returned {status}")
+        except Exception as e:
+            self.logger.error(f"Error selecting {self.mailbox}: {str(e)}")
+            self._logout(connection)
+            return None
+        
+        self.uidvalidity = self._select_response_code(connection, 'UIDVALIDITY')
+        self.uidnext = self._select_response_code(connection, 'UIDNEXT')
+        # The mailbox size reported by SELECT is the baseline, not new mail
+        self.exists = self._select_response_code(connection, 'EXISTS')
+        self.new_mail_seen = False
+        connection.untagged_responses.clear()
+        
+        elapsed = time.monotonic() - start
+        self.handshakes += 1
+        self.total_handshake_time += elapsed
+        IMAP_CONNECT_DURATION.observe(elapsed)
+        self.connection = connection
+        self.logger.debug("Opened new IMAP session in %.2fs", elapsed, extra={'stage': 'connect', 'duration': elapsed})
+        return connection
+    
+    def invalidate(self):
+        """Drop the current connection after it failed, without waiting on the server"""
+        if self.connection is not None:
+            try:
+                self.connection.shutdown()
+            except Exception:
+                pass
+            self.connection = None
+    
+    def close(self):
+        """Gracefully close the session"""
+        if self.connection is not None:
+            connection = self.connection
+            self.connection = None
+            try:
+                connection.close()
+            except Exception:
+                pass
+            self._logout(connection)
+    
+    def _select_response_code(self, connection, name):
+        """Read a numeric response code (e.g. UIDVALIDITY) returned by SELECT"""
+        _, data = connection.response(name)
+        try:
+            return int(data[-1])
+        except (TypeError, ValueError, IndexError):
+            return None
+    
+    def _logout(self, connection):
+        try:
+            connection.logout()
+        except Exception:
+            pass
+    
+    def average_handshake_time(self):
+        """Average cost of a full connect + login + select"""
+        if not self.handshakes:
+            return 0.0
+        return self.total_handshake_time / self.handshakes
+    
+    def get_stats(self):
+        """Return handshake and latency savings of the session"""
+        return {
+            'handshakes': self.handshakes,
+            'reuses': self.reuses,
+            'avg_handshake_seconds': self.average_handshake_time(),
+            'avg_noop_seconds': self.total_noop_time / max(self.reuses, 1),
+            'estimated_seconds_saved': max(
+                0.0, self.reuses * self.average_handshake_time() - self.total_noop_time
+            ),
+        }
+
+def write_json_atomically(path, data):
+    """Write JSON to a temporary file and rename it over the target"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+class UIDCheckpoint:
+    """Durable high-water mark of the highest processed UID for one UIDVALIDITY"""
+    
+    def __init__(self, path, logger):
+        self.path = path
+        self.logger = logger
+        self.uidvalidity = None
+        self.last_uid = None
+        self.load()
+    
+    def load(self):
+        """Load the checkpoint from disk, starting fresh if it is missing or corrupt"""
+        if not self.path or not os.path.exists(self.path):
+            return
+        
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+            self.uidvalidity = int(state['uidvalidity'])
+            self.last_uid = int(state['last_uid'])
+            self.logger.info(f"Loaded UID checkpoint: UIDVALIDITY {self.uidvalidity}, last UID {self.last_uid}")
+        except Exception as e:
+            self.logger.warning(f"Ignoring unreadable UID checkpoint '{self.path}': {str(e)}")
+            self.uidvalidity = None
+            self.last_uid = None
+    
+    def save(self):
+        """Atomically write the checkpoint to disk"""
+        if not self.path:
+            return
+        
+        state = {
+            'uidvalidity': self.uidvalidity,
+            'last_uid': self.last_uid,
+            'updated_at': datetime.now().isoformat(),
+        }
+        try:
+            write_json_atomically(self.path, state)
+        except Exception as e:
+            self.logger.error(f"Error saving UID checkpoint: {str(e)}")
+    
+    def is_valid_for(self, uidvalidity):
+        """Check whether the checkpoint can be used against the selected mailbox"""
+        return (
+            uidvalidity is not None
+            and self.uidvalidity == uidvalidity
+            and self.last_uid is not None
+        )
+    
+    def advance(self, uidvalidity, uid):
+        """Move the high-water mark forward and persist it"""
+        if self.uidvalidity != uidvalidity:
+            self.uidvalidity = uidvalidity
+            self.last_uid = uid
+        elif self.last_uid is None or uid > self.last_uid:
+            self.last_uid = uid
+        else:
+            return
+        self.save()
+
+class ServerDiscoveryCache:
+    """Remembers which IMAP server last worked for each account"""
+    
+    def __init__(self, path, logger, max_failures=3):
+        self.path = path
+        self.logger = logger
+        self.max_failures = max_failures
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.load()
+    
+    def load(self):
+        """Load cached servers from disk, starting empty if missing or corrupt"""
+        if not self.path or not os.path.exists(self.path):
+            return
+        
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self.entries = json.load(f)
+        except Exception as e:
+            self.logger.warning(f"Ignoring unreadable IMAP discovery cache '{self.path}': {str(e)}")
+            self.entries = {}
+    
+    def save(self):
+        if not self.path:
+            return
+        
+        try:
+            write_json_atomically(self.path, self.entries)
+        except Exception as e:
+            self.logger.error(f"Error saving IMAP discovery cache: {str(e)}")
+    
+    def get(self, account):
+        """Return the cached (host, port) for an account, or None"""
+        with self.lock:
+            entry = self.entries.get(account)
+            if not entry:
+                return None
+            return entry['host'], entry['port']
+    
+    def record_success(self, account, host, port):
+        with self.lock:
+            entry = self.entries.get(account)
+            if entry and (entry['host'], entry['port']) == (host, port) and not entry.get('failures'):
+                return
+            self.entries[account] = {
+                'host': host,
+                'port': port,
+                'failures': 0,
+                'updated_at': datetime.now().isoformat(),
+            }
+            self.save()
+    
+    def record_failure(self, account):
+        """Count a failed connect to the cached server, dropping it after repeated failures"""
+        with self.lock:
+            entry = self.entries.get(account)
+            if not entry:
+                return
+            
+            entry['failures'] = entry.get('failures', 0) + 1
+            if entry['failures'] >= self.max_failures:
+                self.logger.warning(
+                    f"Dropping cached IMAP server {entry['host']}:{entry['port']} "
+                    f"after {entry['failures']} consecutive failures"
+                )
+                del self.entries[account]
+            self.save()
+
 class EmailMonitor:
-    def __init__(self, config, logger):
+    def __init__(self, config, logger, discovery_cache=None):
         self.config = config
         self.logger = logger
         self.last_check_time = None
         self.connection = None
+        self.session = MailboxSession(self._open_connection, logger)
+        self.checkpoint = UIDCheckpoint(config.uid_state_file, logger)
+        self.dedup = DedupStore(config.dedup_store_file, logger, config.dedup_retention_days)
+        self.poll_scheduler = PollScheduler(
+            config.poll_history_file, logger, config.check_interval, config.poll_min_interval,
+            config.poll_max_interval, config.poll_cost, config.adaptive_polling
+        )
+        
+        # Called as alert_handler(monitor, emails) before new emails are marked processed
+        self.alert_handler = None
+        
+        # Monitors for several mailboxes share one cache (and its file)
+        self.discovery_cache = discovery_cache or ServerDiscoveryCache(config.discovery_cache_file, logger)
+        
+        # Download statistics
+        self.messages_fetched = 0
+        self.bytes_downloaded = 0
+        
+        # Heartbeat for the health watchdog
+        self.successful_checks = 0
+        self.consecutive_failures = 0
+        self.last_check_completed_at = None
+        self.imap_connected = False
+        # Whether the last wait between checks was an IMAP IDLE rather than a poll interval
+        self.using_idle = False
     
     def connect_to_mailbox(self):
         """Establish IMAP connection to the mailbox"""
+        self.connection = self._open_connection()
+        return self.connection is not None
+    
+    def get_imap_servers(self, domain):
+        """List candidate (host, port) pairs for a domain, most likely first"""
+        if 'gmail' in domain:
+            return [('imap.gmail.com', 993)]
+        elif 'outlook' in domain or 'hotmail' in domain or 'live' in domain:
+            return [('outlook.office365.com', 993)]
+        elif 'yahoo' in domain:
+            return [('imap.mail.yahoo.com', 993)]
+        
+        # For custom domains, try common hosting providers first
+        # Check for Turbify/Yahoo Small Business first for this domain
+        if 'quantumescapesdanville' in domain:
+            return [
+                ('imap.mail.yahoo.com', 993),  # Turbify uses Yahoo infrastructure
+                ('imap.bizmail.yahoo.com', 993),  # Alternative Yahoo business server
+                ('imap.gmail.com', 993),  # Backup: Google Workspace
+                ('outlook.office365.com', 993),  # Backup: Microsoft 365
+            ]
+        
+        return [
+            # Major hosting providers (most common)
+            ('imap.gmail.com', 993),  # Google Workspace
+            ('outlook.office365.com', 993),  # Microsoft 365
+            ('imap.mail.yahoo.com', 993),  # Yahoo Business/Turbify
+            # Domain-specific servers
+            (f'imap.{domain}', 993),
+            (f'mail.{domain}', 993),
+            (f'{domain}', 993),
+            # Common hosting providers
+            ('imap.hostgator.com', 993),
+            ('imap.godaddy.com', 993),
+            ('mail.privateemail.com', 993),
+            # Fallback to non-SSL
+            (f'imap.{domain}', 143),
+            (f'mail.{domain}', 143)
+        ]
+    
+    def _open_transport(self, imap_server, port):
+        """Connect to a single IMAP server up to (not including) LOGIN, raising on failure"""
+        self.logger.info(f"Attempting connection to IMAP server: {imap_server}:{port}")
+        
+        # Create IMAP connection; the timeout covers TCP connect, TLS and the greeting
+        connect_timeout = self.config.imap_connect_timeout
+        if port == 993:
+            connection = imaplib.IMAP4_SSL(imap_server, port, timeout=connect_timeout)
+        else:
+            connection = imaplib.IMAP4(imap_server, port, timeout=connect_timeout)
+        
         try:
-            # Determine IMAP server based on email domain
-            domain = self.config.email_address.split('@')[1].lower()
-            
-            # List of IMAP servers to try for the domain
-            imap_servers = []
-            
-            if 'gmail' in domain:
-                imap_servers = [('imap.gmail.com', 993)]
-            elif 'outlook' in domain or 'hotmail' in domain or 'live' in domain:
-                imap_servers = [('outlook.office365.com', 993)]
-            elif 'yahoo' in domain:
-                imap_servers = [('imap.mail.yahoo.com', 993)]
-            else:
-                # For custom domains, try common hosting providers first
-                # Check for Turbify/Yahoo Small Business first for this domain
-                if 'quantumescapesdanville' in domain:
-                    imap_servers = [
-                        ('imap.mail.yahoo.com', 993),  # Turbify uses Yahoo infrastructure
-                        ('imap.bizmail.yahoo.com', 993),  # Alternative Yahoo business server
-                        ('imap.gmail.com', 993),  # Backup: Google Workspace
-                        ('outlook.office365.com', 993),  # Backup: Microsoft 365
-                    ]
-                else:
-                    imap_servers = [
-                        # Major hosting providers (most common)
-                        ('imap.gmail.com', 993),  # Google Workspace
-                        ('outlook.office365.com', 993),  # Microsoft 365
-                        ('imap.mail.yahoo.com', 993),  # Yahoo Business/Turbify
-                        # Domain-specific servers
-                        (f'imap.{domain}', 993),
-                        (f'mail.{domain}', 993),
-                        (f'{domain}', 993),
-                        # Common hosting providers
-                        ('imap.hostgator.com', 993),
-                        ('imap.godaddy.com', 993),
-                        ('mail.privateemail.com', 993),
-                        # Fallback to non-SSL
-                        (f'imap.{domain}', 143),
-                        (f'mail.{domain}', 143)
-                    ]
-            
-            # Try each server configuration
-            old_timeout = socket.getdefaulttimeout()
-            for imap_server, port in imap_servers:
-                try:
-                    self.logger.info(f"Attempting connection to IMAP server: {imap_server}:{port}")
-                    
-                    # Set socket timeout to 10 seconds
-                    socket.setdefaulttimeout(10)
-                    
-                    # Create IMAP connection
-                    if port == 993:
-                        self.connection = imaplib.IMAP4_SSL(imap_server, port)
-                    else:
-                        self.connection = imaplib.IMAP4(imap_server, port)
-                        self.connection.starttls()
-                    
-                    self.connection.login(self.config.email_address, self.config.email_password)
-                    
-                    # Restore original timeout after successful connection
-                    socket.setdefaulttimeout(old_timeout)
-                    
-                    self.logger.info(f"Successfully connected to mailbox via {imap_server}:{port}")
-                    return True
+            if port != 993:
+                connection.starttls()
+        except Exception:
+            self._drop_transport(connection)
+            raise
+        
+        return connection
+    
+    def _login(self, connection):
+        """Log in on a connection from _open_transport, raising on failure"""
+        # Timeouts are set on this connection's socket only, never process-wide
+        connection.sock.settimeout(self.config.imap_login_timeout)
+        connection.login(self.config.email_address, self.config.email_password)
+        connection.sock.settimeout(self.config.imap_command_timeout)
+    
+    def _drop_transport(self, connection):
+        try:
+            connection.shutdown()
+        except Exception:
+            pass
+    
+    def _connect_to_server(self, imap_server, port):
+        """Connect and log in to a single IMAP server, raising on failure"""
+        connection = self._open_transport(imap_server, port)
+        try:
+            self._login(connection)
+        except Exception:
+            self._drop_transport(connection)
+            raise
+        
+        return connection
+    
+    def _race_servers(self, imap_servers, stagger=DISCOVERY_STAGGER_SECONDS):
+        """Connect to candidates concurrently, happy-eyeballs style, and log in to the fastest
+        
+        Candidates start in order of preference, each one either after the
+        previous has been connecting for `stagger` seconds or as soon as a
+        started attempt fails. Only the connect, TLS and greeting are raced:
+        the credentials go to one server at a time, in the order they
+        answered, and to the next only if that login fails. Returns
+        (host, port, connection) or None.
+        """
+        condition = threading.Condition()
+        state = {'connected': [], 'finished': 0, 'failed': False, 'done': False}
+        
+        def attempt(imap_server, port):
+            connection = None
+            try:
+                connection = self._open_transport(imap_server, port)
+            except Exception as server_error:
+                self.logger.debug(f"Failed to connect to {imap_server}:{port} - {str(server_error)}")
+            
+            with condition:
+                state['finished'] += 1
+                if connection is None:
+                    state['failed'] = True
+                elif not state['done']:
+                    state['connected'].append((imap_server, port, connection))
+                    connection = None
+                condition.notify_all()
+            
+            # Answered after a login succeeded elsewhere
+            if connection is not None:
+                self._drop_transport(connection)
+        
+        started = 0
+        next_start = time.monotonic()
+        try:
+            while True:
+                with condition:
+                    while not state['connected']:
+                        if state['finished'] >= len(imap_servers):
+                            return None
+                        
+                        now = time.monotonic()
+                        if started < len(imap_servers) and (now >= next_start or state['failed']):
+                            state['failed'] = False
+                            imap_server, port = imap_servers[started]
+                            threading.Thread(target=attempt, args=(imap_server, port), daemon=True).start()
+                            started += 1
+                            next_start = now + stagger
+                            continue
+                        
+                        condition.wait(next_start - now if started < len(imap_servers) else None)
                     
+                    imap_server, port, connection = state['connected'].pop(0)
+                
+                # Outside the lock, so the other candidates keep connecting meanwhile
+                try:
+                    self._login(connection)
+                    return imap_server, port, connection
+                except Exception as login_error:
+                    self.logger.debug(f"Login to {imap_server}:{port} failed - {str(login_error)}")
+                    self._drop_transport(connection)
+                    with condition:
+                        state['failed'] = True
+        finally:
+            with condition:
+                state['done'] = True
+                unused, state['connected'] = state['connected'], []
+            for _, _, connection in unused:
+                self._drop_transport(connection)
+    
+    def discovery_candidates(self):
+        """The server that worked last time, if any, and the candidates to race without it"""
+        # Determine IMAP server based on email domain
+        account = self.config.email_address
+        domain = account.split('@')[1].lower()
+        return self.discovery_cache.get(account), self.get_imap_servers(domain)
+    
+    def record_connected(self, imap_server, port, cached=False):
+        self.discovery_cache.record_success(self.config.email_address, imap_server, port)
+        self.logger.info(f"Successfully connected to mailbox via {imap_server}:{port}{' (cached)' if cached else ''}")
+    
+    def record_cached_failure(self, cached, imap_servers, error):
+        """Count a failed connect to the cached server; returns the candidates to race, it first"""
+        self.logger.warning(f"Cached IMAP server {cached[0]}:{cached[1]} failed - {str(error)}")
+        self.discovery_cache.record_failure(self.config.email_address)
+        return [cached] + [server for server in imap_servers if server != cached]
+    
+    def record_discovery_failed(self):
+        domain = self.config.email_address.split('@')[1].lower()
+        self.logger.error(f"Failed to connect to any IMAP server for domain {domain}")
+        self.logger.error("Please check:")
+        self.logger.error("1. Email credentials are correct")
+        self.logger.error("2. IMAP is enabled for this email account")
+        self.logger.error("3. Network connectivity and firewall settings")
+    
+    def _open_connection(self):
+        """Find a working IMAP server for the account and return a logged-in connection"""
+        try:
+            cached, imap_servers = self.discovery_candidates()
+            
+            # Go straight to the server that worked last time
+            if cached:
+                try:
+                    connection = self._connect_to_server(*cached)
+                    self.record_connected(*cached, cached=True)
+                    return connection
                 except Exception as server_error:
-                    self.logger.debug(f"Failed to connect to {imap_server}:{port} - {str(server_error)}")
-                    if self.connection:
-                        try:
-                            self.connection.close()
-                            self.connection.logout()
-                        except:
-                            pass
-                        self.connection = None
-                    continue
+                    imap_servers = self.record_cached_failure(cached, imap_servers, server_error)
             
-            # Restore timeout if all connections failed
-            socket.setdefaulttimeout(old_timeout)
+            winner = self._race_servers(imap_servers)
             
-            # If we get here, all servers failed
-            self.logger.error(f"Failed to connect to any IMAP server for domain {domain}")
-            self.logger.error("Please check:")
-            self.logger.error("1. Email credentials are correct")
-            self.logger.error("2. IMAP is enabled for this email account")
-            self.logger.error("3. Network connectivity and firewall settings")
-            return False
+            if winner:
+                imap_server, port, connection = winner
+                self.record_connected(imap_server, port)
+                return connection
             
+            # If we get here, all servers failed
+            self.record_discovery_failed()
+            return None
+        
         except Exception as e:
             self.logger.error(f"Error connecting to mailbox: {str(e)}")
-            return False
+            return None
     
     def disconnect_from_mailbox(self):
         """Close IMAP connection"""
         try:
-            if self.connection:
+            if self.session.connection:
+                self.session.close()
+                self.logger.debug("Disconnected from mailbox")
+            elif self.connection:
                 self.connection.close()
                 self.connection.logout()
-                self.connection = None
                 self.logger.debug("Disconnected from mailbox")
         except Exception as e:
             self.logger.error(f"Error disconnecting from mailbox: {str(e)}")
+        finally:
+            self.connection = None
     
     def test_connection(self):
         """Test the email connection"""
         self.logger.info("Testing email connection...")
-        if self.connect_to_mailbox():
-            self.disconnect_from_mailbox()
+        # Keep the tested session open so the first cycle can reuse it
+        return self.session.acquire() is not None
+    
+    def wait_for_new_mail(self, timeout, should_stop=None):
+        """Block in IMAP IDLE until the server announces new mail (RFC 2177)
+        
+        Returns True when the server reported new messages, False when the
+        timeout expired or should_stop() became true, and None when IDLE cannot
+        be used and the caller should fall back to interval polling.
+        """
+        self.using_idle = False
+        connection = self.session.acquire()
+        if connection is None:
+            return None
+        
+        if not self.session.supports_idle():
+            self.logger.debug("IMAP server does not support IDLE")
+            return None
+        self.using_idle = True
+        
+        # Mail announced since the last search (e.g. in acquire's NOOP) is
+        # not repeated once IDLE starts
+        if self.session.new_mail_seen:
+            self.logger.debug("New mail was announced before IDLE started")
             return True
-        return False
+        
+        timeout = min(timeout, IDLE_MAX_SECONDS)
+        tag = connection._new_tag()
+        
+        try:
+            connection.send(tag + b' IDLE\r\n')
+            
+            # Untagged responses may arrive before the continuation
+            new_mail = False
+            while True:
+                response = connection.readline()
+                if not response:
+                    raise imaplib.IMAP4.abort("connection closed by server before IDLE")
+                if response.startswith(b'+'):
+                    break
+                if not response.startswith(b'* ') or response.startswith(b'* BYE'):
+                    self.logger.warning(f"IMAP server refused IDLE: {response.strip()}")
+                    connection.tagged_commands.pop(tag, None)
+                    return None
+                new_mail = self.session.note_idle_line(response)
+            
+            self.logger.debug(f"Waiting up to {timeout}s for new mail via IMAP IDLE")
+            
+            deadline = time.monotonic() + timeout
+            sock = connection.sock
+            
+            while not new_mail:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or (should_stop and should_stop()):
+                    break
+                
+                # imaplib's buffered reader (or TLS) may already hold a line the raw socket won't report
+                if not has_buffered_input(connection):
+                    # Wake up at least once a second to honour should_stop
+                    readable, _, _ = select.select([sock], [], [], min(1.0, remaining))
+                    if not readable:
+                        continue
+                
+                line = connection.readline()
+                if not line or line.startswith(b'* BYE'):
+                    raise imaplib.IMAP4.abort("connection closed by server during IDLE")
+                
+                self.logger.debug("IDLE update: %s", line.strip())
+                new_mail = self.session.note_idle_line(line)
+            
+            # Leave IDLE and consume everything up to the tagged completion
+            connection.send(b'DONE\r\n')
+            while True:
+                line = connection.readline()
+                if not line:
+                    raise imaplib.IMAP4.abort("connection closed by server after IDLE")
+                if line.startswith(tag):
+                    break
+                self.session.note_untagged_line(line)
+            
+            connection.tagged_commands.pop(tag, None)
+            
+            if new_mail:
+                self.logger.info("IMAP IDLE: server reported new mail")
+            return new_mail
+        
+        except (imaplib.IMAP4.error, OSError) as e:
+            self.logger.error(f"IMAP IDLE failed: {str(e)}")
+            self.session.invalidate()
+            self.connection = None
+            self.using_idle = False
+            return None
     
     def decode_email_header(self, header):
         """Decode email header that might be encoded"""
@@ -153,19 +939,33 @@ class EmailMonitor:
             self.logger.error(f"Error decoding header '{header}': {str(e)}")
             return str(header) if header else ""
     
+    def extract_header_info(self, msg):
+        """Extract the header fields the monitor cares about"""
+        return {
+            'from': self.decode_email_header(msg.get('From', '')),
+            'to': self.decode_email_header(msg.get('To', '')),
+            'subject': self.decode_email_header(msg.get('Subject', '')),
+            'date': self.decode_email_header(msg.get('Date', '')),
+            'message_id': msg.get('Message-ID', ''),
+        }
+    
+    def parse_email_headers(self, raw_headers):
+        """Parse a header-only fetch into the same structure as parse_email_message"""
+        try:
+            email_info = self.extract_header_info(email.message_from_bytes(raw_headers))
+            email_info['body'] = ""
+            return email_info
+        except Exception as e:
+            self.logger.error(f"Error parsing email headers: {str(e)}")
+            return None
+    
     def parse_email_message(self, raw_email):
         """Parse raw email message and extract relevant information"""
         try:
             msg = email.message_from_bytes(raw_email)
             
             # Extract email information
-            email_info = {
-                'from': self.decode_email_header(msg.get('From', '')),
-                'to': self.decode_email_header(msg.get('To', '')),
-                'subject': self.decode_email_header(msg.get('Subject', '')),
-                'date': self.decode_email_header(msg.get('Date', '')),
-                'message_id': msg.get('Message-ID', ''),
-            }
+            email_info = self.extract_header_info(msg)
             
             # Extract body content
             body = ""
@@ -183,11 +983,10 @@ class EmailMonitor:
                     body = msg.get_payload(decode=True).decode('utf-8', errors='ignore')
                 except:
                     body = ""
-            
-            email_info['body'] = body[:500]  # Limit body to first 500 chars
+            email_info['body'] = body[:BODY_PREVIEW_CHARS]  # Limit body to first 500 chars
             
             return email_info
-            
+        
         except Exception as e:
             self.logger.error(f"Error parsing email message: {str(e)}")
             return None
@@ -195,7 +994,7 @@ class EmailMonitor:
     def is_from_bookeo(self, email_info):
         """Check if email is from Bookeo"""
         sender = email_info.get('from', '').lower()
-        return self.config.bookeo_sender.lower() in sender
+        return any(bookeo_sender.lower() in sender for bookeo_sender in self.config.bookeo_senders)
     
     def is_recent_email(self, email_info):
         """Check if email was received after last check"""
@@ -219,78 +1018,289 @@ class EmailMonitor:
             email_date_naive = email_date.replace(tzinfo=None)
             
             return email_date_naive > self.last_check_time
-            
+        
         except Exception as e:
             self.logger.error(f"Error parsing email date '{date_str}': {str(e)}")
             return True  # If we can't parse the date, consider it new
     
-    def check_for_bookeo_emails(self):
-        """Check mailbox for new emails from Bookeo"""
+    def build_search_criteria(self, uidvalidity):
+        """Build the UID SEARCH criteria for this cycle
+        
+        Returns the criteria and whether it is an incremental search from the
+        UID checkpoint. Without a usable checkpoint (first run or UIDVALIDITY
+        changed) a date search covering the look-back window is used instead.
+        """
+        # Several senders become nested ORs: OR OR FROM "a" FROM "b" FROM "c"
+        sender_criteria = f'FROM "{self.config.bookeo_senders[0]}"'
+        for bookeo_sender in self.config.bookeo_senders[1:]:
+            sender_criteria = f'OR {sender_criteria} FROM "{bookeo_sender}"'
+        
+        if self.checkpoint.is_valid_for(uidvalidity):
+            return f'UID {self.checkpoint.last_uid + 1}:* {sender_criteria}', True
+        
+        if self.checkpoint.uidvalidity is not None and self.checkpoint.uidvalidity != uidvalidity:
+            self.logger.warning(
+                f"UIDVALIDITY changed ({self.checkpoint.uidvalidity} -> {uidvalidity}), "
+                f"falling back to date search"
+            )
+        
+        if self.last_check_time is None:
+            # If this is the first check, only consider emails from the last hour
+            self.last_check_time = datetime.now() - timedelta(hours=1)
+        
+        # Format date for IMAP search (DD-MMM-YYYY)
+        since_date = self.last_check_time.strftime("%d-%b-%Y")
+        return f'{sender_criteria} SINCE {since_date}', False
+    
+    def parse_search_response(self, messages, incremental):
+        """Turn UID SEARCH results into the sorted list of UIDs still to process"""
+        # "n:*" always matches the highest UID, even when it is below n
+        uids = sorted(int(uid) for uid in messages[0].split()) if messages and messages[0] else []
+        if incremental:
+            uids = [uid for uid in uids if uid > self.checkpoint.last_uid]
+        self.logger.debug("Found %d potential emails", len(uids))
+        return uids
+    
+    def select_new_emails(self, header_data, incremental):
+        """Filter a header FETCH response down to new Bookeo emails
+        
+        Returns the new emails and, keyed by IMAP section, the (email, part)
+        pairs whose text part still has to be fetched.
+        """
+        start = time.perf_counter()
         new_bookeo_emails = []
+        parts_by_section = {}
         
-        try:
-            # Connect to mailbox
-            if not self.connect_to_mailbox():
-                return new_bookeo_emails
+        for response in iter_fetch_responses(header_data):
+            raw_headers = next(
+                (value for name, value in response['literals'].items() if name.startswith('BODY[HEADER')),
+                None
+            )
+            if raw_headers is None or response['uid'] is None:
+                continue
+            
+            self.messages_fetched += 1
+            self.bytes_downloaded += len(raw_headers) + len(response['attributes'])
+            
+            email_info = self.parse_email_headers(raw_headers)
+            if email_info is None:
+                continue
+            
+            email_info['uid'] = response['uid']
             
-            # Select INBOX
-            self.connection.select('INBOX')
+            # UIDs above the checkpoint are new by definition; the date
+            # check only applies to the look-back window without one
+            if not self.is_from_bookeo(email_info) or not (incremental or self.is_recent_email(email_info)):
+                continue
             
-            # Search for emails from Bookeo
-            search_criteria = f'FROM "{self.config.bookeo_sender}"'
+            # Already alerted on (e.g. before a restart): skip without fetching the body
+            if self.dedup.contains_any(dedup_keys(email_info)):
+                self.logger.debug(
+                    "Skipping already processed email: %s", email_info['subject'], extra={'uid': email_info.get('uid')}
+                )
+                continue
             
-            # If we have a last check time, search for recent emails
-            if self.last_check_time:
-                # Format date for IMAP search (DD-MMM-YYYY)
-                since_date = self.last_check_time.strftime("%d-%b-%Y")
-                search_criteria += f' SINCE {since_date}'
+            # When Bookeo sent it, when the server received it and when we found it
+            email_info['sent_at'] = parse_date_header(email_info['date'])
+            email_info['arrived_at'] = parse_internaldate(response['attributes'])
+            email_info['detected_at'] = time.time()
             
-            self.logger.debug(f"Searching with criteria: {search_criteria}")
+            new_bookeo_emails.append(email_info)
+            text_part = find_text_part(parse_bodystructure(response['attributes']))
+            if text_part:
+                parts_by_section.setdefault(text_part['section'], []).append((email_info, text_part))
+        
+        pipeline_latency.observe('parse', time.perf_counter() - start)
+        return new_bookeo_emails, parts_by_section
+    
+    def apply_body_responses(self, body_data, entries):
+        """Decode a partial body FETCH response into the matching emails"""
+        start = time.perf_counter()
+        by_uid = {email_info['uid']: (email_info, text_part) for email_info, text_part in entries}
+        
+        for response in iter_fetch_responses(body_data):
+            if response['uid'] not in by_uid:
+                continue
             
-            # Perform search
-            status, messages = self.connection.search(None, search_criteria)
+            email_info, text_part = by_uid[response['uid']]
+            raw_body = next(iter(response['literals'].values()), b'')
+            self.bytes_downloaded += len(raw_body)
+            
+            body = decode_partial_body(raw_body, text_part['encoding'], text_part['charset'])
+            email_info['body'] = body[:BODY_PREVIEW_CHARS]
+        
+        pipeline_latency.observe('parse', time.perf_counter() - start)
+    
+    def fetch_batch_commands(self, uids, incremental):
+        """Fetch and parse one batch of UIDs, returning None if processing failed
+        
+        Headers and BODYSTRUCTURE come first; only messages that pass the
+        Bookeo filters then have the start of their text/plain part fetched.
+        BODY.PEEK never sets \\Seen on the operator's mail. A command
+        generator, like check_commands.
+        """
+        try:
+            uid_set = compress_uid_set(uids)
+            with pipeline_latency.timer('fetch'):
+                status, header_data = yield ('FETCH', uid_set, HEADER_FETCH_ITEMS)
             
             if status != 'OK':
-                self.logger.error(f"Email search failed: {status}")
-                return new_bookeo_emails
+                self.logger.error(f"Failed to fetch email headers {uid_set}")
+                return None
             
-            # Get list of email IDs
-            email_ids = messages[0].split()
-            self.logger.debug(f"Found {len(email_ids)} potential emails")
+            # Phase 1: filter on headers alone and locate each text/plain part
+            new_bookeo_emails, parts_by_section = self.select_new_emails(header_data, incremental)
             
-            # Process each email
-            for email_id in email_ids:
-                try:
-                    # Fetch email
-                    status, email_data = self.connection.fetch(email_id, '(RFC822)')
-                    
-                    if status != 'OK':
-                        self.logger.error(f"Failed to fetch email {email_id}")
-                        continue
-                    
-                    # Parse email
-                    raw_email = email_data[0][1]
-                    email_info = self.parse_email_message(raw_email)
-                    
-                    if email_info is None:
-                        continue
-                    
-                    # Check if it's from Bookeo and is recent
-                    if self.is_from_bookeo(email_info) and self.is_recent_email(email_info):
-                        new_bookeo_emails.append(email_info)
-                        self.logger.info(f"Found new Bookeo email: {email_info['subject']}")
+            # Phase 2: fetch a bounded prefix of the text part, one FETCH per section
+            for section, entries in parts_by_section.items():
+                body_set = compress_uid_set(email_info['uid'] for email_info, _ in entries)
+                with pipeline_latency.timer('fetch'):
+                    status, body_data = yield ('FETCH', body_set, body_fetch_items(section))
                 
-                except Exception as e:
-                    self.logger.error(f"Error processing email {email_id}: {str(e)}")
-                    continue
+                if status != 'OK':
+                    self.logger.error(f"Failed to fetch email bodies {body_set}")
+                    return None
+                
+                self.apply_body_responses(body_data, entries)
+            
+            # Booking numbers are only known once the body is in
+            new_bookeo_emails = self.dedup.filter_new(new_bookeo_emails)
             
-            # Update last check time
-            self.last_check_time = datetime.now()
+            for email_info in new_bookeo_emails:
+                self.logger.info(
+                    "Found new Bookeo email: %s", email_info['subject'], extra={'uid': email_info.get('uid')}
+                )
             
+            return new_bookeo_emails
+        
         except Exception as e:
-            self.logger.error(f"Error checking for Bookeo emails: {str(e)}")
+            self.logger.error(f"Error processing fetched emails: {str(e)}")
+            return None
+    
+    def check_commands(self, session):
+        """Search and fetch one check of a selected session
         
-        finally:
-            self.disconnect_from_mailbox()
+        A generator shared by both engines: it yields the arguments of each
+        UID command, e.g. ('SEARCH', None, criteria), expects the command's
+        (status, data) result to be sent back and returns the arguments for
+        commit_new_emails, or None if the search failed. The engines only run
+        the commands (see run_commands) and the commit.
+        """
+        new_bookeo_emails = []
+        
+        # This search covers any mail announced so far
+        session.new_mail_seen = False
+        
+        uidvalidity = session.uidvalidity
+        search_criteria, incremental = self.build_search_criteria(uidvalidity)
+        
+        self.logger.debug("Searching with criteria: %s", search_criteria, extra={'stage': 'search'})
+        
+        # Perform search
+        with pipeline_latency.timer('search'):
+            status, messages = yield ('SEARCH', None, search_criteria)
         
-        return new_bookeo_emails
+        if status != 'OK':
+            self.logger.error(f"Email search failed: {status}")
+            return None
+        
+        uids = self.parse_search_response(messages, incremental)
+        
+        # Everything below UIDNEXT at SELECT time was covered by this search
+        high_water_mark = (session.uidnext - 1) if session.uidnext else 0
+        
+        # Fetch in batches with compressed UID sets per FETCH; stop at the
+        # first failure so the checkpoint never moves past a message that
+        # was not processed
+        for batch_start in range(0, len(uids), FETCH_BATCH_SIZE):
+            batch = uids[batch_start:batch_start + FETCH_BATCH_SIZE]
+            
+            batch_emails = yield from self.fetch_batch_commands(batch, incremental)
+            if batch_emails is None:
+                high_water_mark = min(high_water_mark, batch[0] - 1)
+                break
+            new_bookeo_emails.extend(batch_emails)
+            
+            # UIDs missing from the response were expunged in the meantime
+            high_water_mark = max(high_water_mark, batch[-1])
+        
+        return new_bookeo_emails, uidvalidity, high_water_mark
+    
+    def commit_new_emails(self, emails, uidvalidity, high_water_mark):
+        """Hand new emails to the alert handler, then mark them processed; returns the emails
+        
+        The handler records the alerts durably; only after it returns are the
+        emails added to the dedup store and the checkpoint advanced, so a
+        crash or error in between finds them again rather than losing alerts.
+        """
+        for email_info in emails:
+            if email_info.get('arrived_at'):
+                if email_info.get('sent_at'):
+                    pipeline_latency.observe('delivery', email_info['arrived_at'] - email_info['sent_at'])
+                pipeline_latency.observe('detection', email_info['detected_at'] - email_info['arrived_at'])
+        
+        if emails and self.alert_handler:
+            with pipeline_latency.timer('enqueue'):
+                self.alert_handler(self, emails)
+        
+        self.dedup.commit(emails)
+        self.poll_scheduler.record_poll(len(emails))
+        if uidvalidity is not None and high_water_mark > 0:
+            self.checkpoint.advance(uidvalidity, high_water_mark)
+        
+        self.last_check_time = datetime.now()
+        self.successful_checks += 1
+        LAST_SUCCESSFUL_CHECK.set(time.time(), mailbox=self.config.mailbox_name)
+        return emails
+    
+    def record_check(self, start, successful_checks, imap_connected):
+        """Count and time a check that began at perf_counter() start; it succeeded if it committed"""
+        mailbox = self.config.mailbox_name
+        result = 'ok' if self.successful_checks > successful_checks else 'error'
+        self.consecutive_failures = 0 if result == 'ok' else self.consecutive_failures + 1
+        self.imap_connected = imap_connected
+        self.last_check_completed_at = time.time()
+        duration = time.perf_counter() - start
+        CYCLES.inc(mailbox=mailbox, result=result)
+        CYCLE_DURATION.observe(duration, mailbox=mailbox)
+        self.logger.debug("Check of %s finished (%s) in %.3fs", mailbox, result, duration,
+                          extra={'stage': 'check', 'duration': duration})
+    
+    @contextmanager
+    def tracked_check(self, session):
+        """Log context, metrics and health heartbeat around one check of session"""
+        start = time.perf_counter()
+        successful_checks = self.successful_checks
+        log_token = push_log_context(cycle_id=next(CHECK_IDS), mailbox=self.config.mailbox_name)
+        try:
+            yield
+        finally:
+            self.record_check(start, successful_checks, session.connection is not None)
+            pop_log_context(log_token)
+    
+    def discard_new_emails(self):
+        """Abandon a check that failed before its emails were committed"""
+        self.dedup.release_pending()
+        return []
+    
+    def check_for_bookeo_emails(self):
+        """Check mailbox for new emails from Bookeo"""
+        with self.tracked_check(self.session):
+            try:
+                # Reuse the persistent session, reconnecting only if it is gone
+                self.connection = self.session.acquire()
+                if self.connection is None:
+                    return []
+                
+                checked = run_commands(self.check_commands(self.session), self.connection.uid)
+                return self.commit_new_emails(*checked) if checked else []
+            
+            except (imaplib.IMAP4.abort, OSError) as e:
+                self.logger.error(f"IMAP connection lost while checking for Bookeo emails: {str(e)}")
+                self.session.invalidate()
+                self.connection = None
+                return self.discard_new_emails()
+            
+            except Exception as e:
+                self.logger.error(f"Error checking for Bookeo emails: {str(e)}")
+                return self.discard_new_emails()
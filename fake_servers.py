@@ -0,0 +1,561 @@
+"""
+In-process stand-in servers for exercising the monitor without real mailboxes
+"""
+
+import imaplib
+import json
+import re
+import socketserver
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from email.message import EmailMessage
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+import email
+import email.utils
+
+def generate_bookeo_message(index, sender="noreply@bookeo.com", html_size=8000, sent_at=None,
+                            subject=None, message_id=None):
+    """Build a raw Bookeo-like booking email with a text and an HTML alternative
+    
+    subject and message_id replace the "New booking" defaults, e.g. for change emails.
+    """
+    sent_at = sent_at or datetime.now(timezone.utc)
+    booking_number = 3100000 + index
+    
+    text_body = (
+        f"A new booking has been made.\n"
+        f"\n"
+        f"Booking number: {booking_number}\n"
+        f"Date: {(sent_at + timedelta(days=index % 14)).strftime('%A, %B %d, %Y')}\n"
+        f"Time: {6 + index % 5}:00 PM\n"
+        f"Game: {['The Lab', 'Heist', 'Cursed Cabin', 'Escape Room 101'][index % 4]}\n"
+        f"Participants: {2 + index % 7} people\n"
+        f"Total price: ${(2 + index % 7) * 35}.00\n"
+        f"\n"
+        f"Customer Jordan Sample {index}\n"
+        f"Email: customer{index}@example.com\n"
+        f"Phone (mobile): (925) 555-{1000 + index % 9000}\n"
+    )
+    
+    msg = EmailMessage()
+    msg['From'] = f"Bookeo <{sender}>"
+    msg['To'] = "robot@quantumescapesdanville.com"
+    msg['Subject'] = subject or f"New booking: {booking_number}"
+    msg['Date'] = email.utils.format_datetime(sent_at)
+    msg['Message-ID'] = message_id or f"<booking-{booking_number}-{index}@bookeo.com>"
+    msg.set_content(text_body)
+    html_padding = "<tr><td>Booking details</td></tr>" * max(1, html_size // 35)
+    msg.add_alternative(f"<html><body><table>{html_padding}</table></body></html>", subtype='html')
+    return msg.as_bytes()
+
+class FakeMailbox:
+    """Thread-safe list of (uid, raw message, internal date) shared by all sessions"""
+    
+    def __init__(self, uidvalidity=1):
+        self.uidvalidity = uidvalidity
+        self.uidnext = 1
+        self.messages = []
+        self.condition = threading.Condition()
+    
+    def add_message(self, raw_message, internal_date=None):
+        """Append a message and wake up sessions waiting in IDLE"""
+        with self.condition:
+            uid = self.uidnext
+            self.uidnext += 1
+            self.messages.append((uid, raw_message, internal_date or datetime.now(timezone.utc)))
+            self.condition.notify_all()
+            return uid
+    
+    def snapshot(self):
+        with self.condition:
+            return list(self.messages)
+
+def parse_sequence_set(sequence_set, largest):
+    """Expand an IMAP sequence set such as '3,7,9:15' or '5:*' into a set of numbers"""
+    numbers = set()
+    for part in sequence_set.split(','):
+        if ':' in part:
+            first, last = part.split(':')
+            first = largest if first == '*' else int(first)
+            last = largest if last == '*' else int(last)
+            numbers.update(range(min(first, last), max(first, last) + 1))
+        else:
+            numbers.add(largest if part == '*' else int(part))
+    return numbers
+
+def quote(value):
+    if value is None:
+        return "NIL"
+    return '"' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+def build_bodystructure(part):
+    """Render the BODYSTRUCTURE of an email.message.Message"""
+    if part.is_multipart():
+        children = ''.join(build_bodystructure(child) for child in part.get_payload())
+        return f'({children} {quote(part.get_content_subtype().upper())} ("BOUNDARY" {quote(part.get_boundary())}) NIL NIL)'
+    
+    maintype, subtype = part.get_content_maintype().upper(), part.get_content_subtype().upper()
+    params = ' '.join(f'{quote(name.upper())} {quote(value)}' for name, value in (part.get_params() or [])[1:])
+    encoding = (part.get('Content-Transfer-Encoding') or '7BIT').upper()
+    payload = part.get_payload().encode('utf-8', errors='replace')
+    structure = f'{quote(maintype)} {quote(subtype)} ({params or "NIL"}) NIL NIL {quote(encoding)} {len(payload)}'
+    if maintype == 'TEXT':
+        structure += f' {len(payload.splitlines())}'
+    return f'({structure} NIL NIL NIL)'
+
+def get_section(raw_message, section):
+    """Return the raw (still transfer-encoded) body of a numbered MIME section"""
+    part = email.message_from_bytes(raw_message)
+    for index in section.split('.'):
+        if part.is_multipart():
+            part = part.get_payload()[int(index) - 1]
+        elif index != '1':
+            return b''
+    return part.get_payload().encode('utf-8', errors='replace')
+
+def get_header_fields(raw_message, names):
+    """Return only the named header lines, as BODY[HEADER.FIELDS (...)] does"""
+    header_block = raw_message.split(b'\r\n\r\n', 1)[0].split(b'\n\n', 1)[0]
+    selected, keep = [], False
+    for line in header_block.splitlines():
+        if line[:1] in (b' ', b'\t'):
+            if keep:
+                selected.append(line)
+            continue
+        keep = line.split(b':', 1)[0].strip().upper().decode() in names
+        if keep:
+            selected.append(line)
+    return b''.join(line + b'\r\n' for line in selected) + b'\r\n'
+
+class FakeIMAPHandler(socketserver.StreamRequestHandler):
+    """Speaks the subset of IMAP4rev1 used by EmailMonitor"""
+    
+    # Responses are written in several small chunks
+    disable_nagle_algorithm = True
+    
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        self.server.bytes_sent += len(data)
+        self.wfile.write(data)
+    
+    def handle(self):
+        # Message count this session was last told about
+        self.reported_exists = 0
+        self.write(f"* OK [CAPABILITY {' '.join(self.server.capabilities)}] Fake IMAP server ready\r\n")
+        
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            
+            if self.server.latency:
+                # Simulated network round trip per command
+                time.sleep(self.server.latency)
+            
+            parts = line.decode().rstrip('\r\n').split(' ', 2)
+            tag, command = parts[0], parts[1].upper() if len(parts) > 1 else ''
+            arguments = parts[2] if len(parts) > 2 else ''
+            
+            use_uid = command == 'UID'
+            if use_uid:
+                command, _, arguments = arguments.partition(' ')
+                command = command.upper()
+            
+            self.server.record_command(f"UID {command}" if use_uid else command)
+            
+            handler = getattr(self, f"do_{command}", None)
+            if handler is None:
+                self.write(f"{tag} BAD Unsupported command {command}\r\n")
+                continue
+            
+            if handler(tag, arguments, use_uid) is False:
+                return
+    
+    def do_CAPABILITY(self, tag, arguments, use_uid):
+        self.write(f"* CAPABILITY {' '.join(self.server.capabilities)}\r\n{tag} OK CAPABILITY completed\r\n")
+    
+    def do_LOGIN(self, tag, arguments, use_uid):
+        username, _, password = arguments.partition(' ')
+        if self.server.password is not None and password.strip('"') != self.server.password:
+            self.write(f"{tag} NO [AUTHENTICATIONFAILED] Invalid credentials\r\n")
+        else:
+            self.write(f"{tag} OK LOGIN completed\r\n")
+    
+    def do_SELECT(self, tag, arguments, use_uid):
+        mailbox = self.server.mailbox
+        self.reported_exists = len(mailbox.snapshot())
+        self.write(
+            f"* {self.reported_exists} EXISTS\r\n"
+            f"* 0 RECENT\r\n"
+            f"* OK [UIDVALIDITY {mailbox.uidvalidity}] UIDs valid\r\n"
+            f"* OK [UIDNEXT {mailbox.uidnext}] Predicted next UID\r\n"
+            f"{tag} OK [READ-WRITE] SELECT completed\r\n"
+        )
+    
+    do_EXAMINE = do_SELECT
+    
+    def do_IDLE(self, tag, arguments, use_uid):
+        """RFC 2177: report new messages as EXISTS until the client sends DONE"""
+        if 'IDLE' not in self.server.capabilities:
+            self.write(f"{tag} BAD Unsupported command IDLE\r\n")
+            return
+        
+        mailbox = self.server.mailbox
+        done = threading.Event()
+        
+        # Mail that arrived since the last report is announced right away,
+        # before or after the continuation depending on idle_backlog
+        continuation = "+ idling\r\n"
+        count = len(mailbox.snapshot())
+        if count > self.reported_exists:
+            backlog = f"* {count} EXISTS\r\n"
+            continuation = backlog + continuation if self.server.idle_backlog == 'before' else continuation + backlog
+            self.reported_exists = count
+        
+        def announce_new_mail(known):
+            while not done.is_set():
+                with mailbox.condition:
+                    mailbox.condition.wait_for(lambda: done.is_set() or len(mailbox.messages) > known)
+                    count = len(mailbox.messages)
+                if count > known and not done.is_set():
+                    known = self.reported_exists = count
+                    self.write(f"* {count} EXISTS\r\n")
+        
+        self.write(continuation)
+        watcher = threading.Thread(target=announce_new_mail, args=(self.reported_exists,), daemon=True)
+        watcher.start()
+        line = self.rfile.readline()
+        done.set()
+        with mailbox.condition:
+            mailbox.condition.notify_all()
+        watcher.join()
+        
+        if not line:
+            return False
+        if line.strip().upper() != b'DONE':
+            self.write(f"{tag} BAD Expected DONE\r\n")
+            return
+        self.write(f"{tag} OK IDLE terminated\r\n")
+    
+    def do_NOOP(self, tag, arguments, use_uid):
+        self.reported_exists = len(self.server.mailbox.snapshot())
+        self.write(f"* {self.reported_exists} EXISTS\r\n{tag} OK NOOP completed\r\n")
+    
+    def do_SEARCH(self, tag, arguments, use_uid):
+        messages = self.server.mailbox.snapshot()
+        uid_range = re.search(r'UID (\S+)', arguments)
+        # Several FROM keys only appear OR-ed together in the monitor's searches
+        senders = [sender.lower().encode() for sender in re.findall(r'FROM "([^"]*)"', arguments)]
+        
+        wanted = None
+        if uid_range and messages:
+            wanted = parse_sequence_set(uid_range.group(1), messages[-1][0])
+        
+        results = []
+        for sequence, (uid, raw_message, _) in enumerate(messages, 1):
+            if wanted is not None and uid not in wanted:
+                continue
+            if senders and not any(sender in raw_message[:2000].lower() for sender in senders):
+                continue
+            results.append(uid if use_uid else sequence)
+        
+        self.write(f"* SEARCH {' '.join(map(str, results))}\r\n".replace(' \r\n', '\r\n'))
+        self.write(f"{tag} OK SEARCH completed\r\n")
+    
+    def do_FETCH(self, tag, arguments, use_uid):
+        sequence_set, _, items = arguments.partition(' ')
+        messages = self.server.mailbox.snapshot()
+        if not messages:
+            self.write(f"{tag} OK FETCH completed\r\n")
+            return
+        
+        largest = messages[-1][0] if use_uid else len(messages)
+        wanted = parse_sequence_set(sequence_set, largest)
+        self.server.fetch_commands += 1
+        
+        for sequence, (uid, raw_message, internal_date) in enumerate(messages, 1):
+            if (uid if use_uid else sequence) not in wanted:
+                continue
+            
+            response = f"* {sequence} FETCH (UID {uid}".encode()
+            if 'INTERNALDATE' in items:
+                response += f' INTERNALDATE "{internal_date.strftime("%d-%b-%Y %H:%M:%S %z")}"'.encode()
+            if 'RFC822.SIZE' in items:
+                response += f" RFC822.SIZE {len(raw_message)}".encode()
+            if 'BODYSTRUCTURE' in items:
+                response += f" BODYSTRUCTURE {build_bodystructure(email.message_from_bytes(raw_message))}".encode()
+            if re.search(r'RFC822(?![.\w])', items):
+                response += f" RFC822 {{{len(raw_message)}}}\r\n".encode() + raw_message
+            
+            header_fields = re.search(r'BODY(?:\.PEEK)?\[HEADER\.FIELDS \(([^)]*)\)\]', items)
+            if header_fields:
+                names = header_fields.group(1).upper()
+                literal = get_header_fields(raw_message, names.split())
+                response += f" BODY[HEADER.FIELDS ({names})] {{{len(literal)}}}\r\n".encode() + literal
+            
+            body_section = re.search(r'BODY(?:\.PEEK)?\[([\d.]+)\](?:<(\d+)\.(\d+)>)?', items)
+            if body_section:
+                section, offset, length = body_section.groups()
+                literal = get_section(raw_message, section)
+                item = f"BODY[{section}]"
+                if offset is not None:
+                    literal = literal[int(offset):int(offset) + int(length)]
+                    item += f"<{offset}>"
+                response += f" {item} {{{len(literal)}}}\r\n".encode() + literal
+            response += b")\r\n"
+            self.write(response)
+        
+        self.write(f"{tag} OK FETCH completed\r\n")
+    
+    def do_CLOSE(self, tag, arguments, use_uid):
+        self.write(f"{tag} OK CLOSE completed\r\n")
+    
+    def do_LOGOUT(self, tag, arguments, use_uid):
+        self.write(f"* BYE Logging out\r\n{tag} OK LOGOUT completed\r\n")
+        return False
+
+class FakeIMAPServer(socketserver.ThreadingTCPServer):
+    """Plain-text IMAP server on localhost backed by a FakeMailbox
+    
+    Supports LOGIN (checked against password when one is given), SELECT,
+    SEARCH, FETCH and their UID forms, and IDLE when it is listed in
+    capabilities. latency is added to every command. Mail a session has not
+    been told about when it starts IDLE is announced in the same write as the
+    continuation, 'before' or 'after' it per idle_backlog.
+    """
+    
+    allow_reuse_address = True
+    daemon_threads = True
+    
+    def __init__(self, mailbox=None, latency=0.0, capabilities=("IMAP4rev1",), password=None, idle_backlog='before'):
+        super().__init__(('127.0.0.1', 0), FakeIMAPHandler)
+        self.mailbox = mailbox or FakeMailbox()
+        self.latency = latency
+        self.capabilities = list(capabilities)
+        self.password = password
+        self.idle_backlog = idle_backlog
+        self.commands = []
+        self.fetch_commands = 0
+        self.bytes_sent = 0
+        self.thread = None
+    
+    @property
+    def port(self):
+        return self.server_address[1]
+    
+    def record_command(self, command):
+        self.commands.append(command)
+    
+    def reset_counters(self):
+        self.commands = []
+        self.fetch_commands = 0
+        self.bytes_sent = 0
+    
+    def start(self):
+        """Serve in a background thread"""
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+    
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+    
+    def connect(self, username="robot@quantumescapesdanville.com", password="password"):
+        """Return a logged-in imaplib connection, usable as a MailboxSession connector"""
+        connection = imaplib.IMAP4('127.0.0.1', self.port)
+        connection.login(username, password)
+        return connection
+    
+    async def connect_async(self, username="robot@quantumescapesdanville.com", password="password"):
+        """Return a logged-in AsyncIMAPClient, usable as an AsyncMailboxSession connector"""
+        from async_engine import AsyncIMAPClient
+        
+        client = await AsyncIMAPClient.connect('127.0.0.1', self.port, tls=None)
+        await client.login(username, password)
+        return client
+
+class FakeTwilioHandler(BaseHTTPRequestHandler):
+    """Speaks the parts of the Twilio REST API used by SMSSender, with keep-alive"""
+    
+    protocol_version = "HTTP/1.1"
+    
+    # Headers and body go out in separate writes; don't let Nagle hold the body back
+    disable_nagle_algorithm = True
+    
+    ACCOUNT_RE = re.compile(r'^/2010-04-01/Accounts/(\w+)\.json$')
+    MESSAGES_RE = re.compile(r'^/2010-04-01/Accounts/(\w+)/Messages\.json$')
+    
+    def setup(self):
+        # Like Twilio's edge, close connections left idle too long
+        self.timeout = self.server.idle_timeout
+        super().setup()
+        self.server.record_connection()
+        if self.server.connect_latency:
+            # Simulated TCP and TLS handshakes, paid once per connection
+            time.sleep(self.server.connect_latency)
+    
+    def send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def send_error_json(self, status, code, message, headers=None):
+        self.send_json(status, {'code': code, 'message': message, 'more_info': '', 'status': status}, headers)
+    
+    def handle_request(self):
+        if self.server.latency:
+            # Simulated network round trip per request
+            time.sleep(self.server.latency)
+        self.server.requests += 1
+    
+    def do_GET(self):
+        self.handle_request()
+        url = urlsplit(self.path)
+        
+        account = self.ACCOUNT_RE.match(url.path)
+        if account:
+            self.send_json(200, {'sid': account.group(1), 'friendly_name': 'Fake Twilio account', 'status': 'active'})
+            return
+        
+        messages = self.MESSAGES_RE.match(url.path)
+        if messages:
+            query = parse_qs(url.query)
+            to_number = query.get('To', [None])[0]
+            from_number = query.get('From', [None])[0]
+            page_size = int(query.get('PageSize', ['50'])[0])
+            matching = [
+                message for message in reversed(self.server.snapshot())
+                if (to_number is None or message['to'] == to_number)
+                and (from_number is None or message['from'] == from_number)
+            ]
+            self.send_json(200, {
+                'messages': matching[:page_size],
+                'page': 0,
+                'page_size': page_size,
+                'first_page_uri': url.path,
+                'next_page_uri': None,
+                'previous_page_uri': None,
+                'uri': url.path,
+                'start': 0,
+                'end': min(len(matching), page_size),
+            })
+            return
+        
+        self.send_error_json(404, 20404, 'The requested resource was not found')
+    
+    def do_POST(self):
+        self.handle_request()
+        length = int(self.headers.get('Content-Length') or 0)
+        form = {name: values[0] for name, values in parse_qs(self.rfile.read(length).decode()).items()}
+        
+        messages = self.MESSAGES_RE.match(urlsplit(self.path).path)
+        if not messages:
+            self.send_error_json(404, 20404, 'The requested resource was not found')
+            return
+        
+        retry_after = self.server.admit(form.get('From'))
+        if retry_after is not None:
+            self.send_error_json(429, 20429, 'Too Many Requests', {'Retry-After': retry_after})
+            return
+        
+        self.send_json(201, self.server.record_message(messages.group(1), form))
+    
+    def log_message(self, format, *args):
+        # Keep benchmark and smoke-test output clean
+        pass
+
+class FakeTwilioServer(ThreadingHTTPServer):
+    """Local stand-in for api.twilio.com, for SMSSender via TWILIO_API_BASE_URL
+    
+    At most rate_limit messages per sender number are accepted per second;
+    the rest get a 429 with a Retry-After of retry_after seconds, like
+    Twilio's concurrency and throughput limits. latency is added to every
+    request and connect_latency to the first request on each connection;
+    connections idle for idle_timeout seconds are closed.
+    """
+    
+    daemon_threads = True
+    
+    def __init__(self, rate_limit=None, retry_after="1", latency=0.0, connect_latency=0.0, idle_timeout=None):
+        super().__init__(('127.0.0.1', 0), FakeTwilioHandler)
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.latency = latency
+        self.connect_latency = connect_latency
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.messages = []
+        self.recent_sends = {}
+        self.thread = None
+        self.reset_counters()
+    
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+    
+    def reset_counters(self):
+        self.requests = 0
+        self.connections = 0
+        self.rejected = 0
+    
+    def record_connection(self):
+        with self.lock:
+            self.connections += 1
+    
+    def admit(self, from_number):
+        """None if a send from this number is accepted now, otherwise the Retry-After value"""
+        if self.rate_limit is None:
+            return None
+        
+        now = time.monotonic()
+        with self.lock:
+            sends = self.recent_sends.setdefault(from_number, deque())
+            while sends and now - sends[0] >= 1.0:
+                sends.popleft()
+            if len(sends) >= self.rate_limit:
+                self.rejected += 1
+                return self.retry_after
+            sends.append(now)
+            return None
+    
+    def record_message(self, account_sid, form):
+        with self.lock:
+            sid = f"SM{len(self.messages) + 1:032x}"
+            message = {
+                'sid': sid,
+                'account_sid': account_sid,
+                'to': form.get('To'),
+                'from': form.get('From'),
+                'body': form.get('Body', ''),
+                'status': 'queued',
+                'num_segments': '1',
+                'direction': 'outbound-api',
+                'date_created': email.utils.format_datetime(datetime.now(timezone.utc), usegmt=True),
+                'uri': f"/2010-04-01/Accounts/{account_sid}/Messages/{sid}.json",
+            }
+            self.messages.append(message)
+            return message
+    
+    def snapshot(self):
+        with self.lock:
+            return list(self.messages)
+    
+    def start(self):
+        """Serve in a background thread"""
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+    
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,54 @@
+"""
+Helpers that wire the agent to the fake IMAP and Twilio servers, shared by the
+pytest suite and benchmarks.py
+"""
+
+import logging
+import os
+
+from config import Config
+from email_monitor import EmailMonitor
+from sms_sender import SMSSender
+
+TWILIO_ENV = ('TWILIO_ACCOUNT_SID', 'TWILIO_AUTH_TOKEN', 'TWILIO_PHONE_NUMBER', 'TWILIO_API_BASE_URL')
+
+def make_logger(level=logging.WARNING):
+    """Quiet logger so log I/O does not distort the timings"""
+    logger = logging.getLogger("OfflineHarness")
+    logger.setLevel(level)
+    if not logger.handlers:
+        logger.addHandler(logging.StreamHandler())
+    return logger
+
+def make_monitor(server, logger, state_dir=None):
+    """EmailMonitor wired to a fake IMAP server
+    
+    Without state_dir nothing is persisted; with it the UID checkpoint and the
+    dedup store live there, so a second monitor on the same directory sees
+    what a restarted agent would.
+    """
+    config = Config()
+    config.uid_state_file = os.path.join(state_dir, "uid_checkpoint.json") if state_dir else None
+    config.dedup_store_file = os.path.join(state_dir, "processed_emails.log") if state_dir else None
+    config.discovery_cache_file = None
+    config.poll_history_file = None
+    monitor = EmailMonitor(config, logger)
+    monitor.session.connector = server.connect
+    return monitor
+
+def make_twilio_sender(server, logger, rate, burst):
+    """SMSSender talking to a fake Twilio endpoint"""
+    os.environ.update({
+        'TWILIO_ACCOUNT_SID': 'AC' + '0' * 32,
+        'TWILIO_AUTH_TOKEN': 'benchmark',
+        'TWILIO_PHONE_NUMBER': '+15550000000',
+        'TWILIO_API_BASE_URL': server.base_url,
+    })
+    config = Config()
+    config.sms_rate_limit = rate
+    config.sms_rate_burst = burst
+    return SMSSender(config, logger), config
+
+def clear_twilio_env():
+    for name in TWILIO_ENV:
+        os.environ.pop(name, None)
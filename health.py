@@ -0,0 +1,127 @@
+"""
+Watchdog that turns the agent's heartbeats into a precomputed /health snapshot
+"""
+
+import json
+import threading
+import time
+
+class HealthWatchdog:
+    """Recomputes liveness and readiness every interval seconds
+    
+    start() refreshes on a thread of its own; the asyncio engine calls
+    refresh() from a task on its event loop instead.
+    
+    Live: every mailbox has completed a check, successful or not, within its
+    expected gap (the polling interval, or the IDLE timeout while its monitor
+    actually waits in IDLE) plus stall_timeout, and the SMS worker threads are
+    running. A monitor stuck in a blocking IMAP call stops completing checks,
+    so /health turns into a 503 and Render restarts the process.
+    
+    Ready: live, the last check of every mailbox succeeded and left its IMAP
+    session open, and the SMS backlog is within max_sms_backlog alerts and
+    max_sms_age seconds.
+    
+    Probes only read the last snapshot, so they never wait on IMAP, Twilio or
+    the outbox; a snapshot that stops being refreshed reads as not live.
+    """
+    
+    def __init__(self, email_monitors, sms_dispatcher, outbox, config, logger, interval=5):
+        self.email_monitors = email_monitors
+        self.sms_dispatcher = sms_dispatcher
+        self.outbox = outbox
+        self.logger = logger
+        self.interval = interval
+        self.stall_timeout = config.health_stall_timeout
+        self.max_sms_backlog = config.health_max_sms_backlog
+        self.max_sms_age = config.health_max_sms_age
+        self.idle_timeout = config.idle_timeout
+        self.started_at = time.time()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.snapshot = None
+        self.refresh()
+    
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="health-watchdog", daemon=True)
+        self.thread.start()
+    
+    def stop(self):
+        self.stop_event.set()
+    
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            self.refresh()
+    
+    def mailbox_health(self, monitor, now):
+        last_completed = monitor.last_check_completed_at or self.started_at
+        expected_gap = monitor.poll_scheduler.next_interval(now)
+        if monitor.using_idle:
+            expected_gap = max(expected_gap, self.idle_timeout)
+        overdue = now - last_completed - expected_gap
+        return {
+            'name': monitor.config.mailbox_name,
+            'live': overdue <= self.stall_timeout,
+            'ready': monitor.consecutive_failures == 0 and monitor.imap_connected and monitor.successful_checks > 0,
+            'last_check_age': round(now - monitor.last_check_completed_at, 1) if monitor.last_check_completed_at else None,
+            'overdue_seconds': round(max(0.0, overdue), 1),
+            'consecutive_failures': monitor.consecutive_failures,
+            'imap_session': 'open' if monitor.imap_connected else 'closed',
+        }
+    
+    def sms_health(self, now):
+        pending, oldest_created_at = self.outbox.backlog()
+        oldest_age = now - oldest_created_at if oldest_created_at else 0.0
+        workers = self.sms_dispatcher.workers
+        return {
+            'live': all(worker.is_alive() for worker in workers),
+            'ready': pending <= self.max_sms_backlog and oldest_age <= self.max_sms_age,
+            'backlog': pending,
+            'oldest_pending_age': round(oldest_age, 1),
+            'queue_depth': self.sms_dispatcher.queue.qsize(),
+            'workers': sum(worker.is_alive() for worker in workers),
+        }
+    
+    def refresh(self):
+        """Recompute the snapshot from the monitors' and dispatcher's heartbeats"""
+        now = time.time()
+        try:
+            mailboxes = [self.mailbox_health(monitor, now) for monitor in self.email_monitors]
+            sms = self.sms_health(now)
+            live = sms['live'] and all(mailbox['live'] for mailbox in mailboxes)
+            ready = live and sms['ready'] and all(mailbox['ready'] for mailbox in mailboxes)
+            status = 'ok' if ready else 'degraded' if live else 'stalled'
+            body = {
+                'status': status,
+                'live': live,
+                'ready': ready,
+                'uptime': round(now - self.started_at, 1),
+                'generated_at': round(now, 3),
+                'mailboxes': mailboxes,
+                'sms': sms,
+            }
+        except Exception as e:
+            self.logger.error(f"Error computing health snapshot: {str(e)}")
+            live = ready = False
+            body = {'status': 'error', 'live': False, 'ready': False, 'error': str(e), 'generated_at': round(now, 3)}
+        
+        if self.snapshot is not None and live != self.snapshot[1]:
+            self.logger.warning(f"Health changed to {body['status']}: {json.dumps(body)}")
+        
+        # Replaced as a whole, so readers never see a half-built snapshot
+        self.snapshot = (now, live, ready, json.dumps(body).encode('utf-8'))
+    
+    def response(self, readiness=False):
+        """(status code, content type, body) from the last snapshot"""
+        generated_at, live, ready, body = self.snapshot
+        if time.time() - generated_at > max(3 * self.interval, 30):
+            # The watchdog itself has stopped
+            live = ready = False
+        healthy = ready if readiness else live
+        return (200 if healthy else 503), 'application/json', body
+    
+    def health_route(self):
+        return self.response()
+    
+    def ready_route(self):
+        return self.response(readiness=True)
@@ -0,0 +1,135 @@
+"""
+Latency histograms for each stage between Bookeo sending an email and Twilio accepting its SMS
+"""
+
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# Bucket upper bounds in seconds, from 1 ms up to an hour
+LATENCY_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0,
+    60.0, 120.0, 300.0, 600.0, 1800.0, 3600.0,
+)
+
+# Stages in pipeline order. The first two compare clocks on different hosts
+# and the last three include time spent in the outbox, so they overlap the rest.
+PIPELINE_STAGES = {
+    'delivery': "Date header to IMAP arrival (INTERNALDATE): Bookeo and mail transport",
+    'detection': "IMAP arrival to the check that found the email: polling or IDLE delay",
+    'search': "UID SEARCH round trip",
+    'fetch': "one UID FETCH round trip (headers or text part)",
+    'parse': "decoding one FETCH response into emails",
+    'extract': "booking details extracted from one email body",
+    'enqueue': "building and durably recording the alerts found by one check",
+    'outbox': "alert recorded to SMS accepted: coalescing, queueing, rate limiting, retries",
+    'send': "Twilio API call that accepted the SMS",
+    'arrival_to_sms': "IMAP arrival to SMS accepted",
+    'end_to_end': "Date header to SMS accepted",
+}
+
+class LatencyHistogram:
+    """Counts of observations per bucket; percentiles are interpolated within a bucket"""
+    
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is everything above the top bound
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.lock = threading.Lock()
+    
+    def observe(self, seconds):
+        # Clock skew between hosts can make a cross-host stage slightly negative
+        seconds = max(0.0, seconds)
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self.lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += seconds
+            self.max = max(self.max, seconds)
+    
+    def snapshot(self):
+        """(bucket counts, count, sum, max) read together"""
+        with self.lock:
+            return list(self.counts), self.count, self.sum, self.max
+    
+    def percentile(self, fraction, snapshot=None):
+        counts, count, _, maximum = snapshot or self.snapshot()
+        if not count:
+            return 0.0
+        
+        target = fraction * count
+        cumulative = 0
+        for index, bucket_count in enumerate(counts):
+            if bucket_count and cumulative + bucket_count >= target:
+                lower = self.buckets[index - 1] if index else 0.0
+                upper = min(self.buckets[index], maximum) if index < len(self.buckets) else maximum
+                return lower + (upper - lower) * (target - cumulative) / bucket_count
+            cumulative += bucket_count
+        return maximum
+    
+    def get_stats(self):
+        snapshot = self.snapshot()
+        _, count, total, maximum = snapshot
+        return {
+            'count': count,
+            'mean': total / count if count else 0.0,
+            'p50': self.percentile(0.5, snapshot),
+            'p90': self.percentile(0.9, snapshot),
+            'p99': self.percentile(0.99, snapshot),
+            'max': maximum,
+        }
+
+class PipelineLatency:
+    """One LatencyHistogram per pipeline stage, shared by every mailbox and sender"""
+    
+    def __init__(self, stages=PIPELINE_STAGES):
+        self.histograms = {stage: LatencyHistogram() for stage in stages}
+    
+    def observe(self, stage, seconds):
+        self.histograms[stage].observe(seconds)
+    
+    @contextmanager
+    def timer(self, stage):
+        """Observe the duration of the with block, whether or not it raises"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.histograms[stage].observe(time.perf_counter() - start)
+    
+    def reset(self):
+        for stage in self.histograms:
+            self.histograms[stage] = LatencyHistogram()
+    
+    def get_stats(self):
+        """Percentiles in seconds for every stage observed so far"""
+        stats = {}
+        for stage, histogram in self.histograms.items():
+            stage_stats = histogram.get_stats()
+            if stage_stats['count']:
+                stats[stage] = {name: round(value, 4) for name, value in stage_stats.items()}
+        return stats
+    
+    def format_table(self):
+        """Human-readable percentiles per stage, for logs and benchmarks"""
+        lines = [f"{'stage':>15} {'count':>6} {'p50':>9} {'p90':>9} {'p99':>9} {'max':>9}"]
+        for stage, stats in self.get_stats().items():
+            lines.append(
+                f"{stage:>15} {stats['count']:>6} " + ' '.join(
+                    format_seconds(stats[name]).rjust(9) for name in ('p50', 'p90', 'p99', 'max')
+                )
+            )
+        return '\n'.join(lines)
+
+def format_seconds(seconds):
+    if seconds < 0.001:
+        return f"{seconds * 1000000:.0f}us"
+    if seconds < 1:
+        return f"{seconds * 1000:.1f}ms"
+    return f"{seconds:.1f}s"
+
+# Shared by the monitors, the SMS dispatcher and the asyncio engine
+pipeline_latency = PipelineLatency()
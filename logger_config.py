@@ -2,20 +2,163 @@
 Logging configuration for the email monitoring agent
 """
 
+import atexit
+import contextvars
+import copy
+import json
 import logging
 import logging.handlers
 import os
-from datetime import datetime
+import queue
+from datetime import datetime, timezone
 
-def setup_logger(name="EmailMonitor", log_level="INFO", log_file="email_monitor.log"):
-    """Setup and configure logger with both file and console handlers"""
+# Typed fields a record may carry, via extra= or the current log context
+STRUCTURED_FIELDS = {
+    'cycle_id': int,
+    'mailbox': str,
+    'stage': str,
+    'duration': float,
+    'uid': int,
+    'booking_number': str,
+}
+
+# Formats tracebacks before records cross the logging queue
+TRACEBACK_FORMATTER = logging.Formatter()
+
+# Fields added to every record logged in the current thread or asyncio task
+log_context = contextvars.ContextVar('log_context', default={})
+
+def push_log_context(**fields):
+    """Add fields to the current context's records; returns a token for pop_log_context"""
+    return log_context.set({**log_context.get(), **fields})
+
+def pop_log_context(token):
+    log_context.reset(token)
+
+class LogContextFilter(logging.Filter):
+    """Copies the current log context onto each record, on the thread that logged it"""
+    
+    def filter(self, record):
+        for name, value in log_context.get().items():
+            if not hasattr(record, name):
+                setattr(record, name, value)
+        return True
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: time, level, logger, message and any structured fields"""
+    
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for name, field_type in STRUCTURED_FIELDS.items():
+            value = getattr(record, name, None)
+            if value is not None:
+                try:
+                    entry[name] = round(value, 6) if field_type is float else field_type(value)
+                except (TypeError, ValueError):
+                    entry[name] = str(value)
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            # Formatted by BoundedQueueHandler.prepare before the record was queued
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+class LazyValue:
+    """Log argument computed only if the record is formatted, e.g. LazyValue(dispatcher.get_stats)"""
+    
+    def __init__(self, function, *args):
+        self.function = function
+        self.args = args
+    
+    def __str__(self):
+        return str(self.function(*self.args))
+
+class BoundedQueueHandler(logging.handlers.QueueHandler):
+    """Hands records to a QueueListener thread through a bounded queue
     
+    When the queue is full, overflow='block' waits for room; overflow='drop'
+    discards DEBUG and INFO records (counting them, and reporting the count
+    once there is room again) but still waits for warnings and errors.
+    """
+    
+    def __init__(self, log_queue, overflow='drop'):
+        super().__init__(log_queue)
+        self.overflow = overflow
+        self.listener = None
+        self.dropped = 0
+        self.reported = 0
+    
+    def prepare(self, record):
+        """Merge the arguments into the message, keeping the traceback in exc_text
+        
+        The base class appends the traceback to the message and drops
+        exc_info, so the JSON formatter could no longer report it apart.
+        Text formatters still append exc_text to the message.
+        """
+        record = copy.copy(record)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = TRACEBACK_FORMATTER.formatException(record.exc_info)
+        record.message = record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None
+        return record
+    
+    def enqueue(self, record):
+        if self.overflow == 'block' or record.levelno >= logging.WARNING:
+            self.queue.put(record)
+        else:
+            try:
+                self.queue.put_nowait(record)
+            except queue.Full:
+                self.dropped += 1
+                return
+        
+        if self.dropped > self.reported:
+            dropped, self.reported = self.dropped - self.reported, self.dropped
+            self.queue.put(self.prepare(logging.makeLogRecord({
+                'name': record.name, 'levelno': logging.WARNING, 'levelname': 'WARNING',
+                'msg': f"Dropped {dropped} log record(s): logging queue full",
+            })))
+
+class BlockingQueueListener(logging.handlers.QueueListener):
+    """QueueListener whose stop() waits for room in a full bounded queue and may be called twice"""
+    
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+    
+    def stop(self):
+        if self._thread is not None:
+            super().stop()
+
+def setup_logger(name="EmailMonitor", log_level="INFO", log_file="email_monitor.log", queue_size=10000,
+                 overflow='drop', log_format='text'):
+    """Setup and configure logger with both file and console handlers
+    
+    The handlers run on a QueueListener thread, so logging calls only put a
+    record on a bounded queue (queue_size records, overflow 'drop' or 'block'
+    when it is full) instead of writing and rotating files on the monitor
+    thread. queue_size=0 attaches the handlers directly.
+    
+    log_format 'json' writes JSON lines with the structured fields instead
+    of text. The agents pass the validated Config values.
+    """
     # Create logger
     logger = logging.getLogger(name)
     logger.setLevel(getattr(logging, log_level.upper(), logging.INFO))
     
-    # Clear existing handlers
+    # Clear existing handlers, flushing a previous listener first
+    for handler in logger.handlers:
+        if isinstance(handler, BoundedQueueHandler) and handler.listener:
+            handler.listener.stop()
     logger.handlers.clear()
+    logger.filters.clear()
+    logger.addFilter(LogContextFilter())
+    handlers = []
     
     # Create formatters
     detailed_formatter = logging.Formatter(
@@ -28,13 +171,17 @@ def setup_logger(name="EmailMonitor", log_level="INFO", log_file="email_monitor.
         datefmt='%H:%M:%S'
     )
     
+    if log_format == 'json':
+        detailed_formatter = console_formatter = JsonFormatter()
+    
     # Create console handler
     console_handler = logging.StreamHandler()
     console_handler.setLevel(logging.INFO)
     console_handler.setFormatter(console_formatter)
-    logger.addHandler(console_handler)
+    handlers.append(console_handler)
     
     # Create file handler with rotation
+    file_error = None
     try:
         file_handler = logging.handlers.RotatingFileHandler(
             log_file,
@@ -44,9 +191,24 @@ def setup_logger(name="EmailMonitor", log_level="INFO", log_file="email_monitor.
         )
         file_handler.setLevel(getattr(logging, log_level.upper(), logging.INFO))
         file_handler.setFormatter(detailed_formatter)
-        logger.addHandler(file_handler)
+        handlers.append(file_handler)
     except Exception as e:
-        logger.error(f"Failed to setup file logging: {str(e)}")
+        file_error = e
+    
+    if queue_size > 0:
+        queue_handler = BoundedQueueHandler(queue.Queue(maxsize=queue_size), overflow)
+        queue_handler.listener = BlockingQueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+        queue_handler.listener.start()
+        
+        # Write out what is still queued when the process exits
+        atexit.register(queue_handler.listener.stop)
+        logger.addHandler(queue_handler)
+    else:
+        for handler in handlers:
+            logger.addHandler(handler)
+    
+    if file_error:
+        logger.error(f"Failed to setup file logging: {str(file_error)}")
     
     # Log startup information
     logger.info("=" * 50)
@@ -54,6 +216,8 @@ def setup_logger(name="EmailMonitor", log_level="INFO", log_file="email_monitor.
     logger.info(f"Start Time: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
     logger.info(f"Log Level: {log_level.upper()}")
     logger.info(f"Log File: {log_file}")
+    logger.info(f"Log Format: {log_format}")
+    logger.info(f"Log Queue: {f'{queue_size} records, {overflow} when full' if queue_size > 0 else 'disabled'}")
     logger.info("=" * 50)
     
     return logger
@@ -0,0 +1,98 @@
+"""
+Mailbox profiles: several monitored mailboxes (one per location) in a single agent
+"""
+
+import copy
+import json
+import os
+import re
+
+from email_monitor import EmailMonitor, ServerDiscoveryCache
+
+class MailboxProfile:
+    """One monitored mailbox with its own sender filters and SMS recipients
+    
+    config is a copy of the agent Config with the mailbox-specific settings
+    replaced, so EmailMonitor needs no knowledge of profiles.
+    """
+    
+    def __init__(self, name, config):
+        self.name = name
+        self.config = config
+    
+    @classmethod
+    def from_dict(cls, entry, base_config):
+        name = entry.get("name") or entry["email_address"]
+        config = copy.copy(base_config)
+        config.mailbox_name = name
+        config.email_address = entry["email_address"]
+        
+        # Keep passwords out of the file by naming an environment variable
+        if entry.get("email_password_env"):
+            config.email_password = os.getenv(entry["email_password_env"])
+        else:
+            config.email_password = entry.get("email_password")
+        
+        config.bookeo_senders = list(entry.get("bookeo_senders") or base_config.bookeo_senders)
+        config.bookeo_sender = config.bookeo_senders[0] if config.bookeo_senders else ""
+        config.target_phone_numbers = list(entry.get("target_phone_numbers") or [])
+        config.target_phone_number = config.target_phone_numbers[0] if config.target_phone_numbers else ""
+        
+        # Each mailbox has its own UIDs and traffic, so each needs its own checkpoint,
+        # dedup log and polling history
+        slug = re.sub(r'[^a-z0-9]+', '_', name.lower()).strip('_')
+        config.uid_state_file = entry.get("uid_state_file", f"uid_checkpoint_{slug}.json")
+        config.dedup_store_file = entry.get("dedup_store_file", f"processed_emails_{slug}.log")
+        config.poll_history_file = entry.get("poll_history_file", f"poll_history_{slug}.json")
+        return cls(name, config)
+    
+    def validate(self):
+        errors = []
+        if not self.config.email_address:
+            errors.append(f"{self.name}: email_address is required")
+        if not self.config.email_password:
+            errors.append(f"{self.name}: email password is not set")
+        if not self.config.bookeo_senders:
+            errors.append(f"{self.name}: at least one Bookeo sender is required")
+        if not self.config.target_phone_numbers:
+            errors.append(f"{self.name}: at least one target phone number is required")
+        return errors
+
+def load_profiles(config, logger):
+    """Load the mailbox profiles, or a single profile from Config when no file is set
+    
+    Returns None if the profiles file cannot be read or is invalid.
+    """
+    if not config.mailbox_profiles_file:
+        return [MailboxProfile(config.mailbox_name, config)]
+    
+    try:
+        with open(config.mailbox_profiles_file) as f:
+            data = json.load(f)
+        
+        entries = data["profiles"] if isinstance(data, dict) else data
+        profiles = [MailboxProfile.from_dict(entry, config) for entry in entries]
+        
+        errors = [error for profile in profiles for error in profile.validate()]
+        names = [profile.name for profile in profiles]
+        if len(set(names)) != len(names):
+            errors.append("mailbox profile names must be unique")
+        if not profiles:
+            errors.append("no mailbox profiles defined")
+        
+        if errors:
+            for error in errors:
+                logger.error(f"Invalid mailbox profile: {error}")
+            return None
+        
+        logger.info(f"Loaded {len(profiles)} mailbox profile(s) from {config.mailbox_profiles_file}")
+        return profiles
+    
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        logger.error(f"Error loading mailbox profiles from {config.mailbox_profiles_file}: {str(e)}")
+        return None
+
+def build_monitors(profiles, config, logger):
+    """Create one EmailMonitor per profile, all sharing the server discovery cache"""
+    discovery_cache = ServerDiscoveryCache(config.discovery_cache_file, logger)
+    return [EmailMonitor(profile.config, logger, discovery_cache) for profile in profiles]
@@ -5,22 +5,41 @@ Monitors robot@quantumescapesdanville.com for emails from noreply@bookeo.com
 and sends SMS alerts when detected.
 """
 
-import time
 import signal
 import sys
+import threading
 from datetime import datetime
-from email_monitor import EmailMonitor
-from sms_sender import SMSSender
-from logger_config import setup_logger
+from latency_metrics import pipeline_latency
+from mailbox_profiles import load_profiles, build_monitors
+from sms_sender import SMSSender, SMSDispatchQueue
+from sms_outbox import SMSOutbox, alert_key
+from logger_config import LazyValue, setup_logger
 from config import Config
 
 class EmailMonitoringAgent:
     def __init__(self):
-        self.logger = setup_logger()
         self.config = Config()
-        self.email_monitor = EmailMonitor(self.config, self.logger)
+        self.logger = setup_logger(
+            log_level=self.config.log_level, log_file=self.config.log_file, queue_size=self.config.log_queue_size,
+            overflow=self.config.log_queue_overflow, log_format=self.config.log_format
+        )
+        self.profiles = load_profiles(self.config, self.logger) or []
+        self.email_monitors = build_monitors(self.profiles, self.config, self.logger)
+        self.email_monitor = self.email_monitors[0] if self.email_monitors else None
+        self.config.resolve_async_engine(len(self.email_monitors))
         self.sms_sender = SMSSender(self.config, self.logger)
+        self.outbox = SMSOutbox(
+            self.config.sms_outbox_file, self.logger, self.config.sms_max_attempts, self.config.sms_retry_delay,
+            self.config.sms_coalesce_window, self.config.sms_coalesce_max_delay
+        )
+        self.sms_dispatcher = SMSDispatchQueue(self.sms_sender, self.outbox, self.config, self.logger)
         self.running = True
+        # Set by signal_handler, so waits between cycles end as soon as a shutdown is requested
+        self.stop_event = threading.Event()
+        
+        # Alerts are recorded before each monitor marks its emails processed
+        for email_monitor in self.email_monitors:
+            email_monitor.alert_handler = self.handle_new_emails
         
         # Setup signal handlers for graceful shutdown
         signal.signal(signal.SIGINT, self.signal_handler)
@@ -30,80 +49,128 @@ class EmailMonitoringAgent:
         """Handle shutdown signals gracefully"""
         self.logger.info(f"Received signal {signum}, shutting down gracefully...")
         self.running = False
+        self.stop_event.set()
+    
+    def build_alert_message(self, email_info):
+        """Create the SMS text for a new Bookeo email"""
+        subject = email_info.get('subject', 'No Subject')
+        sender = email_info.get('from', 'Unknown Sender')
+        received_time = email_info.get('date', 'Unknown Time')
+        
+        # Create SMS message
+        message = (
+            f" New Bookeo Email Alert!\n"
+        #    f"From: {sender}\n"
+        #    f"Subject: {subject}\n"
+        #    f"Time: {received_time}\n"
+        #    f"Check your email for details."
+        )
+        return message
     
-    def process_new_bookeo_emails(self, emails):
-        """Process and send SMS alerts for new Bookeo emails"""
+    def record_alerts(self, emails, recipients=None):
+        """Record one SMS alert per new Bookeo email and recipient in the outbox
+        
+        Returns the keys of the alerts not recorded before. Outbox errors
+        propagate, so the monitor does not mark the emails processed.
+        """
+        recipients = recipients or self.config.target_phone_numbers
+        keys = []
         for email_info in emails:
             try:
                 subject = email_info.get('subject', 'No Subject')
-                sender = email_info.get('from', 'Unknown Sender')
-                received_time = email_info.get('date', 'Unknown Time')
-                
-                # Create SMS message
-                message = (
-                    f" New Bookeo Email Alert!\n"
-                #    f"From: {sender}\n"
-                #    f"Subject: {subject}\n"
-                #    f"Time: {received_time}\n"
-                #    f"Check your email for details."
-                )
-                
-                # Send SMS notification
-                success = self.sms_sender.send_notification(
-                    self.config.target_phone_number,
-                    message
-                )
-                
-                if success:
-                    self.logger.info(f"SMS alert sent successfully for email: {subject}")
-                else:
-                    self.logger.error(f"Failed to send SMS alert for email: {subject}")
-                    
+                message = self.build_alert_message(email_info)
             except Exception as e:
                 self.logger.error(f"Error processing email notification: {str(e)}")
+                continue
+            
+            for recipient in recipients:
+                key = alert_key(email_info, recipient)
+                if self.outbox.add(
+                    key, recipient, message, f"email: {subject}", subject,
+                    email_info.get('sent_at'), email_info.get('arrived_at')
+                ):
+                    keys.append(key)
+        return keys
+    
+    def process_new_bookeo_emails(self, emails, recipients=None):
+        """Record SMS alerts for new Bookeo emails and queue them for the workers"""
+        keys = self.record_alerts(emails, recipients)
+        self.sms_dispatcher.submit(keys)
+        return keys
+    
+    def handle_new_emails(self, email_monitor, emails):
+        """Alert handler for the monitors"""
+        self.process_new_bookeo_emails(emails, email_monitor.config.target_phone_numbers)
     
     def run_monitoring_cycle(self):
         """Run a single monitoring cycle"""
         try:
             self.logger.info("Starting email monitoring cycle...")
             
-            # Check for new Bookeo emails
-            new_emails = self.email_monitor.check_for_bookeo_emails()
-            
-            if new_emails:
-                self.logger.info(f"Found {len(new_emails)} new Bookeo email(s)")
-                self.process_new_bookeo_emails(new_emails)
-            else:
-                self.logger.info("No new Bookeo emails found")
+            # Check each mailbox; alerts are recorded and queued by handle_new_emails
+            for email_monitor in self.email_monitors:
+                mailbox = email_monitor.config.mailbox_name
+                new_emails = email_monitor.check_for_bookeo_emails()
                 
+                if new_emails:
+                    self.logger.info(f"Found {len(new_emails)} new Bookeo email(s) in {mailbox}")
+                else:
+                    self.logger.info(f"No new Bookeo emails found in {mailbox}")
+            
+            self.logger.debug("SMS dispatch stats: %s", LazyValue(self.sms_dispatcher.get_stats))
+        
         except Exception as e:
             self.logger.error(f"Error during monitoring cycle: {str(e)}")
     
+    def next_check_interval(self):
+        """Seconds between checks, from the mailbox whose traffic needs the shortest interval"""
+        return min(email_monitor.poll_scheduler.next_interval() for email_monitor in self.email_monitors)
+    
     def run(self):
         """Main monitoring loop"""
         self.logger.info("Email Monitoring Agent started")
-        self.logger.info(f"Monitoring: {self.config.email_address}")
-        self.logger.info(f"Target sender: {self.config.bookeo_sender}")
-        self.logger.info(f"SMS alerts to: {self.config.target_phone_number}")
-        self.logger.info(f"Check interval: {self.config.check_interval} seconds")
+        for profile in self.profiles:
+            self.logger.info(
+                f"Monitoring {profile.name}: {profile.config.email_address} "
+                f"(senders: {', '.join(profile.config.bookeo_senders)}; "
+                f"SMS alerts to: {', '.join(profile.config.target_phone_numbers)})"
+            )
+        if self.config.adaptive_polling:
+            self.logger.info(
+                f"Check interval: adaptive, {self.config.poll_min_interval}-{self.config.poll_max_interval} seconds"
+            )
+        else:
+            self.logger.info(f"Check interval: {self.config.check_interval} seconds")
+        self.logger.info(f"IMAP IDLE push mode: {'enabled' if self.config.use_idle else 'disabled'}")
         
         # Validate configuration
         if not self.config.validate():
             self.logger.error("Configuration validation failed. Exiting...")
             return False
         
+        if not self.email_monitors:
+            self.logger.error("No valid mailbox profiles. Exiting...")
+            return False
+        
+        if self.config.use_async_engine:
+            return self.run_async_engine()
+        
+        if len(self.email_monitors) > 1:
+            self.logger.warning("ASYNC_ENGINE=false: mailboxes are checked one after another, without IDLE")
+        
         # Test connections
-        if not self.email_monitor.test_connection():
+        if not all([email_monitor.test_connection() for email_monitor in self.email_monitors]):
             self.logger.error("Email connection test failed.")
             self.logger.error("The agent will continue running and retry connections periodically.")
             self.logger.error("Check setup_instructions.md for troubleshooting steps.")
             # Don't exit - continue with monitoring loop for resilience
-            
+        
         if not self.sms_sender.test_connection():
             self.logger.error("SMS service connection test failed. Exiting...")
             return False
         
         self.logger.info("All connection tests passed. Starting monitoring...")
+        self.sms_dispatcher.start()
         
         # Main monitoring loop
         while self.running:
@@ -111,26 +178,62 @@ class EmailMonitoringAgent:
                 cycle_start = datetime.now()
                 self.run_monitoring_cycle()
                 
-                # Calculate sleep time to maintain consistent interval
+                # Wait for the server to push new mail; None means IDLE is unavailable.
+                # With several mailboxes only the asyncio engine can IDLE on all of them.
+                if self.config.use_idle and len(self.email_monitors) == 1:
+                    new_mail = self.email_monitor.wait_for_new_mail(
+                        self.config.idle_timeout,
+                        lambda: not self.running
+                    )
+                    if new_mail is not None:
+                        continue
+                
+                # Sleep until the mailbox due soonest should be checked again
                 cycle_duration = (datetime.now() - cycle_start).total_seconds()
-                sleep_time = max(0, self.config.check_interval - cycle_duration)
+                sleep_time = max(0, self.next_check_interval() - cycle_duration)
                 
                 if sleep_time > 0:
-                    self.logger.debug(f"Sleeping for {sleep_time:.2f} seconds until next check")
-                    time.sleep(sleep_time)
+                    self.logger.debug("Sleeping for %.2f seconds until next check", sleep_time)
+                    self.stop_event.wait(sleep_time)
                 else:
                     self.logger.warning(f"Monitoring cycle took longer than interval: {cycle_duration:.2f}s")
-                    
+            
             except KeyboardInterrupt:
                 self.logger.info("Keyboard interrupt received. Shutting down...")
                 break
             except Exception as e:
                 self.logger.error(f"Unexpected error in main loop: {str(e)}")
                 self.logger.info(f"Waiting {self.config.check_interval} seconds before retry...")
-                time.sleep(self.config.check_interval)
+                self.stop_event.wait(self.config.check_interval)
         
+        for email_monitor in self.email_monitors:
+            email_monitor.disconnect_from_mailbox()
+            self.logger.info(f"IMAP session stats for {email_monitor.config.mailbox_name}: {email_monitor.session.get_stats()}")
+        
+        # Give queued alerts a chance to go out before exiting; the rest stay in the outbox
+        self.sms_dispatcher.stop()
+        self.logger.info(f"SMS dispatch stats: {self.sms_dispatcher.get_stats()}")
+        self.logger.info(f"Alert latency by stage:\n{pipeline_latency.format_table()}")
+        self.outbox.close()
         self.logger.info("Email Monitoring Agent stopped")
         return True
+    
+    def run_async_engine(self):
+        """Run the monitoring loop on the asyncio engine (one event loop plus its outbox thread)"""
+        from async_engine import AsyncMonitoringEngine
+        
+        # The engine connects to IMAP on its first cycle and retries like the sync loop
+        if not self.sms_sender.test_connection():
+            self.logger.error("SMS service connection test failed. Exiting...")
+            return False
+        
+        self.logger.info("SMS connection test passed. Starting asyncio monitoring engine...")
+        result = AsyncMonitoringEngine(self).run()
+        self.logger.info(f"SMS dispatch stats: {self.sms_dispatcher.get_stats()}")
+        self.logger.info(f"Alert latency by stage:\n{pipeline_latency.format_table()}")
+        self.outbox.close()
+        self.logger.info("Email Monitoring Agent stopped")
+        return result
 
 def main():
     """Entry point for the application"""
@@ -0,0 +1,225 @@
+"""
+Prometheus text exposition of the agent's counters, gauges and latency histograms
+"""
+
+import threading
+
+from latency_metrics import LatencyHistogram, pipeline_latency
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+def escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{escape_label_value(value)}"' for name, value in pairs) + '}'
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+    """A named metric with optional labels, updated in place by the code it measures"""
+    
+    type = 'untyped'
+    
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+    
+    def key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+    
+    def samples(self):
+        """(suffix, label values, extra labels, value) tuples for the exposition"""
+        with self.lock:
+            values = list(self.values.items())
+        return [('', key, (), value) for key, value in values]
+    
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for suffix, key, extra, value in self.samples():
+            lines.append(f"{self.name}{suffix}{format_labels(self.labelnames, key, extra)} {format_value(value)}")
+        return lines
+
+class Counter(Metric):
+    type = 'counter'
+    
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    type = 'gauge'
+    
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+class Histogram(Metric):
+    """Prometheus histogram over LatencyHistogram's buckets"""
+    
+    type = 'histogram'
+    
+    def observe(self, seconds, **labels):
+        key = self.key(labels)
+        histogram = self.values.get(key)
+        if histogram is None:
+            with self.lock:
+                histogram = self.values.setdefault(key, LatencyHistogram())
+        histogram.observe(seconds)
+    
+    def samples(self):
+        with self.lock:
+            histograms = list(self.values.items())
+        return [sample for key, histogram in histograms for sample in histogram_samples(key, histogram)]
+
+def histogram_samples(key, histogram):
+    counts, count, total, _ = histogram.snapshot()
+    samples = []
+    cumulative = 0
+    for bound, bucket_count in zip(histogram.buckets + (float('inf'),), counts):
+        cumulative += bucket_count
+        samples.append(('_bucket', key, (('le', format_value(float(bound))),), cumulative))
+    samples.append(('_sum', key, (), total))
+    samples.append(('_count', key, (), count))
+    return samples
+
+class CallbackMetric(Metric):
+    """Reads a value the agent already keeps (e.g. a stats attribute) at scrape time
+    
+    callback returns a number, or {label values tuple: number}.
+    """
+    
+    def __init__(self, name, documentation, metric_type, callback, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self.type = metric_type
+        self.callback = callback
+    
+    def samples(self):
+        values = self.callback()
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [('', key, (), value) for key, value in values.items()]
+
+class PipelineLatencyMetric(Metric):
+    """latency_metrics.pipeline_latency as one histogram labelled by stage"""
+    
+    type = 'histogram'
+    
+    def __init__(self, name, documentation, recorder):
+        super().__init__(name, documentation, ('stage',))
+        self.recorder = recorder
+    
+    def samples(self):
+        return [
+            sample
+            for stage, histogram in list(self.recorder.histograms.items())
+            for sample in histogram_samples((stage,), histogram)
+        ]
+
+class MetricsRegistry:
+    """Every metric the /metrics endpoint exposes, in registration order
+    
+    Updating a metric takes only that metric's lock, for a dictionary update,
+    and rendering copies each metric's values before formatting them, so a
+    scrape never waits on IMAP, Twilio or the outbox.
+    """
+    
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+    
+    def register(self, metric):
+        """Add a metric, replacing any earlier one with the same name"""
+        with self.lock:
+            self.metrics[metric.name] = metric
+        return metric
+    
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+    
+    def gauge(self, name, documentation, labelnames=()):
+        return self.register(Gauge(name, documentation, labelnames))
+    
+    def histogram(self, name, documentation, labelnames=()):
+        return self.register(Histogram(name, documentation, labelnames))
+    
+    def callback(self, name, documentation, metric_type, callback, labelnames=()):
+        return self.register(CallbackMetric(name, documentation, metric_type, callback, labelnames))
+    
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return ('\n'.join(lines) + '\n').encode('utf-8')
+
+registry = MetricsRegistry()
+
+CYCLES = registry.counter(
+    'email_monitor_cycles_total', "Mailbox checks, by result", ('mailbox', 'result')
+)
+CYCLE_DURATION = registry.histogram(
+    'email_monitor_cycle_duration_seconds', "Time to check one mailbox for new Bookeo emails", ('mailbox',)
+)
+LAST_SUCCESSFUL_CHECK = registry.gauge(
+    'email_monitor_last_successful_check_timestamp_seconds', "Unix time of the last successful check", ('mailbox',)
+)
+IMAP_CONNECT_DURATION = registry.histogram(
+    'email_monitor_imap_connect_seconds', "Connect, login and SELECT of a new IMAP session"
+)
+registry.register(PipelineLatencyMetric(
+    'email_monitor_alert_stage_seconds', "Alert latency by pipeline stage", pipeline_latency
+))
+
+def register_agent_metrics(email_monitors, sms_dispatcher):
+    """Expose the download and SMS statistics the monitors and dispatcher already keep"""
+    def per_mailbox(attribute):
+        return lambda: {
+            (monitor.config.mailbox_name,): getattr(monitor, attribute) for monitor in email_monitors
+        }
+    
+    registry.callback(
+        'email_monitor_emails_fetched_total', "Messages whose headers were downloaded", 'counter',
+        per_mailbox('messages_fetched'), ('mailbox',)
+    )
+    registry.callback(
+        'email_monitor_imap_bytes_downloaded_total', "Bytes of headers and text parts downloaded", 'counter',
+        per_mailbox('bytes_downloaded'), ('mailbox',)
+    )
+    
+    for attribute, documentation in (
+        ('sent', "Alerts delivered to Twilio"),
+        ('failed', "Alerts abandoned after their last attempt"),
+        ('retries', "Failed delivery attempts that will be retried"),
+        ('throttled', "Deliveries deferred by rate limiting"),
+        ('messages', "SMS messages accepted by Twilio, counting a digest once"),
+    ):
+        registry.callback(
+            f'email_monitor_sms_{attribute}_total', documentation, 'counter',
+            lambda attribute=attribute: getattr(sms_dispatcher, attribute)
+        )
+    
+    registry.callback(
+        'email_monitor_sms_queue_depth', "Alerts queued for the SMS workers", 'gauge',
+        sms_dispatcher.queue.qsize
+    )
+    registry.callback(
+        'email_monitor_sms_in_flight', "Alerts being sent right now", 'gauge',
+        lambda: sms_dispatcher.in_flight
+    )
+
+def render_metrics():
+    """Route handler for /metrics: (status code, content type, body)"""
+    return 200, CONTENT_TYPE, registry.render()
@@ -0,0 +1,160 @@
+"""
+Adaptive polling interval from recent and historical booking arrivals
+"""
+
+import json
+import math
+import os
+import time
+from datetime import datetime
+
+HOURS_PER_WEEK = 7 * 24
+
+# Recent arrivals count with this half-life when estimating the current rate
+RECENT_HALF_LIFE_SECONDS = 3600
+
+# Weight, in observed seconds, of the configured check_interval in each hour
+# of the week before history has been collected
+PRIOR_EXPOSURE_SECONDS = 3600
+
+# Once an hour of the week has been observed this long (about eight weeks),
+# its history is halved so the schedule follows seasonal changes
+MAX_SLOT_EXPOSURE_SECONDS = 8 * 3600
+
+# How often the history is written to disk when no email arrives
+SAVE_INTERVAL_SECONDS = 600
+
+class PollScheduler:
+    """Chooses how long to wait before the next poll of one mailbox
+    
+    With bookings arriving at rate r per second, polling every T seconds
+    costs 1/T polls per second and delays each booking by T/2 on average.
+    Minimizing poll_cost/T + r*T/2 gives T = sqrt(2 * poll_cost / r), so
+    four times the traffic halves the interval. r is the larger of the recent
+    rate and the history for the current hour of the week; that history
+    starts out at the rate for which check_interval would be the best choice.
+    
+    After an email arrives the next poll comes after min_interval, doubling
+    with each empty poll, because bookings bring follow-ups (receipts,
+    changes) within minutes. The interval always stays within min_interval
+    and max_interval.
+    """
+    
+    def __init__(self, path, logger, check_interval, min_interval, max_interval, poll_cost=3.0, adaptive=True):
+        self.path = path
+        self.logger = logger
+        self.check_interval = check_interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.poll_cost = poll_cost
+        self.adaptive = adaptive
+        self.prior_rate = 2 * poll_cost / check_interval ** 2
+        
+        # [arrivals, seconds observed] for each hour of the week, local time
+        self.slots = [[0.0, 0.0] for _ in range(HOURS_PER_WEEK)]
+        self.recent_arrivals = 0.0
+        self.recent_updated_at = None
+        self.last_poll_at = None
+        self.last_arrival_at = None
+        self.empty_polls = 0
+        self.last_save = float('-inf')
+        
+        # Statistics
+        self.polls = 0
+        self.arrivals = 0
+        self.load()
+    
+    def load(self):
+        """Load the arrival history, starting fresh if it is missing or corrupt"""
+        if not self.path or not os.path.exists(self.path):
+            return
+        
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                slots = json.load(f)['slots']
+            if len(slots) != HOURS_PER_WEEK:
+                raise ValueError(f"expected {HOURS_PER_WEEK} hourly slots, found {len(slots)}")
+            self.slots = [[float(arrivals), float(exposure)] for arrivals, exposure in slots]
+            self.logger.info(f"Loaded polling history: {sum(slot[0] for slot in self.slots):.0f} arrival(s)")
+        except Exception as e:
+            self.logger.warning(f"Ignoring unreadable polling history '{self.path}': {str(e)}")
+            self.slots = [[0.0, 0.0] for _ in range(HOURS_PER_WEEK)]
+    
+    def save(self, now):
+        self.last_save = now
+        if not self.path:
+            return
+        
+        try:
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'slots': self.slots, 'updated_at': datetime.now().isoformat()}, f)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            self.logger.error(f"Error saving polling history: {str(e)}")
+    
+    def slot(self, now):
+        moment = datetime.fromtimestamp(now)
+        return self.slots[moment.weekday() * 24 + moment.hour]
+    
+    def decayed_recent_arrivals(self, now):
+        if self.recent_updated_at is None:
+            return 0.0
+        return self.recent_arrivals * 0.5 ** ((now - self.recent_updated_at) / RECENT_HALF_LIFE_SECONDS)
+    
+    def record_poll(self, arrivals, now=None):
+        """Record a successful check of the mailbox that found this many new emails"""
+        now = time.time() if now is None else now
+        self.polls += 1
+        
+        # The time since the previous check was watched; credit it to the hour it mostly fell in
+        if self.last_poll_at is not None and now > self.last_poll_at:
+            slot = self.slot((self.last_poll_at + now) / 2)
+            slot[1] += now - self.last_poll_at
+            if slot[1] > MAX_SLOT_EXPOSURE_SECONDS:
+                slot[0] /= 2
+                slot[1] /= 2
+        self.last_poll_at = now
+        
+        if not arrivals:
+            self.empty_polls += 1
+            if now - self.last_save >= SAVE_INTERVAL_SECONDS:
+                self.save(now)
+            return
+        
+        self.arrivals += arrivals
+        self.slot(now)[0] += arrivals
+        self.recent_arrivals = self.decayed_recent_arrivals(now) + arrivals
+        self.recent_updated_at = now
+        self.last_arrival_at = now
+        self.empty_polls = 0
+        self.save(now)
+    
+    def expected_rate(self, now=None):
+        """Expected new emails per second right now"""
+        now = time.time() if now is None else now
+        arrivals, exposure = self.slot(now)
+        historical = (arrivals + self.prior_rate * PRIOR_EXPOSURE_SECONDS) / (exposure + PRIOR_EXPOSURE_SECONDS)
+        
+        # An exponentially weighted count over a mean age of half-life / ln 2
+        recent = self.decayed_recent_arrivals(now) * math.log(2) / RECENT_HALF_LIFE_SECONDS
+        return max(historical, recent)
+    
+    def next_interval(self, now=None):
+        """Seconds to wait between the end of this check and the next one"""
+        if not self.adaptive:
+            return self.check_interval
+        
+        now = time.time() if now is None else now
+        interval = math.sqrt(2 * self.poll_cost / self.expected_rate(now))
+        if self.last_arrival_at is not None:
+            interval = min(interval, self.min_interval * 2 ** min(self.empty_polls, 32))
+        return min(self.max_interval, max(self.min_interval, interval))
+    
+    def get_stats(self):
+        return {
+            'polls': self.polls,
+            'arrivals': self.arrivals,
+            'next_interval': round(self.next_interval(), 1),
+            'expected_per_hour': round(self.expected_rate() * 3600, 3),
+        }
@@ -5,74 +5,227 @@ This version prevents the free tier from sleeping by adding internal HTTP activi
 
 import time
 import signal
+import socket
 import sys
-import re
 import threading
 import requests
 from datetime import datetime
-from email_monitor import EmailMonitor
-from sms_sender import SMSSender
-from logger_config import setup_logger
+from booking_parser import booking_extractor
+from latency_metrics import pipeline_latency
+from mailbox_profiles import load_profiles, build_monitors
+from health import HealthWatchdog
+from metrics import register_agent_metrics, render_metrics
+from sms_sender import SMSSender, SMSDispatchQueue
+from sms_outbox import SMSOutbox, alert_key
+from logger_config import LazyValue, setup_logger
 from config import Config
 
 # Simple HTTP server for keep-alive
+from concurrent.futures import ThreadPoolExecutor
 from http.server import HTTPServer, BaseHTTPRequestHandler
 import os
 
 class HealthCheckHandler(BaseHTTPRequestHandler):
+    # Set by the agent and shared with the asyncio engine's HTTP endpoint. A route
+    # is the response body, or a callable returning (status code, content type, body).
+    routes = {}
+    
     def do_GET(self):
-        if self.path == '/health':
-            self.send_response(200)
-            self.send_header('Content-type', 'text/plain')
-            self.end_headers()
-            self.wfile.write(b'Email Monitor is running')
-        elif self.path == '/keepalive':
-            self.send_response(200)
-            self.send_header('Content-type', 'text/plain')
+        self.respond(include_body=True)
+    
+    def do_HEAD(self):
+        self.respond(include_body=False)
+    
+    def respond(self, include_body):
+        route = self.routes.get(self.path)
+        if route is not None:
+            status, content_type, body = route() if callable(route) else (200, 'text/plain', route)
+            self.send_response(status)
+            self.send_header('Content-type', content_type)
+            self.send_header('Content-Length', str(len(body)))
             self.end_headers()
-            self.wfile.write(b'Keep-alive ping received')
+            if include_body:
+                self.wfile.write(body)
         else:
             self.send_response(404)
+            self.send_header('Content-Length', '0')
             self.end_headers()
     
     def log_message(self, format, *args):
         # Suppress HTTP server logs
         pass
 
+class PooledHTTPServer(HTTPServer):
+    """HTTPServer that answers requests on a bounded thread pool
+    
+    A connection has request_timeout seconds from the moment a worker picks
+    it up to be read and answered; past that its socket is shut down, so a
+    client trickling in its request holds one worker for a bounded time
+    instead of blocking every probe. At most max_pending connections wait
+    for or occupy a worker; beyond that new connections are closed straight
+    away.
+    """
+    
+    # Listen backlog, so bursts of probes are not dropped before accept()
+    request_queue_size = 128
+    
+    # How often serve_forever() looks for connections past their deadline
+    poll_interval = 0.25
+    
+    def __init__(self, address, handler_class, max_workers=8, request_timeout=10, max_pending=512):
+        super().__init__(address, handler_class)
+        self.request_timeout = request_timeout
+        self.max_pending = max_pending
+        # request -> [future, deadline]; the deadline is set once a worker starts on it
+        self.connections = {}
+        self.pending_lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers, thread_name_prefix="http")
+    
+    def serve_forever(self, poll_interval=None):
+        super().serve_forever(poll_interval or self.poll_interval)
+    
+    def process_request(self, request, client_address):
+        with self.pending_lock:
+            if len(self.connections) >= self.max_pending:
+                self.shutdown_request(request)
+                return
+            entry = self.connections[request] = [None, None]
+        # Each read or write also gives up at the deadline
+        request.settimeout(self.request_timeout)
+        entry[0] = self.executor.submit(self.process_request_thread, request, client_address)
+    
+    def process_request_thread(self, request, client_address):
+        with self.pending_lock:
+            self.connections[request][1] = time.monotonic() + self.request_timeout
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.release(request)
+    
+    def release(self, request):
+        self.shutdown_request(request)
+        with self.pending_lock:
+            self.connections.pop(request, None)
+    
+    def service_actions(self):
+        """Cut off connections that have used up their whole-request deadline"""
+        now = time.monotonic()
+        with self.pending_lock:
+            overdue = [request for request, (_, deadline) in self.connections.items() if deadline and deadline <= now]
+        for request in overdue:
+            try:
+                # Wakes the worker blocked on this socket; it then releases it
+                request.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+    
+    def handle_error(self, request, client_address):
+        # Timeouts and disconnects from probes and scanners are expected
+        pass
+    
+    def stop(self):
+        """Stop accepting connections, then let requests in progress finish within their deadline"""
+        self.shutdown()
+        self.server_close()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        
+        # Connections whose turn never came are closed here, not by a worker
+        with self.pending_lock:
+            cancelled = [request for request, (future, _) in self.connections.items() if future and future.cancelled()]
+        for request in cancelled:
+            self.release(request)
+        
+        while self.connections:
+            self.service_actions()
+            time.sleep(self.poll_interval)
+        self.executor.shutdown(wait=True)
+
 class EmailMonitoringAgent:
     def __init__(self):
-        self.logger = setup_logger()
         self.config = Config()
-        self.email_monitor = EmailMonitor(self.config, self.logger)
+        self.logger = setup_logger(
+            log_level=self.config.log_level, log_file=self.config.log_file, queue_size=self.config.log_queue_size,
+            overflow=self.config.log_queue_overflow, log_format=self.config.log_format
+        )
+        self.profiles = load_profiles(self.config, self.logger) or []
+        self.email_monitors = build_monitors(self.profiles, self.config, self.logger)
+        self.email_monitor = self.email_monitors[0] if self.email_monitors else None
+        self.config.resolve_async_engine(len(self.email_monitors))
         self.sms_sender = SMSSender(self.config, self.logger)
+        self.outbox = SMSOutbox(
+            self.config.sms_outbox_file, self.logger, self.config.sms_max_attempts, self.config.sms_retry_delay,
+            self.config.sms_coalesce_window, self.config.sms_coalesce_max_delay
+        )
+        self.sms_dispatcher = SMSDispatchQueue(self.sms_sender, self.outbox, self.config, self.logger)
+        register_agent_metrics(self.email_monitors, self.sms_dispatcher)
+        self.health_watchdog = HealthWatchdog(
+            self.email_monitors, self.sms_dispatcher, self.outbox, self.config, self.logger
+        )
+        HealthCheckHandler.routes = {
+            '/health': self.health_watchdog.health_route,
+            '/ready': self.health_watchdog.ready_route,
+            '/keepalive': b'Keep-alive ping received',
+            '/metrics': render_metrics,
+        }
         self.running = True
         self.service_url = None
+        self.http_server = None
+        
+        # Alerts are recorded before each monitor marks its emails processed
+        for email_monitor in self.email_monitors:
+            email_monitor.alert_handler = self.handle_new_emails
         
         # Setup signal handlers for graceful shutdown
         signal.signal(signal.SIGINT, self.signal_handler)
         signal.signal(signal.SIGTERM, self.signal_handler)
         
+        # The asyncio engine serves HTTP, pings and refreshes health on its own event loop
+        if self.config.use_async_engine:
+            return
+        
+        # Probes read the snapshot the watchdog refreshes on its own thread
+        self.health_watchdog.start()
+        
         # Start HTTP server for keep-alive
         self.start_http_server()
         
         # Start internal keep-alive pinger
         self.start_keep_alive_pinger()
     
+    def get_http_port(self):
+        return int(os.environ.get('PORT', 10000))  # Render assigns PORT
+    
+    def get_keep_alive_url(self):
+        """Determine our public service URL from the environment"""
+        if not self.service_url:
+            render_service = os.environ.get('RENDER_SERVICE_NAME', 'bookeo-email-monitor')
+            self.service_url = f"https://{render_service}.onrender.com"
+        return self.service_url
+    
     def start_http_server(self):
         """Start HTTP server for health checks and keep-alive"""
-        port = int(os.environ.get('PORT', 10000))  # Render assigns PORT
+        port = self.get_http_port()
         
-        def run_server():
-            try:
-                server = HTTPServer(('0.0.0.0', port), HealthCheckHandler)
-                self.logger.info(f"HTTP server started on port {port}")
-                server.serve_forever()
-            except Exception as e:
-                self.logger.error(f"HTTP server error: {str(e)}")
+        try:
+            self.http_server = PooledHTTPServer(
+                ('0.0.0.0', port), HealthCheckHandler, self.config.http_workers, self.config.http_request_timeout
+            )
+        except Exception as e:
+            self.logger.error(f"HTTP server error: {str(e)}")
+            return
         
         # Run HTTP server in background thread
-        server_thread = threading.Thread(target=run_server, daemon=True)
+        server_thread = threading.Thread(target=self.http_server.serve_forever, name="http-server", daemon=True)
         server_thread.start()
+        self.logger.info(f"HTTP server started on port {port} ({self.config.http_workers} worker(s))")
+    
+    def stop_http_server(self):
+        server, self.http_server = self.http_server, None
+        if server is not None:
+            server.stop()
+            self.logger.info("HTTP server stopped")
     
     def start_keep_alive_pinger(self):
         """Start internal keep-alive pinger to prevent sleeping"""
@@ -85,19 +238,14 @@ class EmailMonitoringAgent:
                     if self.running:
                         # Try to ping our own health endpoint
                         try:
-                            if not self.service_url:
-                                # Try to determine our service URL from environment
-                                render_service = os.environ.get('RENDER_SERVICE_NAME', 'bookeo-email-monitor')
-                                self.service_url = f"https://{render_service}.onrender.com"
-                            
-                            response = requests.get(f"{self.service_url}/keepalive", timeout=30)
+                            response = requests.get(f"{self.get_keep_alive_url()}/keepalive", timeout=30)
                             if response.status_code == 200:
                                 self.logger.info("Keep-alive ping successful - service staying awake")
                             else:
                                 self.logger.warning(f"Keep-alive ping returned status: {response.status_code}")
                         except Exception as ping_error:
                             self.logger.warning(f"Keep-alive ping failed: {str(ping_error)}")
-                            
+                
                 except Exception as e:
                     self.logger.error(f"Keep-alive pinger error: {str(e)}")
         
@@ -110,64 +258,74 @@ class EmailMonitoringAgent:
         """Handle shutdown signals gracefully"""
         self.logger.info(f"Received signal {signum}, shutting down gracefully...")
         self.running = False
+        
+        # Stop the HTTP server off the signal handler; its requests in progress may take a while
+        threading.Thread(target=self.stop_http_server, name="http-shutdown").start()
     
     def extract_booking_details(self, email_body):
         """Extract key booking details from Bookeo email"""
-        details = {}
-        
         try:
-            # Extract Date
-            date_match = re.search(r'Date:\s*(.+)', email_body)
-            if date_match:
-                details['date'] = date_match.group(1).strip()
-            
-            # Extract Time
-            time_match = re.search(r'Time:\s*(.+)', email_body)
-            if time_match:
-                details['time'] = time_match.group(1).strip()
-            
-            # Extract Game
-            game_match = re.search(r'Game:\s*(.+)', email_body)
-            if game_match:
-                details['game'] = game_match.group(1).strip()
-            
-            # Extract Participants
-            participants_match = re.search(r'Participants:\s*(.+)', email_body)
-            if participants_match:
-                details['participants'] = participants_match.group(1).strip()
-            
-            # Extract Total price
-            price_match = re.search(r'Total price:\s*(.+)', email_body)
-            if price_match:
-                details['price'] = price_match.group(1).strip()
-            
-            # Extract Customer name
-            customer_match = re.search(r'Customer\s*([^\n]+)', email_body)
-            if customer_match:
-                details['customer'] = customer_match.group(1).strip()
-            
-            # Extract Customer email
-            email_match = re.search(r'Email:\s*([^\s\n]+)', email_body)
-            if email_match:
-                details['customer_email'] = email_match.group(1).strip()
-            
-            # Extract Customer phone
-            phone_match = re.search(r'Phone \(mobile\):\s*(.+)', email_body)
-            if phone_match:
-                details['customer_phone'] = phone_match.group(1).strip()
-            
-            # Extract Booking number
-            booking_match = re.search(r'Booking number:\s*(.+)', email_body)
-            if booking_match:
-                details['booking_number'] = booking_match.group(1).strip()
-                
+            # One precompiled scan for every field; add new labels in booking_parser.BOOKING_FIELDS
+            with pipeline_latency.timer('extract'):
+                return booking_extractor.extract(email_body)
         except Exception as e:
             self.logger.error(f"Error extracting booking details: {str(e)}")
+            return {}
+    
+    def build_alert_message(self, email_info, booking_details=None):
+        """Create the SMS text for a new Bookeo email"""
+        subject = email_info.get('subject', 'No Subject')
+        if booking_details is None:
+            booking_details = self.extract_booking_details(email_info.get('body', ''))
         
-        return details
-
-    def process_new_bookeo_emails(self, emails):
-        """Process and send SMS alerts for new Bookeo emails"""
+        # Create detailed SMS message
+        if booking_details:
+            message = "🔔 NEW BOOKEO BOOKING!\n"
+            
+            if 'date' in booking_details:
+                message += f"📅 Date: {booking_details['date']}\n"
+            if 'time' in booking_details:
+                message += f"⏰ Time: {booking_details['time']}\n"
+            if 'game' in booking_details:
+                message += f"🎮 Game: {booking_details['game']}\n"
+            if 'participants' in booking_details:
+                message += f"👥 Participants: {booking_details['participants']}\n"
+            if 'customer' in booking_details:
+                message += f"👤 Customer: {booking_details['customer']}\n"
+            if 'customer_phone' in booking_details:
+                message += f"📞 Phone: {booking_details['customer_phone']}\n"
+        else:
+            # Fallback message if extraction fails
+            message = (
+                f"🔔 New Bookeo Booking!\n"
+                f"Subject: {subject}\n"
+                f"Check email for full details."
+            )
+        
+        return message
+    
+    def build_alert_summary(self, email_info, booking_details):
+        """One short line per booking in a digest SMS, such as: 10/18 7:00 PM Heist x3"""
+        parts = []
+        if 'date' in booking_details:
+            try:
+                # Bookeo writes "Sunday, October 18, 2026"
+                parts.append(datetime.strptime(booking_details['date'], "%A, %B %d, %Y").strftime("%m/%d"))
+            except ValueError:
+                parts.append(booking_details['date'])
+        parts.extend(booking_details[field] for field in ('time', 'game') if field in booking_details)
+        if 'participants' in booking_details:
+            parts.append(f"x{booking_details['participants'].split()[0]}")
+        return ' '.join(parts) or email_info.get('subject', 'No Subject')
+    
+    def record_alerts(self, emails, recipients=None):
+        """Record one SMS alert per new Bookeo email and recipient in the outbox
+        
+        Returns the keys of the alerts not recorded before. Outbox errors
+        propagate, so the monitor does not mark the emails processed.
+        """
+        recipients = recipients or self.config.target_phone_numbers
+        keys = []
         for email_info in emails:
             try:
                 subject = email_info.get('subject', 'No Subject')
@@ -175,66 +333,81 @@ class EmailMonitoringAgent:
                 
                 # Extract booking details from email body
                 booking_details = self.extract_booking_details(email_body)
-                
-                # Create detailed SMS message
-                if booking_details:
-                    message = "🔔 NEW BOOKEO BOOKING!\n"
-                    
-                    if 'date' in booking_details:
-                        message += f"📅 Date: {booking_details['date']}\n"
-                    if 'time' in booking_details:
-                        message += f"⏰ Time: {booking_details['time']}\n"
-                    if 'game' in booking_details:
-                        message += f"🎮 Game: {booking_details['game']}\n"
-                    if 'participants' in booking_details:
-                        message += f"👥 Participants: {booking_details['participants']}\n"
-                    if 'customer' in booking_details:
-                        message += f"👤 Customer: {booking_details['customer']}\n"
-                    if 'customer_phone' in booking_details:
-                        message += f"📞 Phone: {booking_details['customer_phone']}\n"
-                else:
-                    # Fallback message if extraction fails
-                    message = (
-                        f"🔔 New Bookeo Booking!\n"
-                        f"Subject: {subject}\n"
-                        f"Check email for full details."
-                    )
-                
-                # Send SMS notification
-                success = self.sms_sender.send_notification(
-                    self.config.target_phone_number,
-                    message
-                )
-                
-                if success:
-                    self.logger.info(f"SMS alert sent successfully for booking: {booking_details.get('booking_number', 'Unknown')}")
-                else:
-                    self.logger.error(f"Failed to send SMS alert for email: {subject}")
-                    
+                message = self.build_alert_message(email_info, booking_details)
+                summary = self.build_alert_summary(email_info, booking_details)
             except Exception as e:
                 self.logger.error(f"Error processing email notification: {str(e)}")
-
+                continue
+            
+            description = f"booking: {booking_details.get('booking_number', subject)}"
+            self.logger.info(
+                "Recording alert for %s", description,
+                extra={'uid': email_info.get('uid'), 'booking_number': booking_details.get('booking_number')}
+            )
+            for recipient in recipients:
+                key = alert_key(email_info, recipient)
+                if self.outbox.add(
+                    key, recipient, message, description, summary,
+                    email_info.get('sent_at'), email_info.get('arrived_at')
+                ):
+                    keys.append(key)
+        return keys
+    
+    def process_new_bookeo_emails(self, emails, recipients=None):
+        """Record SMS alerts for new Bookeo emails and queue them for the workers"""
+        keys = self.record_alerts(emails, recipients)
+        self.sms_dispatcher.submit(keys)
+        return keys
+    
+    def handle_new_emails(self, email_monitor, emails):
+        """Alert handler for the monitors"""
+        self.process_new_bookeo_emails(emails, email_monitor.config.target_phone_numbers)
+    
     def run_monitoring_cycle(self):
         """Run a single monitoring cycle"""
         try:
             self.logger.info("Starting email monitoring cycle...")
-            new_emails = self.email_monitor.check_for_bookeo_emails()
             
-            if new_emails:
-                self.logger.info(f"Found {len(new_emails)} new Bookeo email(s)")
-                self.process_new_bookeo_emails(new_emails)
-            else:
-                self.logger.info("No new Bookeo emails found")
+            # Alerts are recorded and queued by handle_new_emails
+            for email_monitor in self.email_monitors:
+                mailbox = email_monitor.config.mailbox_name
+                new_emails = email_monitor.check_for_bookeo_emails()
                 
+                if new_emails:
+                    self.logger.info(f"Found {len(new_emails)} new Bookeo email(s) in {mailbox}")
+                else:
+                    self.logger.info(f"No new Bookeo emails found in {mailbox}")
+            
+            self.logger.debug("SMS dispatch stats: %s", LazyValue(self.sms_dispatcher.get_stats))
+        
         except Exception as e:
             self.logger.error(f"Error in monitoring cycle: {str(e)}")
-
+    
+    def next_check_interval(self):
+        """Seconds between checks, from the mailbox whose traffic needs the shortest interval"""
+        return min(email_monitor.poll_scheduler.next_interval() for email_monitor in self.email_monitors)
+    
     def run(self):
         """Main monitoring loop"""
         try:
+            # Malformed numeric settings were replaced by defaults; validate() reports them
+            if not self.config.validate():
+                self.logger.error("Configuration validation failed")
+                return False
+            
+            if not self.email_monitors:
+                self.logger.error("No valid mailbox profiles")
+                return False
+            
+            if self.config.use_async_engine:
+                return self.run_async_engine()
+            
+            if len(self.email_monitors) > 1:
+                self.logger.warning("ASYNC_ENGINE=false: mailboxes are checked one after another, without IDLE")
+            
             # Test connections before starting main loop
             self.logger.info("Testing email connection...")
-            if not self.email_monitor.test_connection():
+            if not all([email_monitor.test_connection() for email_monitor in self.email_monitors]):
                 self.logger.error("Email connection test failed")
                 return False
             
@@ -244,23 +417,66 @@ class EmailMonitoringAgent:
                 return False
             
             self.logger.info("All connection tests passed. Starting monitoring...")
+            self.sms_dispatcher.start()
             
             # Main monitoring loop
             while self.running:
                 self.run_monitoring_cycle()
                 
-                # Wait for next check (2 minutes)
-                for _ in range(120):  # 120 seconds = 2 minutes
-                    if not self.running:
-                        break
-                    time.sleep(1)
+                # Wait for the server to push new mail; None means IDLE is unavailable.
+                # With several mailboxes only the asyncio engine can IDLE on all of them.
+                if self.config.use_idle and len(self.email_monitors) == 1:
+                    new_mail = self.email_monitor.wait_for_new_mail(
+                        self.config.idle_timeout,
+                        lambda: not self.running
+                    )
+                    if new_mail is not None:
+                        continue
+                
+                # Wait for the next check, staying responsive to shutdown
+                deadline = time.monotonic() + self.next_check_interval()
+                while self.running and time.monotonic() < deadline:
+                    time.sleep(min(1, deadline - time.monotonic()))
             
+            for email_monitor in self.email_monitors:
+                email_monitor.disconnect_from_mailbox()
+                self.logger.info(f"IMAP session stats for {email_monitor.config.mailbox_name}: {email_monitor.session.get_stats()}")
+            
+            # Give queued alerts a chance to go out before exiting; the rest stay in the outbox
+            self.sms_dispatcher.stop()
+            self.logger.info(f"SMS dispatch stats: {self.sms_dispatcher.get_stats()}")
+            self.logger.info(f"Alert latency by stage:\n{pipeline_latency.format_table()}")
+            self.health_watchdog.stop()
+            self.outbox.close()
             self.logger.info("Email monitoring stopped")
             return True
-            
+        
         except Exception as e:
             self.logger.error(f"Critical error in monitoring loop: {str(e)}")
             return False
+    
+    def run_async_engine(self):
+        """Run monitoring, the HTTP endpoint and the pinger on one asyncio event loop"""
+        from async_engine import AsyncMonitoringEngine
+        
+        self.logger.info("Testing Twilio connection...")
+        if not self.sms_sender.test_connection():
+            self.logger.error("Twilio connection test failed")
+            return False
+        
+        engine = AsyncMonitoringEngine(
+            self,
+            http_routes=HealthCheckHandler.routes,
+            http_port=self.get_http_port(),
+            keep_alive_url=self.get_keep_alive_url(),
+            health_watchdog=self.health_watchdog
+        )
+        result = engine.run()
+        self.logger.info(f"SMS dispatch stats: {self.sms_dispatcher.get_stats()}")
+        self.logger.info(f"Alert latency by stage:\n{pipeline_latency.format_table()}")
+        self.outbox.close()
+        self.logger.info("Email monitoring stopped")
+        return result
 
 def main():
     """Entry point for the application"""
@@ -0,0 +1,306 @@
+"""
+Durable SMS outbox: every alert is recorded before it is sent
+"""
+
+import hashlib
+import random
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+# Ceiling for the exponential backoff between delivery attempts
+MAX_RETRY_DELAY_SECONDS = 15 * 60
+
+def alert_key(email_info, recipient):
+    """Idempotency key for one alert: the email's Message-ID plus the recipient"""
+    identity = (email_info.get('message_id') or '').strip()
+    if not identity:
+        # Without a Message-ID, fall back to headers that identify the email
+        identity = '|'.join(email_info.get(name, '') for name in ('from', 'subject', 'date'))
+    return hashlib.sha256(f"{identity}|{recipient}".encode('utf-8')).hexdigest()[:32]
+
+# Most alerts merged into one digest SMS
+MAX_DIGEST_ALERTS = 10
+
+class SMSOutbox:
+    """SQLite table of alerts with their delivery state
+    
+    pending -> sending -> sent, or back to pending with a backoff delay, or
+    failed once the attempts are used up. A row is committed as "sending"
+    before every attempt, so after a crash the rows left in that state
+    (claimed by an earlier run) are known to be in doubt and are reconciled
+    against Twilio instead of being sent blindly a second time.
+    
+    With a coalescing window, a new alert is held until no further alert for
+    the same recipient has arrived for coalesce_window seconds, but never
+    longer than coalesce_max_delay after it was recorded. The held alerts are
+    then claimed together and sent as one digest.
+    """
+    
+    def __init__(self, path, logger, max_attempts=6, retry_delay=5, coalesce_window=0, coalesce_max_delay=0):
+        self.path = path or ':memory:'
+        self.logger = logger
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.coalesce_window = coalesce_window
+        self.coalesce_max_delay = max(coalesce_max_delay, coalesce_window)
+        self.run_id = uuid.uuid4().hex
+        self.lock = threading.Lock()
+        
+        self.connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self.connection.row_factory = sqlite3.Row
+        if path:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            # Every state change must survive a power cut, not just a crash
+            self.connection.execute("PRAGMA synchronous=FULL")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS outbox (
+                key TEXT PRIMARY KEY,
+                recipient TEXT NOT NULL,
+                message TEXT NOT NULL,
+                description TEXT,
+                summary TEXT,
+                email_sent_at REAL,
+                email_arrived_at REAL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL,
+                last_attempt_at REAL,
+                claimed_by TEXT,
+                batch_id TEXT,
+                sent_body TEXT,
+                message_sid TEXT,
+                last_error TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        """)
+        
+        # Outboxes created before digests and latency tracking were added lack these columns
+        columns = {row['name'] for row in self.connection.execute("PRAGMA table_info(outbox)")}
+        for column, column_type in (('summary', 'TEXT'), ('batch_id', 'TEXT'), ('sent_body', 'TEXT'),
+                                    ('email_sent_at', 'REAL'), ('email_arrived_at', 'REAL')):
+            if column not in columns:
+                self.connection.execute(f"ALTER TABLE outbox ADD COLUMN {column} {column_type}")
+        
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, next_attempt_at)"
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS outbox_recipient ON outbox (recipient, status)"
+        )
+    
+    @contextmanager
+    def transaction(self):
+        """Hold the lock for one BEGIN IMMEDIATE ... COMMIT, so a batch of updates lands whole or not at all"""
+        with self.lock, self.connection:
+            self.connection.execute("BEGIN IMMEDIATE")
+            yield
+    
+    def add(self, key, recipient, message, description, summary=None, email_sent_at=None, email_arrived_at=None):
+        """Record an alert; returns False if this key was already recorded
+        
+        summary is the alert's line in a digest; message is sent when the
+        alert goes out on its own. The email's Date header and IMAP arrival
+        times, when known, are kept to measure end-to-end latency.
+        """
+        now = time.time()
+        with self.transaction():
+            cursor = self.connection.execute(
+                "INSERT OR IGNORE INTO outbox "
+                "(key, recipient, message, description, summary, email_sent_at, email_arrived_at, "
+                "next_attempt_at, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, recipient, message, description, summary, email_sent_at, email_arrived_at,
+                 now + self.coalesce_window, now, now)
+            )
+            if cursor.rowcount != 1:
+                return False
+            
+            if self.coalesce_window:
+                # Restart the recipient's window, bounded by each alert's maximum delay
+                self.connection.execute(
+                    "UPDATE outbox SET next_attempt_at = MIN(?, created_at + ?) "
+                    "WHERE recipient = ? AND status = 'pending' AND attempts = 0",
+                    (now + self.coalesce_window, self.coalesce_max_delay, recipient)
+                )
+        return True
+    
+    def claim_batch(self, key, limit=MAX_DIGEST_ALERTS):
+        """Mark a due alert and the recipient's other pending alerts as being sent
+        
+        Returns their rows as they were before the claim (oldest first, the
+        given alert always included), or an empty list if the alert is not
+        pending and due. Alerts waiting out a retry backoff or deferral only
+        ride along once due themselves, so they never use up attempts early;
+        alerts not attempted yet (e.g. held for coalescing) always do.
+        """
+        now = time.time()
+        with self.transaction():
+            leader = self.connection.execute(
+                "SELECT * FROM outbox WHERE key = ? AND status = 'pending' AND next_attempt_at <= ?", (key, now)
+            ).fetchone()
+            if leader is None:
+                return []
+            
+            rows = [leader] + self.connection.execute(
+                "SELECT * FROM outbox WHERE recipient = ? AND status = 'pending' AND key != ? "
+                "AND (attempts = 0 OR next_attempt_at <= ?) ORDER BY created_at LIMIT ?",
+                (leader['recipient'], key, now, limit - 1)
+            ).fetchall()
+            rows = sorted((dict(row) for row in rows), key=lambda row: row['created_at'])
+            
+            batch_id = uuid.uuid4().hex
+            self.connection.executemany(
+                "UPDATE outbox SET status = 'sending', attempts = attempts + 1, last_attempt_at = ?, "
+                "claimed_by = ?, batch_id = ?, sent_body = NULL, updated_at = ? WHERE key = ?",
+                [(now, self.run_id, batch_id, now, row['key']) for row in rows]
+            )
+        return rows
+    
+    def set_sent_body(self, keys, body):
+        """Record the exact text about to be sent, for reconciliation after a crash"""
+        with self.transaction():
+            self.connection.executemany(
+                "UPDATE outbox SET sent_body = ? WHERE key = ?", [(body, key) for key in keys]
+            )
+    
+    def defer(self, keys, delay):
+        """Return claimed alerts to pending without counting the attempt, e.g. when rate limited"""
+        now = time.time()
+        with self.transaction():
+            self.connection.executemany(
+                "UPDATE outbox SET status = 'pending', attempts = attempts - 1, next_attempt_at = ?, "
+                "sent_body = NULL, updated_at = ? WHERE key = ? AND status = 'sending'",
+                [(now + delay, now, key) for key in keys]
+            )
+    
+    def mark_sent(self, keys, message_sid):
+        now = time.time()
+        with self.transaction():
+            self.connection.executemany(
+                "UPDATE outbox SET status = 'sent', message_sid = ?, last_error = NULL, updated_at = ? WHERE key = ?",
+                [(message_sid, now, key) for key in keys]
+            )
+    
+    def mark_attempt_failed(self, keys, error):
+        """Schedule retries with exponential backoff and jitter; returns {key: new status}"""
+        now = time.time()
+        statuses = {}
+        with self.transaction():
+            for key in keys:
+                row = self.connection.execute("SELECT attempts FROM outbox WHERE key = ?", (key,)).fetchone()
+                if row is None:
+                    continue
+                
+                attempts = row['attempts']
+                if attempts >= self.max_attempts:
+                    status, next_attempt_at = 'failed', now
+                else:
+                    delay = min(self.retry_delay * 2 ** (attempts - 1), MAX_RETRY_DELAY_SECONDS)
+                    status, next_attempt_at = 'pending', now + delay * random.uniform(0.5, 1.5)
+                
+                self.connection.execute(
+                    "UPDATE outbox SET status = ?, next_attempt_at = ?, last_error = ?, updated_at = ? WHERE key = ?",
+                    (status, next_attempt_at, error, now, key)
+                )
+                statuses[key] = status
+        return statuses
+    
+    def due(self, limit=100):
+        """Keys of pending alerts whose next attempt is due"""
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT key FROM outbox WHERE status = 'pending' AND next_attempt_at <= ? "
+                "ORDER BY next_attempt_at LIMIT ?",
+                (time.time(), limit)
+            ).fetchall()
+        return [row['key'] for row in rows]
+    
+    def known_sids(self, since):
+        """Twilio SIDs recorded for alerts updated since the given time"""
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT message_sid FROM outbox WHERE message_sid IS NOT NULL AND updated_at >= ?", (since,)
+            ).fetchall()
+        return {row['message_sid'] for row in rows}
+    
+    def in_doubt(self):
+        """Alerts an earlier run started sending but never recorded the outcome of"""
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT * FROM outbox WHERE status = 'sending' AND claimed_by != ? ORDER BY last_attempt_at",
+                (self.run_id,)
+            ).fetchall()
+        return [dict(row) for row in rows]
+    
+    def recover(self, find_sent_message):
+        """Resolve in-doubt alerts: sent if Twilio has the message, otherwise retried
+        
+        find_sent_message(recipient, message, since, exclude) returns the SID
+        of a matching message (not in exclude) or None, and raises if Twilio
+        cannot be asked; the rows then stay in doubt until the next call.
+        Alerts claimed together as a digest are resolved together.
+        """
+        batches = {}
+        for row in self.in_doubt():
+            batches.setdefault(row['batch_id'] or row['key'], []).append(row)
+        
+        matched_sids = set()
+        for rows in batches.values():
+            first = rows[0]
+            keys = [row['key'] for row in rows]
+            description = ', '.join(row['description'] or '' for row in rows)
+            try:
+                # Outboxes from before digests recorded no sent_body; the message was sent as is
+                sid = find_sent_message(
+                    first['recipient'], first['sent_body'] or first['message'], first['last_attempt_at'], matched_sids
+                )
+            except Exception as e:
+                self.logger.warning(f"Cannot reconcile in-doubt SMS for {description} yet: {str(e)}")
+                return False
+            
+            if sid:
+                matched_sids.add(sid)
+                self.mark_sent(keys, sid)
+                self.logger.info(f"In-doubt SMS for {description} was already delivered ({sid})")
+            else:
+                now = time.time()
+                with self.transaction():
+                    self.connection.executemany(
+                        "UPDATE outbox SET status = 'pending', next_attempt_at = ?, updated_at = ? WHERE key = ?",
+                        [(now, now, key) for key in keys]
+                    )
+                self.logger.info(f"In-doubt SMS for {description} was not delivered, retrying")
+        return True
+    
+    def prune(self, retention_seconds):
+        """Delete finished alerts older than the retention window"""
+        with self.lock:
+            self.connection.execute(
+                "DELETE FROM outbox WHERE status IN ('sent', 'failed') AND updated_at < ?",
+                (time.time() - retention_seconds,)
+            )
+    
+    def get_stats(self):
+        """Number of alerts in each delivery state"""
+        with self.lock:
+            rows = self.connection.execute("SELECT status, COUNT(*) AS count FROM outbox GROUP BY status").fetchall()
+        stats = dict.fromkeys(('pending', 'sending', 'sent', 'failed'), 0)
+        stats.update({row['status']: row['count'] for row in rows})
+        return stats
+    
+    def backlog(self):
+        """(alerts not yet sent or abandoned, created_at of the oldest) from the status index"""
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT COUNT(*) AS count, MIN(created_at) AS oldest FROM outbox "
+                "WHERE status IN ('pending', 'sending')"
+            ).fetchone()
+        return row['count'], row['oldest']
+    
+    def close(self):
+        with self.lock:
+            self.connection.close()
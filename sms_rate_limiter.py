@@ -0,0 +1,152 @@
+"""
+Client-side send rate limiting per Twilio sender number
+"""
+
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+# Pause after a 429 without a usable Retry-After, doubling per consecutive 429
+DEFAULT_THROTTLE_SECONDS = 1.0
+MAX_THROTTLE_SECONDS = 60.0
+
+# After a 429 the rate is halved, down to this fraction of the configured rate,
+# and grows back by a tenth of the configured rate per successful send
+MIN_RATE_FRACTION = 0.1
+RATE_RECOVERY_FRACTION = 0.1
+
+def parse_retry_after(value):
+    """Seconds to wait from a Retry-After header (delta-seconds or HTTP date), or None"""
+    if not value:
+        return None
+    
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+class TokenBucket:
+    """rate tokens per second, holding at most burst"""
+    
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.consecutive_throttles = 0
+    
+    def refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+    
+    def take(self, now):
+        """Take a token; returns 0 on success, otherwise the seconds until one is available"""
+        if now < self.paused_until:
+            return self.paused_until - now
+        
+        self.refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+class SendRateLimiter:
+    """One token bucket per sender number, shared by every caller of an SMSSender
+    
+    acquire() never blocks: callers that get a wait time put the alert back in
+    the outbox for later. A 429 from Twilio pauses the number for Retry-After
+    (or an exponential back-off when the header is missing) and halves its
+    rate; each successful send then raises the rate back towards the
+    configured one.
+    """
+    
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}
+        self.lock = threading.Lock()
+        
+        # Statistics
+        self.granted = 0
+        self.limited = 0
+        self.throttles = 0
+    
+    def _bucket(self, sender):
+        bucket = self.buckets.get(sender)
+        if bucket is None:
+            bucket = self.buckets[sender] = TokenBucket(self.rate, self.burst)
+        return bucket
+    
+    def acquire(self, sender):
+        """Reserve one send for sender; returns 0, or the seconds to wait before trying again"""
+        with self.lock:
+            wait = self._bucket(sender).take(time.monotonic())
+            if wait:
+                self.limited += 1
+            else:
+                self.granted += 1
+            return wait
+    
+    def delay(self, sender):
+        """Seconds until sender may send again, without taking a token"""
+        with self.lock:
+            bucket = self._bucket(sender)
+            now = time.monotonic()
+            if now < bucket.paused_until:
+                return bucket.paused_until - now
+            bucket.refill(now)
+            return 0.0 if bucket.tokens >= 1 else (1 - bucket.tokens) / bucket.rate
+    
+    def available(self, sender):
+        """Whole sends sender could make right now"""
+        with self.lock:
+            bucket = self._bucket(sender)
+            now = time.monotonic()
+            if now < bucket.paused_until:
+                return 0
+            bucket.refill(now)
+            return int(bucket.tokens)
+    
+    def throttle(self, sender, retry_after=None):
+        """Twilio rejected a send with 429: pause the number and slow it down"""
+        with self.lock:
+            bucket = self._bucket(sender)
+            if retry_after is None:
+                retry_after = min(
+                    DEFAULT_THROTTLE_SECONDS * 2 ** bucket.consecutive_throttles, MAX_THROTTLE_SECONDS
+                )
+            
+            now = time.monotonic()
+            bucket.paused_until = max(bucket.paused_until, now + retry_after)
+            bucket.rate = max(self.rate * MIN_RATE_FRACTION, bucket.rate / 2)
+            
+            # Tokens only start accruing again once the pause is over
+            bucket.tokens = 0.0
+            bucket.updated = bucket.paused_until
+            bucket.consecutive_throttles += 1
+            self.throttles += 1
+            return retry_after
+    
+    def record_success(self, sender):
+        with self.lock:
+            bucket = self._bucket(sender)
+            bucket.consecutive_throttles = 0
+            if bucket.rate < self.rate:
+                bucket.refill(time.monotonic())
+                bucket.rate = min(self.rate, bucket.rate + self.rate * RATE_RECOVERY_FRACTION)
+    
+    def get_stats(self):
+        with self.lock:
+            return {
+                'granted': self.granted,
+                'limited': self.limited,
+                'throttles': self.throttles,
+                'rates': {sender: round(bucket.rate, 3) for sender, bucket in self.buckets.items()},
+            }
@@ -3,14 +3,127 @@ SMS sending module using Twilio for notifications
 """
 
 import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from requests.adapters import HTTPAdapter
 from twilio.rest import Client
-from twilio.base.exceptions import TwilioException
+from twilio.base.exceptions import TwilioException, TwilioRestException
+from twilio.http.http_client import TwilioHttpClient
+
+from latency_metrics import pipeline_latency
+from sms_rate_limiter import SendRateLimiter, parse_retry_after
+
+# Twilio timestamps have one-second resolution and our clock may drift, so a
+# message created slightly before an attempt started may still belong to it
+RECONCILE_SLACK_SECONDS = 60
+
+# How often the dispatcher looks for alerts whose retry backoff has expired
+PUMP_INTERVAL_SECONDS = 1.0
+
+# How often delivered and abandoned alerts past the retention window are deleted
+PRUNE_INTERVAL_SECONDS = 3600
+
+# Messages are cut to this length to minimize cost and stay on the free service (was 1600)
+MAX_MESSAGE_CHARS = 50
+
+# GSM 03.38 characters; anything else forces UCS-2, which fits far less per segment
+GSM7_BASIC_CHARS = frozenset(
+    "@£$¥èéùìòÇ\nØø\rÅåΔ_ΦΓΛΩΠΨΣΘΞÆæßÉ !\"#¤%&'()*+,-./0123456789:;<=>?"
+    "¡ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÑÜ§¿abcdefghijklmnopqrstuvwxyzäöñüà"
+)
+GSM7_EXTENDED_CHARS = frozenset("^{}\\[~]|€\f")
+
+def sms_segment_count(text):
+    """Number of SMS segments Twilio bills for text"""
+    if all(char in GSM7_BASIC_CHARS or char in GSM7_EXTENDED_CHARS for char in text):
+        # Extended characters take an escape plus the character
+        units = len(text) + sum(char in GSM7_EXTENDED_CHARS for char in text)
+        single, multipart = 160, 153
+    else:
+        units = len(text.encode('utf-16-le')) // 2
+        single, multipart = 70, 67
+    
+    if units <= single:
+        return 1
+    return -(-units // multipart)
+
+def build_digest_message(rows, max_segments=1):
+    """One SMS for several alerts: a count, then as many summaries as fit
+    
+    Stays within max_segments and MAX_MESSAGE_CHARS; alerts whose summary
+    does not fit are counted in a trailing "+N more".
+    """
+    def fits(text):
+        return len(text) <= MAX_MESSAGE_CHARS and sms_segment_count(text) <= max_segments
+    
+    header = f"{len(rows)} Bookeo alerts:"
+    summaries = [row['summary'] or row['description'] or '' for row in rows]
+    
+    lines = [header]
+    for index, summary in enumerate(summaries):
+        remaining = len(summaries) - index - 1
+        more = f"\n+{remaining} more" if remaining else ""
+        if fits('\n'.join(lines + [summary]) + more):
+            lines.append(summary)
+            continue
+        
+        # The count alone says it all when not even one summary fits
+        if len(lines) > 1 and fits('\n'.join(lines + [f"+{remaining + 1} more"])):
+            lines.append(f"+{remaining + 1} more")
+        else:
+            lines = [header]
+        break
+    
+    if len(lines) == 1:
+        return f"{len(rows)} new Bookeo alerts"
+    return '\n'.join(lines)
+
+class SMSThrottled(Exception):
+    """A send was held back by the rate limiter or rejected by Twilio with 429"""
+    
+    def __init__(self, retry_after):
+        super().__init__(f"rate limited, retry in {retry_after:.1f}s")
+        self.retry_after = retry_after
+
+class PooledTwilioHttpClient(TwilioHttpClient):
+    """TwilioHttpClient with a sized keep-alive connection pool that reports 429s to the rate limiter
+    
+    The session keeps up to pool_size connections open between requests, so
+    only the first request on each pays for the TCP and TLS handshakes.
+    last_request_at tells the sender when the pool was last used, so it can
+    refresh connections before Twilio drops them as idle.
+    """
+    
+    def __init__(self, rate_limiter, pool_size=4, timeout=None, **kwargs):
+        super().__init__(pool_connections=True, timeout=timeout, **kwargs)
+        self.rate_limiter = rate_limiter
+        self.pool_size = pool_size
+        self.last_request_at = None
+        
+        # http:// too, for a local fake Twilio endpoint
+        adapter = HTTPAdapter(pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+    
+    def request(self, method, url, params=None, data=None, headers=None, auth=None, timeout=None,
+                allow_redirects=False):
+        response = super().request(method, url, params, data, headers, auth, timeout, allow_redirects)
+        self.last_request_at = time.monotonic()
+        if response.status_code == 429 and data and data.get('From'):
+            self.rate_limiter.throttle(data['From'], parse_retry_after((response.headers or {}).get('Retry-After')))
+        return response
 
 class SMSSender:
     def __init__(self, config, logger):
         self.config = config
         self.logger = logger
         self.client = None
+        
+        # Shared by the dispatch workers and the asyncio engine
+        self.rate_limiter = SendRateLimiter(config.sms_rate_limit, config.sms_rate_burst)
         self.setup_twilio_client()
     
     def setup_twilio_client(self):
@@ -23,10 +136,19 @@ class SMSSender:
                 self.logger.error("Twilio credentials not found in environment variables")
                 return False
             
-            self.client = Client(account_sid, auth_token)
+            http_client = PooledTwilioHttpClient(
+                self.rate_limiter, pool_size=self.config.sms_http_pool_size, timeout=self.config.sms_http_timeout
+            )
+            self.client = Client(account_sid, auth_token, http_client=http_client)
+            
+            # Point at a local fake Twilio endpoint for testing
+            api_base_url = os.getenv("TWILIO_API_BASE_URL")
+            if api_base_url:
+                self.client.api.base_url = api_base_url
+            
             self.logger.info("Twilio client initialized successfully")
             return True
-            
+        
         except Exception as e:
             self.logger.error(f"Error setting up Twilio client: {str(e)}")
             return False
@@ -44,7 +166,7 @@ class SMSSender:
             account = self.client.api.accounts(self.client.username).fetch()
             self.logger.info(f"Twilio connection successful. Account: {account.friendly_name}")
             return True
-            
+        
         except TwilioException as e:
             self.logger.error(f"Twilio connection test failed: {str(e)}")
             return False
@@ -52,6 +174,49 @@ class SMSSender:
             self.logger.error(f"Error testing Twilio connection: {str(e)}")
             return False
     
+    def warm_up(self, connections=1):
+        """Open up to connections pooled connections to Twilio before the first alert needs them
+        
+        Each concurrent account fetch takes its own connection from the pool,
+        which keeps it open afterwards. Returns the number that succeeded.
+        """
+        if not self.client:
+            return 0
+        
+        connections = max(1, min(connections, self.client.http_client.pool_size))
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=connections, thread_name_prefix="twilio-warm-up") as executor:
+            results = list(executor.map(lambda _: self._fetch_account(), range(connections)))
+        
+        warmed = sum(results)
+        self.logger.debug("Warmed up %d/%d Twilio connection(s) in %.3fs", warmed, connections, time.monotonic() - start)
+        return warmed
+    
+    def keep_warm(self, connections=1):
+        """Refresh the pooled connections if they have been idle for the keep-alive interval
+        
+        Twilio closes idle connections, after which the next alert would pay
+        for a new TLS handshake. Each refresh is an Account fetch per
+        connection, so it only runs when SMS_HTTP_KEEPALIVE_INTERVAL is set.
+        Returns True if the connections were refreshed.
+        """
+        interval = self.config.sms_http_keepalive_interval
+        if not self.client or not interval:
+            return False
+        
+        last_request_at = self.client.http_client.last_request_at
+        if last_request_at is None or time.monotonic() - last_request_at < interval:
+            return False
+        return self.warm_up(connections) > 0
+    
+    def _fetch_account(self):
+        try:
+            self.client.api.accounts(self.client.username).fetch()
+            return True
+        except Exception as e:
+            self.logger.debug(f"Twilio connection warm-up failed: {str(e)}")
+            return False
+    
     def format_phone_number(self, phone_number):
         """Format phone number for Twilio (ensure it starts with +1)"""
         # Remove any non-digit characters
@@ -67,42 +232,104 @@ class SMSSender:
         else:
             return f"+1{clean_number}"
     
-    def send_notification(self, to_phone_number, message):
-        """Send SMS notification via Twilio"""
+    def build_message_params(self, to_phone_number, message):
+        """Prepare the Twilio message parameters, or None if no sender number is configured"""
+        # Get Twilio phone number from environment
+        from_phone = os.getenv("TWILIO_PHONE_NUMBER")
+        if not from_phone:
+            self.logger.error("TWILIO_PHONE_NUMBER not found in environment variables")
+            return None
+        
+        return {
+            'body': message[:MAX_MESSAGE_CHARS],  # Limit message length
+            'from_': self.format_phone_number(from_phone),
+            'to': self.format_phone_number(to_phone_number),
+        }
+    
+    def available_sends(self):
+        """How many messages the rate limiter would let through right now"""
+        from_phone = os.getenv("TWILIO_PHONE_NUMBER")
+        if not from_phone:
+            # Let sends through so the missing number is reported
+            return self.rate_limiter.burst
+        return self.rate_limiter.available(self.format_phone_number(from_phone))
+    
+    def send_message(self, to_phone_number, message):
+        """Send an SMS via Twilio and return its message SID, or None if it failed
+        
+        Raises SMSThrottled when the sender number is over its rate limit or
+        Twilio answered 429; nothing was sent and the caller should retry later.
+        """
         if not self.client:
             self.logger.error("Twilio client not initialized")
-            return False
+            return None
         
+        params = None
         try:
-            # Get Twilio phone number from environment
-            from_phone = os.getenv("TWILIO_PHONE_NUMBER")
-            if not from_phone:
-                self.logger.error("TWILIO_PHONE_NUMBER not found in environment variables")
-                return False
+            params = self.build_message_params(to_phone_number, message)
+            if params is None:
+                return None
             
-            # Format phone numbers
-            formatted_to = self.format_phone_number(to_phone_number)
-            formatted_from = self.format_phone_number(from_phone)
+            wait = self.rate_limiter.acquire(params['from_'])
+            if wait:
+                raise SMSThrottled(wait)
             
-            self.logger.info(f"Sending SMS from {formatted_from} to {formatted_to}")
+            self.logger.info(f"Sending SMS from {params['from_']} to {params['to']}")
             
             # Send SMS
-            twilio_message = self.client.messages.create(
-                body=message[:50],  # Limit message length  # was [:1600 and shortened to 50 to minimize cost and use free service
-                from_=formatted_from,
-                to=formatted_to
-            )
+            twilio_message = self.client.messages.create(**params)
+            self.rate_limiter.record_success(params['from_'])
             
             self.logger.info(f"SMS sent successfully. Message SID: {twilio_message.sid}")
-            return True
-            
+            return twilio_message.sid
+        
+        except SMSThrottled:
+            raise
+        except TwilioRestException as e:
+            if e.status == 429:
+                self.logger.warning(f"Twilio rate limited {params['from_']}: {e.msg}")
+                sender = params['from_']
+                raise SMSThrottled(self.rate_limiter.delay(sender) or self.rate_limiter.throttle(sender))
+            self.logger.error(f"Twilio error sending SMS: {str(e)}")
+            return None
         except TwilioException as e:
             self.logger.error(f"Twilio error sending SMS: {str(e)}")
-            return False
+            return None
         except Exception as e:
             self.logger.error(f"Error sending SMS notification: {str(e)}")
+            return None
+    
+    def send_notification(self, to_phone_number, message):
+        """Send SMS notification via Twilio"""
+        try:
+            return self.send_message(to_phone_number, message) is not None
+        except SMSThrottled as e:
+            self.logger.error(f"SMS not sent: {str(e)}")
             return False
     
+    def find_sent_message(self, to_phone_number, message, since, exclude=()):
+        """Return the SID of a message Twilio already accepted for this alert, or None
+        
+        Used before re-sending an alert whose earlier attempt may have reached
+        Twilio. Raises if Twilio cannot be asked, because "not sent" must never
+        be guessed.
+        """
+        if not self.client:
+            raise RuntimeError("Twilio client not initialized")
+        
+        params = self.build_message_params(to_phone_number, message)
+        if params is None:
+            raise RuntimeError("TWILIO_PHONE_NUMBER not configured")
+        
+        earliest = datetime.fromtimestamp(since - RECONCILE_SLACK_SECONDS, timezone.utc)
+        for sent in self.client.messages.list(to=params['to'], from_=params['from_'], limit=50):
+            if sent.sid in exclude or (sent.date_created and sent.date_created < earliest):
+                continue
+            # Trial accounts prefix the body, so compare the end
+            if (sent.body or '').endswith(params['body']):
+                return sent.sid
+        return None
+    
     def send_test_message(self, to_phone_number):
         """Send a test message to verify SMS functionality"""
         test_message = (
@@ -112,3 +339,309 @@ class SMSSender:
         
         self.logger.info("Sending test SMS message...")
         return self.send_notification(to_phone_number, test_message)
+
+class SMSDispatchQueue:
+    """Bounded queue of outbox alerts delivered by a pool of worker threads
+    
+    The monitoring loop only records alerts in the SMSOutbox and enqueues
+    their keys; sending, retries and their logging happen on the workers so a
+    slow Twilio response never delays the next IMAP check. A pump thread
+    queues alerts whose retry backoff or coalescing window has expired, and
+    anything that did not fit in the queue, so nothing recorded in the outbox
+    is dropped. A worker sends all of a recipient's pending alerts at once,
+    as a digest when there are several.
+    """
+    
+    def __init__(self, sms_sender, outbox, config, logger):
+        self.sms_sender = sms_sender
+        self.outbox = outbox
+        self.logger = logger
+        self.worker_count = config.sms_workers
+        self.queue = queue.Queue(maxsize=config.sms_queue_size)
+        self.queued = set()
+        self.stop_event = threading.Event()
+        self.workers = []
+        self.max_segments = config.sms_max_segments
+        self.pump_interval = PUMP_INTERVAL_SECONDS
+        self.retention_seconds = config.dedup_retention_days * 24 * 3600
+        self.last_prune = float('-inf')
+        
+        # Dispatch statistics
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.attempts = 0
+        self.messages = 0
+        self.coalesced = 0
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self.deferred = 0
+        self.throttled = 0
+        self.total_send_time = 0.0
+        self.max_send_time = 0.0
+        self.total_queue_wait = 0.0
+    
+    def start(self):
+        """Reconcile sends interrupted by a crash, warm up Twilio connections, then start the workers and the pump"""
+        self.outbox.recover(self.find_sent_message)
+        
+        # One pooled connection per worker, so the first alerts skip the TLS handshake
+        self.sms_sender.warm_up(self.worker_count)
+        
+        for index in range(self.worker_count):
+            worker = threading.Thread(target=self._worker, name=f"sms-worker-{index}", daemon=True)
+            worker.start()
+            self.workers.append(worker)
+        
+        pump = threading.Thread(target=self._pump, name="sms-pump", daemon=True)
+        pump.start()
+        self.workers.append(pump)
+        self.logger.info(f"SMS dispatch queue started with {self.worker_count} worker(s)")
+    
+    def find_sent_message(self, to_phone_number, message, since, exclude=()):
+        # SIDs already recorded for other alerts can never belong to this one
+        known_sids = self.outbox.known_sids(since - RECONCILE_SLACK_SECONDS)
+        return self.sms_sender.find_sent_message(to_phone_number, message, since, known_sids | set(exclude))
+    
+    def submit(self, keys):
+        """Queue newly recorded alerts; held ones are queued by the pump when their window closes"""
+        if self.outbox.coalesce_window:
+            return
+        for key in keys:
+            self.enqueue(key)
+    
+    def enqueue(self, key):
+        """Queue an outbox alert without blocking; a full queue leaves it to the pump"""
+        with self.lock:
+            if key in self.queued:
+                return True
+            try:
+                self.queue.put_nowait((key, time.monotonic()))
+                self.queued.add(key)
+                return True
+            except queue.Full:
+                self.deferred += 1
+        
+        self.logger.warning(f"SMS queue full ({self.queue.maxsize}), alert stays in the outbox for later")
+        return False
+    
+    def poll_outbox(self):
+        """Reconcile in-doubt alerts, prune old ones and return the keys due for an attempt"""
+        if self.outbox.in_doubt():
+            self.outbox.recover(self.find_sent_message)
+        
+        now = time.monotonic()
+        if now - self.last_prune >= PRUNE_INTERVAL_SECONDS:
+            self.outbox.prune(self.retention_seconds)
+            self.last_prune = now
+        
+        # Alerts beyond what the rate limiter allows stay in the outbox instead of
+        # being claimed and deferred over and over
+        with self.lock:
+            busy = len(self.queued) + self.in_flight
+        capacity = self.sms_sender.available_sends() - busy
+        if capacity <= 0:
+            return []
+        return self.outbox.due(limit=min(capacity, self.queue.maxsize))
+    
+    def _pump(self):
+        while not self.stop_event.wait(self.pump_interval):
+            try:
+                for key in self.poll_outbox():
+                    if not self.enqueue(key):
+                        break
+                self.sms_sender.keep_warm(self.worker_count)
+            except Exception as e:
+                self.logger.error(f"Error in SMS outbox pump: {str(e)}")
+    
+    def _worker(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                self.queue.task_done()
+                return
+            
+            key, queued_at = job
+            with self.lock:
+                self.queued.discard(key)
+                self.in_flight += 1
+                self.total_queue_wait += time.monotonic() - queued_at
+            
+            try:
+                self._deliver(key)
+            except Exception as e:
+                self.logger.error(f"Error in SMS worker: {str(e)}")
+            finally:
+                with self.lock:
+                    self.in_flight -= 1
+                self.queue.task_done()
+    
+    def _deliver(self, key):
+        prepared = self.prepare_delivery(key)
+        if prepared is None:
+            return
+        
+        rows, body = prepared
+        start = time.monotonic()
+        sid, error = None, "send failed"
+        try:
+            sid = self.sms_sender.send_message(rows[0]['recipient'], body)
+        except SMSThrottled as e:
+            self.defer(rows, e.retry_after)
+            return
+        except Exception as e:
+            error = str(e)
+        
+        self.record_result(rows, sid, error, time.monotonic() - start)
+    
+    def defer(self, rows, delay):
+        """Put claimed alerts back in the outbox until the sender number may send again"""
+        self.outbox.defer([row['key'] for row in rows], delay)
+        with self.lock:
+            self.throttled += 1
+        self.logger.info(f"SMS for {self.describe(rows)} deferred {delay:.1f}s by rate limiting")
+    
+    def prepare_delivery(self, key):
+        """Claim a due alert with the recipient's other pending alerts and build their SMS
+        
+        Alerts an earlier attempt already delivered are settled first. Returns
+        (rows, body) for the rest, or None if nothing is left to send. May
+        query Twilio, so the asyncio engine runs it in a thread.
+        """
+        rows = self.outbox.claim_batch(key)
+        if not rows:
+            # Not due, already sent, given up on, or taken by another worker
+            return None
+        
+        try:
+            rows = self._settle_previous_attempts(rows)
+        except Exception as e:
+            self.record_result(rows, None, str(e), 0.0)
+            return None
+        if not rows:
+            return None
+        
+        body = rows[0]['message'] if len(rows) == 1 else build_digest_message(rows, self.max_segments)
+        self.outbox.set_sent_body([row['key'] for row in rows], body)
+        return rows, body
+    
+    def _settle_previous_attempts(self, rows):
+        """Mark alerts whose previous attempt reached Twilio as sent; returns the others"""
+        remaining = []
+        attempts = {}
+        for row in rows:
+            if row['attempts'] > 0:
+                attempts.setdefault(row['batch_id'] or row['key'], []).append(row)
+            else:
+                remaining.append(row)
+        
+        for previous in attempts.values():
+            # The previous attempt may have reached Twilio even though it reported an error
+            first = previous[0]
+            sid = self.find_sent_message(
+                first['recipient'], first['sent_body'] or first['message'], first['last_attempt_at']
+            )
+            if sid is None:
+                remaining.extend(previous)
+                continue
+            
+            self.outbox.mark_sent([row['key'] for row in previous], sid)
+            with self.lock:
+                self.sent += len(previous)
+            self.logger.info(f"SMS alert for {self.describe(previous)} was already delivered ({sid})")
+        
+        remaining.sort(key=lambda row: row['created_at'])
+        return remaining
+    
+    def describe(self, rows):
+        if len(rows) == 1:
+            return rows[0]['description']
+        return f"{len(rows)} alerts ({', '.join(row['description'] or '' for row in rows)})"
+    
+    def record_result(self, rows, sid, error, elapsed):
+        """Store the outcome of one delivery attempt for claimed rows in the outbox, the stats and the log"""
+        keys = [row['key'] for row in rows]
+        if sid:
+            self.outbox.mark_sent(keys, sid)
+            statuses = dict.fromkeys(keys, 'sent')
+            self.record_latency(rows, elapsed)
+        else:
+            statuses = self.outbox.mark_attempt_failed(keys, error)
+        
+        counts = {status: list(statuses.values()).count(status) for status in ('sent', 'failed', 'pending')}
+        with self.lock:
+            self.attempts += 1
+            self.total_send_time += elapsed
+            self.max_send_time = max(self.max_send_time, elapsed)
+            if sid:
+                self.messages += 1
+                self.coalesced += len(rows) - 1
+            self.sent += counts['sent']
+            self.failed += counts['failed']
+            self.retries += counts['pending']
+        
+        description = self.describe(rows)
+        attempt = max(row['attempts'] for row in rows) + 1
+        if sid:
+            self.logger.info(
+                "SMS alert sent successfully for %s (%.2fs)", description, elapsed,
+                extra={'stage': 'send', 'duration': elapsed}
+            )
+        if counts['failed']:
+            self.logger.error(f"Failed to send SMS alert for {description} after {attempt} attempt(s): {error}")
+        if counts['pending']:
+            self.logger.warning(f"SMS attempt {attempt} for {description} failed, will retry with backoff: {error}")
+    
+    def record_latency(self, rows, elapsed):
+        """Observe the send and, for each alert in it, how long it took to reach Twilio"""
+        now = time.time()
+        pipeline_latency.observe('send', elapsed)
+        for row in rows:
+            pipeline_latency.observe('outbox', now - row['created_at'])
+            if row.get('email_arrived_at'):
+                pipeline_latency.observe('arrival_to_sms', now - row['email_arrived_at'])
+            if row.get('email_sent_at'):
+                pipeline_latency.observe('end_to_end', now - row['email_sent_at'])
+    
+    def stop(self, timeout=30):
+        """Deliver what is already queued (up to timeout seconds), then stop the workers
+        
+        Anything not delivered stays in the outbox for the next run.
+        """
+        self.stop_event.set()
+        deadline = time.monotonic() + timeout
+        for _ in range(self.worker_count):
+            try:
+                self.queue.put(None, timeout=max(0, deadline - time.monotonic()))
+            except queue.Full:
+                break
+        for worker in self.workers:
+            worker.join(max(0, deadline - time.monotonic()))
+        
+        pending = self.outbox.get_stats()['pending']
+        if pending:
+            self.logger.warning(f"SMS dispatch stopped with {pending} alert(s) left in the outbox")
+        self.workers = []
+    
+    def get_stats(self):
+        """Queue depth, delivery counts, latencies, outbox states and rate limiting"""
+        outbox_stats = self.outbox.get_stats()
+        rate_limiter_stats = self.sms_sender.rate_limiter.get_stats()
+        with self.lock:
+            attempts = max(self.attempts, 1)
+            return {
+                'queue_depth': self.queue.qsize(),
+                'in_flight': self.in_flight,
+                'messages': self.messages,
+                'coalesced': self.coalesced,
+                'sent': self.sent,
+                'failed': self.failed,
+                'retries': self.retries,
+                'deferred': self.deferred,
+                'throttled': self.throttled,
+                'avg_send_seconds': self.total_send_time / attempts,
+                'max_send_seconds': self.max_send_time,
+                'avg_queue_wait_seconds': self.total_queue_wait / attempts,
+                'outbox': outbox_stats,
+                'rate_limiter': rate_limiter_stats,
+            }
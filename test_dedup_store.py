@@ -0,0 +1,53 @@
+"""
+Tests for the processed-email store: resent, changed and cancelled bookings
+"""
+
+import logging
+
+from dedup_store import DedupStore, dedup_keys
+
+def booking_email(message_id, subject, booking_number="3100001"):
+    return {
+        'from': "Bookeo <noreply@bookeo.com>",
+        'subject': subject,
+        'date': "Sat, 17 Oct 2026 10:00:00 +0000",
+        'message_id': message_id,
+        'body': f"Booking number: {booking_number}\n",
+    }
+
+def process(store, emails):
+    new_emails = store.filter_new(emails)
+    store.commit(new_emails)
+    return [email_info['subject'] for email_info in new_emails]
+
+def make_store(tmp_path):
+    return DedupStore(str(tmp_path / "processed.log"), logging.getLogger("test_dedup_store"))
+
+def test_resent_booking_is_skipped(tmp_path):
+    store = make_store(tmp_path)
+    assert process(store, [booking_email("<a@bookeo.com>", "New booking: 3100001")]) == ["New booking: 3100001"]
+    assert process(store, [booking_email("<b@bookeo.com>", "New booking: 3100001")]) == []
+
+def test_changed_booking_is_alerted(tmp_path):
+    store = make_store(tmp_path)
+    process(store, [booking_email("<a@bookeo.com>", "New booking: 3100001")])
+    assert process(store, [booking_email("<b@bookeo.com>", "Booking changed: 3100001")]) == ["Booking changed: 3100001"]
+
+def test_cancelled_booking_is_alerted(tmp_path):
+    store = make_store(tmp_path)
+    process(store, [booking_email("<a@bookeo.com>", "New booking: 3100001")])
+    process(store, [booking_email("<b@bookeo.com>", "Booking changed: 3100001")])
+    cancelled = booking_email("<c@bookeo.com>", "Booking cancelled: 3100001")
+    assert process(store, [cancelled]) == ["Booking cancelled: 3100001"]
+    assert process(store, [booking_email("<c@bookeo.com>", "Booking cancelled: 3100001")]) == []
+
+def test_keys_survive_restart(tmp_path):
+    process(make_store(tmp_path), [booking_email("<a@bookeo.com>", "New booking: 3100001")])
+    assert process(make_store(tmp_path), [booking_email("<a@bookeo.com>", "New booking: 3100001")]) == []
+
+def test_missing_message_id_falls_back_to_header_hash():
+    first = booking_email("", "New booking: 3100001")
+    other = dict(first, subject="Booking changed: 3100001")
+    assert dedup_keys(first)[0].startswith("hash:")
+    assert dedup_keys(first) == dedup_keys(dict(first))
+    assert dedup_keys(first)[0] != dedup_keys(other)[0]
@@ -0,0 +1,217 @@
+"""
+Tests for EmailMonitor against the fake IMAP server: FETCH parsing, IDLE,
+the UID checkpoint and dedup of changed and cancelled bookings
+"""
+
+import threading
+import time
+
+import pytest
+
+from email_monitor import compress_uid_set, decode_partial_body, iter_fetch_responses
+from fake_servers import FakeIMAPServer, FakeMailbox, generate_bookeo_message
+from harness import make_logger, make_monitor
+
+@pytest.fixture
+def server():
+    server = FakeIMAPServer(capabilities=("IMAP4rev1", "IDLE")).start()
+    yield server
+    server.stop()
+
+def subjects(emails):
+    return [email_info['subject'] for email_info in emails]
+
+def test_compress_uid_set():
+    assert compress_uid_set([3, 7, 9, 10, 11]) == "3,7,9:11"
+    assert compress_uid_set([11, 9, 10, 10, 3]) == "3,9:11"
+    assert compress_uid_set([5]) == "5"
+    assert compress_uid_set([]) == ""
+
+def test_iter_fetch_responses_splits_messages():
+    data = [
+        (b'1 (UID 4 INTERNALDATE "17-Oct-2026 10:00:00 +0000" BODY[HEADER] {9}', b'Subject: a'),
+        b')',
+        (b'2 (UID 9 BODY[1]<0> {4}', b'body'),
+        b' FLAGS (\\Seen))',
+        None,
+    ]
+    responses = list(iter_fetch_responses(data))
+    
+    assert [(response['sequence'], response['uid']) for response in responses] == [(1, 4), (2, 9)]
+    assert responses[0]['literals'] == {'BODY[HEADER]': b'Subject: a'}
+    assert b'INTERNALDATE' in responses[0]['attributes']
+    assert responses[1]['literals'] == {'BODY[1]<0>': b'body'}
+    assert b'FLAGS' in responses[1]['attributes']
+
+def test_iter_fetch_responses_inlines_literals_inside_attributes():
+    data = [(b'1 (UID 2 BODYSTRUCTURE ("TEXT" "PLAIN" ("NAME" {5}', b'a"b\\c'), b') NIL))']
+    response, = iter_fetch_responses(data)
+    
+    assert response['uid'] == 2
+    assert response['literals'] == {}
+    assert response['attributes'].endswith(b'("NAME" "a\\"b\\\\c") NIL))')
+
+def test_iter_fetch_responses_from_server(server):
+    for index in range(3):
+        server.mailbox.add_message(generate_bookeo_message(index))
+    connection = server.connect()
+    connection.select('INBOX')
+    status, data = connection.uid('FETCH', '1:3', '(UID BODY.PEEK[HEADER.FIELDS (SUBJECT)])')
+    connection.logout()
+    
+    assert status == 'OK'
+    assert [
+        (response['uid'], response['literals']['BODY[HEADER.FIELDS (SUBJECT)]'].strip())
+        for response in iter_fetch_responses(data)
+    ] == [(uid, f"Subject: New booking: {3099999 + uid}".encode()) for uid in (1, 2, 3)]
+
+def test_decode_partial_body_base64_cut_mid_quantum():
+    # "Booking number: 3100001" is 32 base64 characters; the cut leaves 29, one into a quantum
+    encoded = b"Qm9va2luZyBudW1i\r\nZXI6IDMxMDAwMDE="[:31]
+    assert decode_partial_body(encoded, 'BASE64', 'utf-8') == "Booking number: 31000"
+
+def test_decode_partial_body_quoted_printable_cut_mid_escape():
+    assert decode_partial_body(b"Caf=C3=A9 soft=\r\nbreak =C", 'QUOTED-PRINTABLE', 'utf-8') == "Café softbreak "
+    assert decode_partial_body(b"line=", 'QUOTED-PRINTABLE', 'utf-8') == "line"
+
+def test_decode_partial_body_charsets():
+    assert decode_partial_body("Café".encode('latin-1'), '8BIT', 'iso-8859-1') == "Café"
+    assert decode_partial_body(b"plain", '7BIT', 'no-such-charset') == "plain"
+    # A multi-byte character cut off by the byte limit is dropped
+    assert decode_partial_body("Café".encode('utf-8')[:-1], '8BIT', 'utf-8') == "Caf"
+
+def test_idle_wakes_up_on_mail_arriving_while_idle(server):
+    server.mailbox.add_message(generate_bookeo_message(0))
+    monitor = make_monitor(server, make_logger())
+    assert len(monitor.check_for_bookeo_emails()) == 1
+    
+    threading.Timer(0.3, lambda: server.mailbox.add_message(generate_bookeo_message(1))).start()
+    start = time.monotonic()
+    assert monitor.wait_for_new_mail(5) is True
+    assert time.monotonic() - start < 3
+    assert monitor.using_idle
+    assert subjects(monitor.check_for_bookeo_emails()) == ["New booking: 3100001"]
+    monitor.disconnect_from_mailbox()
+
+def test_idle_times_out_without_mail(server):
+    server.mailbox.add_message(generate_bookeo_message(0))
+    monitor = make_monitor(server, make_logger())
+    monitor.check_for_bookeo_emails()
+    
+    assert monitor.wait_for_new_mail(1) is False
+    assert monitor.check_for_bookeo_emails() == []
+    monitor.disconnect_from_mailbox()
+
+def test_mail_seen_by_keepalive_noop_skips_idle(server):
+    server.mailbox.add_message(generate_bookeo_message(0))
+    monitor = make_monitor(server, make_logger())
+    monitor.check_for_bookeo_emails()
+    
+    # Arrives after the check's SEARCH; the NOOP before IDLE reports it
+    server.mailbox.add_message(generate_bookeo_message(1))
+    server.reset_counters()
+    assert monitor.wait_for_new_mail(5) is True
+    assert 'IDLE' not in server.commands
+    assert subjects(monitor.check_for_bookeo_emails()) == ["New booking: 3100001"]
+    monitor.disconnect_from_mailbox()
+
+@pytest.mark.parametrize('idle_backlog', ['before', 'after'])
+def test_idle_reports_mail_that_arrived_mid_cycle(idle_backlog):
+    server = FakeIMAPServer(capabilities=("IMAP4rev1", "IDLE"), idle_backlog=idle_backlog).start()
+    try:
+        server.mailbox.add_message(generate_bookeo_message(0))
+        monitor = make_monitor(server, make_logger())
+        monitor.check_for_bookeo_emails()
+        
+        # Skip the keep-alive NOOP, so the server announces the new mail
+        # as the IDLE backlog, around its continuation response
+        connection = monitor.session.acquire()
+        monitor.session.acquire = lambda: connection
+        server.mailbox.add_message(generate_bookeo_message(1))
+        
+        start = time.monotonic()
+        assert monitor.wait_for_new_mail(5) is True
+        assert time.monotonic() - start < 3
+        assert subjects(monitor.check_for_bookeo_emails()) == ["New booking: 3100001"]
+        assert monitor.wait_for_new_mail(1) is False
+        monitor.disconnect_from_mailbox()
+    finally:
+        server.stop()
+
+def test_idle_unsupported_falls_back_to_polling():
+    server = FakeIMAPServer().start()
+    try:
+        monitor = make_monitor(server, make_logger())
+        assert monitor.wait_for_new_mail(5) is None
+        assert not monitor.using_idle
+        monitor.disconnect_from_mailbox()
+    finally:
+        server.stop()
+
+def test_checkpoint_resumes_after_restart(server, tmp_path):
+    server.mailbox.add_message(generate_bookeo_message(0))
+    monitor = make_monitor(server, make_logger(), str(tmp_path))
+    assert len(monitor.check_for_bookeo_emails()) == 1
+    assert (monitor.checkpoint.uidvalidity, monitor.checkpoint.last_uid) == (1, 1)
+    monitor.disconnect_from_mailbox()
+    
+    server.mailbox.add_message(generate_bookeo_message(1))
+    restarted = make_monitor(server, make_logger(), str(tmp_path))
+    assert restarted.build_search_criteria(1) == ('UID 2:* FROM "noreply@bookeo.com"', True)
+    assert subjects(restarted.check_for_bookeo_emails()) == ["New booking: 3100001"]
+    assert restarted.checkpoint.last_uid == 2
+    restarted.disconnect_from_mailbox()
+
+def test_checkpoint_resets_when_uidvalidity_changes(server, tmp_path):
+    for index in range(2):
+        server.mailbox.add_message(generate_bookeo_message(index))
+    monitor = make_monitor(server, make_logger(), str(tmp_path))
+    assert len(monitor.check_for_bookeo_emails()) == 2
+    monitor.disconnect_from_mailbox()
+    
+    # The mailbox is rebuilt with new UIDs; old UIDs mean nothing any more
+    rebuilt = FakeMailbox(uidvalidity=2)
+    for _, raw_message, internal_date in server.mailbox.snapshot():
+        rebuilt.add_message(raw_message, internal_date)
+    rebuilt.add_message(generate_bookeo_message(2))
+    server.mailbox = rebuilt
+    
+    restarted = make_monitor(server, make_logger(), str(tmp_path))
+    search_criteria, incremental = restarted.build_search_criteria(2)
+    assert not incremental and 'SINCE' in search_criteria
+    
+    # The date search finds all three again; only the one not alerted on is new
+    assert subjects(restarted.check_for_bookeo_emails()) == ["New booking: 3100002"]
+    assert (restarted.checkpoint.uidvalidity, restarted.checkpoint.last_uid) == (2, 3)
+    assert restarted.build_search_criteria(2)[1]
+    restarted.disconnect_from_mailbox()
+
+def test_changed_and_cancelled_bookings_are_alerted(server, tmp_path):
+    alerts = []
+    server.mailbox.add_message(generate_bookeo_message(1))
+    monitor = make_monitor(server, make_logger(), str(tmp_path))
+    monitor.alert_handler = lambda email_monitor, emails: alerts.extend(subjects(emails))
+    assert len(monitor.check_for_bookeo_emails()) == 1
+    
+    # Bookeo resends the same notification with a new Message-ID
+    server.mailbox.add_message(generate_bookeo_message(1, message_id="<resent-3100001@bookeo.com>"))
+    assert monitor.check_for_bookeo_emails() == []
+    
+    server.mailbox.add_message(generate_bookeo_message(
+        1, subject="Booking changed: 3100001", message_id="<changed-3100001@bookeo.com>"
+    ))
+    assert subjects(monitor.check_for_bookeo_emails()) == ["Booking changed: 3100001"]
+    
+    server.mailbox.add_message(generate_bookeo_message(
+        1, subject="Booking cancelled: 3100001", message_id="<cancelled-3100001@bookeo.com>"
+    ))
+    assert subjects(monitor.check_for_bookeo_emails()) == ["Booking cancelled: 3100001"]
+    monitor.disconnect_from_mailbox()
+    
+    assert alerts == ["New booking: 3100001", "Booking changed: 3100001", "Booking cancelled: 3100001"]
+    
+    # After a restart without the checkpoint the look-back search finds them all; none is alerted again
+    (tmp_path / "uid_checkpoint.json").unlink()
+    restarted = make_monitor(server, make_logger(), str(tmp_path))
+    assert restarted.check_for_bookeo_emails() == []
+    restarted.disconnect_from_mailbox()
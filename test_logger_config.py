@@ -0,0 +1,55 @@
+"""
+Tests for the queued and JSON logging setup
+"""
+
+import json
+import logging
+
+from logger_config import BoundedQueueHandler, push_log_context, pop_log_context, setup_logger
+
+def log_failure(logger):
+    try:
+        1 / 0
+    except ZeroDivisionError:
+        logger.exception("Check failed for %s", "main", extra={'stage': 'check'})
+
+def flush(logger):
+    for handler in logger.handlers:
+        if isinstance(handler, BoundedQueueHandler) and handler.listener:
+            handler.listener.stop()
+        handler.close()
+
+def test_json_exception_field_survives_the_queue(tmp_path):
+    log_file = tmp_path / "agent.log"
+    logger = setup_logger("TestJsonQueue", "INFO", str(log_file), queue_size=100, log_format='json')
+    token = push_log_context(cycle_id=7)
+    try:
+        log_failure(logger)
+    finally:
+        pop_log_context(token)
+    flush(logger)
+    
+    entry = json.loads(log_file.read_text().strip().splitlines()[-1])
+    assert entry['message'] == "Check failed for main"
+    assert entry['stage'] == 'check'
+    assert entry['cycle_id'] == 7
+    assert 'ZeroDivisionError' in entry['exception']
+
+def test_json_exception_field_without_queue(tmp_path):
+    log_file = tmp_path / "agent.log"
+    logger = setup_logger("TestJsonDirect", "INFO", str(log_file), queue_size=0, log_format='json')
+    log_failure(logger)
+    flush(logger)
+    
+    entry = json.loads(log_file.read_text().strip().splitlines()[-1])
+    assert 'ZeroDivisionError' in entry['exception']
+
+def test_text_traceback_written_once(tmp_path):
+    log_file = tmp_path / "agent.log"
+    logger = setup_logger("TestTextQueue", "INFO", str(log_file), queue_size=100)
+    log_failure(logger)
+    flush(logger)
+    
+    text = log_file.read_text()
+    assert "Check failed for main" in text
+    assert text.count("ZeroDivisionError") == 1
@@ -0,0 +1,120 @@
+"""
+Tests for the SMS outbox: claiming digest batches, and recovering alerts left
+in doubt by a crash against the fake Twilio server
+"""
+
+import pytest
+
+from fake_servers import FakeTwilioServer
+from harness import clear_twilio_env, make_logger, make_twilio_sender
+from sms_outbox import SMSOutbox
+
+RECIPIENT = "+19255550100"
+
+@pytest.fixture
+def twilio():
+    server = FakeTwilioServer().start()
+    sender, _ = make_twilio_sender(server, make_logger(), rate=1000, burst=1000)
+    yield server, sender
+    clear_twilio_env()
+    server.stop()
+
+def make_outbox(tmp_path):
+    return SMSOutbox(str(tmp_path / "sms_outbox.db"), make_logger(), max_attempts=3, retry_delay=1)
+
+def claim(outbox, key, message):
+    """Record an alert and claim it for sending, as a dispatcher worker would"""
+    outbox.add(key, RECIPIENT, message, f"email: {key}")
+    rows = outbox.claim_batch(key)
+    assert [row['key'] for row in rows] == [key]
+    return rows
+
+def test_claim_leaves_alerts_in_backoff_alone(tmp_path):
+    outbox = make_outbox(tmp_path)
+    claim(outbox, 'failed-once', "New Bookeo Email Alert! 1")
+    outbox.mark_attempt_failed(['failed-once'], "Twilio error")
+    
+    # A new alert for the same recipient is claimed on its own
+    outbox.add('new', RECIPIENT, "New Bookeo Email Alert! 2", "email: new")
+    assert [row['key'] for row in outbox.claim_batch('new')] == ['new']
+    
+    row = outbox.connection.execute("SELECT status, attempts FROM outbox WHERE key = 'failed-once'").fetchone()
+    assert (row['status'], row['attempts']) == ('pending', 1)
+    outbox.close()
+
+def test_claim_takes_due_and_unattempted_alerts_along(tmp_path):
+    outbox = make_outbox(tmp_path)
+    claim(outbox, 'retry-due', "New Bookeo Email Alert! 1")
+    outbox.mark_attempt_failed(['retry-due'], "Twilio error")
+    outbox.connection.execute("UPDATE outbox SET next_attempt_at = 0 WHERE key = 'retry-due'")
+    outbox.add('held', RECIPIENT, "New Bookeo Email Alert! 2", "email: held")
+    outbox.connection.execute("UPDATE outbox SET next_attempt_at = next_attempt_at + 60 WHERE key = 'held'")
+    outbox.add('new', RECIPIENT, "New Bookeo Email Alert! 3", "email: new")
+    
+    assert [row['key'] for row in outbox.claim_batch('new')] == ['retry-due', 'held', 'new']
+    assert outbox.get_stats()['sending'] == 3
+    outbox.close()
+
+def test_crash_after_send_is_marked_sent_without_resending(twilio, tmp_path):
+    server, sender = twilio
+    outbox = make_outbox(tmp_path)
+    claim(outbox, 'delivered', "New Bookeo Email Alert! 1")
+    sid = sender.send_message(RECIPIENT, "New Bookeo Email Alert! 1")
+    # Crash before mark_sent
+    outbox.close()
+    
+    restarted = make_outbox(tmp_path)
+    assert [row['key'] for row in restarted.in_doubt()] == ['delivered']
+    assert restarted.recover(sender.find_sent_message)
+    
+    assert restarted.get_stats()['sent'] == 1
+    assert restarted.known_sids(0) == {sid}
+    assert restarted.in_doubt() == []
+    assert restarted.due() == []
+    assert len(server.snapshot()) == 1
+    restarted.close()
+
+def test_crash_before_send_is_retried(twilio, tmp_path):
+    server, sender = twilio
+    outbox = make_outbox(tmp_path)
+    claim(outbox, 'lost', "New Bookeo Email Alert! 2")
+    outbox.close()
+    
+    restarted = make_outbox(tmp_path)
+    assert restarted.recover(sender.find_sent_message)
+    
+    assert restarted.get_stats()['pending'] == 1
+    assert restarted.due() == ['lost']
+    assert server.snapshot() == []
+    restarted.close()
+
+def test_identical_alerts_are_matched_to_distinct_messages(twilio, tmp_path):
+    server, sender = twilio
+    outbox = make_outbox(tmp_path)
+    for key in ('first', 'second'):
+        claim(outbox, key, "New Bookeo Email Alert!")
+    # Only one of the two identical texts reached Twilio
+    sid = sender.send_message(RECIPIENT, "New Bookeo Email Alert!")
+    outbox.close()
+    
+    restarted = make_outbox(tmp_path)
+    assert restarted.recover(sender.find_sent_message)
+    
+    assert restarted.known_sids(0) == {sid}
+    assert restarted.get_stats()['sent'] == 1
+    assert len(restarted.due()) == 1
+    restarted.close()
+
+def test_unreachable_twilio_keeps_alerts_in_doubt(tmp_path):
+    outbox = make_outbox(tmp_path)
+    claim(outbox, 'unknown', "New Bookeo Email Alert! 3")
+    outbox.close()
+    
+    def find_sent_message(recipient, message, since, exclude):
+        raise ConnectionError("Twilio unreachable")
+    
+    restarted = make_outbox(tmp_path)
+    assert not restarted.recover(find_sent_message)
+    assert [row['key'] for row in restarted.in_doubt()] == ['unknown']
+    assert restarted.due() == []
+    restarted.close()